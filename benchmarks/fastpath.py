@@ -0,0 +1,59 @@
+"""Per-call cost of the ORM reads against alfa.fastpath.
+
+Run from the repository root with `python benchmarks/fastpath.py [--calls N]`.
+"""
+
+import argparse
+import os
+import tempfile
+import timeit
+
+from alfa import fastpath
+from alfa.db import BaseModel, Portfolio, open_db
+
+
+DAY = 86_400_000
+START = 1_700_000_000_000
+
+
+def _setup(path, days):
+    db = open_db(path)
+    db.connect()
+    db.create_tables(BaseModel.get_models())
+    portfolio = Portfolio.init("Benchmark")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", START - 1, 1_000_000.0)
+    stock = portfolio.start_watching("AAPL")
+    stock.add_prices([(START + i * DAY, 100.0, 101.0, 99.0, 100.5, 100.5, 1000) for i in range(days)])
+    for i in range(0, days, 20):
+        account.buy(f"buy{i}", START + i * DAY + 1, "AAPL", 10, 100.0)
+    return db, account, stock
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=20_000)
+    parser.add_argument("--days", type=int, default=2_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db, account, stock = _setup(os.path.join(directory, "benchmark.db"), args.days)
+        at = START + (args.days // 2) * DAY + 3_600_000
+        cases = [
+            ("get_price()", lambda: stock.get_price(), lambda: fastpath.get_price(stock)),
+            ("get_price(ts)", lambda: stock.get_price(at), lambda: fastpath.get_price(stock, at)),
+            ("get_cash()", lambda: account.get_cash(), lambda: fastpath.get_cash(account)),
+            ("get_cash(ts)", lambda: account.get_cash(at), lambda: fastpath.get_cash(account, at)),
+            ("get_position()", lambda: account.get_position("AAPL"), lambda: fastpath.get_position(account, "AAPL")),
+            ("get_position(ts)", lambda: account.get_position("AAPL", at), lambda: fastpath.get_position(account, "AAPL", at)),
+        ]
+        print(f"{'read':<18}{'orm us/call':>14}{'fast us/call':>14}{'speedup':>10}")
+        for name, orm, fast in cases:
+            orm_seconds = min(timeit.repeat(orm, number=args.calls, repeat=3)) / args.calls
+            fast_seconds = min(timeit.repeat(fast, number=args.calls, repeat=3)) / args.calls
+            print(f"{name:<18}{orm_seconds * 1e6:>14.1f}{fast_seconds * 1e6:>14.1f}{orm_seconds / fast_seconds:>9.1f}x")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Process startup cost: importing alfa and opening a database with its schema.
+
+Run from the repository root with `python benchmarks/startup.py [--runs N]`. Each run is a fresh interpreter that
+imports the modules defining models, opens an existing database and brings its schema up to date.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+
+_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import alfa.db, alfa.blocks, alfa.fx, alfa.indicators, alfa.lots, alfa.orders
+from alfa.db import BaseModel, ensure_schema, open_db
+imported = time.perf_counter()
+db = open_db({path!r})
+db.connect()
+{schema}
+db.close()
+print((imported - start) * 1000, (time.perf_counter() - imported) * 1000, "numpy" in sys.modules)
+"""
+
+CASES = [
+    ("create_tables", "db.create_tables(BaseModel.get_models())"),
+    ("ensure_schema", "ensure_schema()"),
+]
+
+
+def _run(path, schema):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, ("src", os.environ.get("PYTHONPATH")))))
+    output = subprocess.run([sys.executable, "-c", _SCRIPT.format(path=path, schema=schema)], env=env, check=True, capture_output=True, text=True)
+    import_ms, schema_ms, numpy = output.stdout.split()
+    return float(import_ms), float(schema_ms), numpy == "True"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        # The schema exists, as at every start after the first
+        _run(path, CASES[-1][1])
+        print(f"{'schema':<16}{'import ms':>12}{'schema ms':>12}{'numpy':>8}")
+        for name, schema in CASES:
+            runs = [_run(path, schema) for _ in range(args.runs)]
+            import_ms = statistics.median(run[0] for run in runs)
+            schema_ms = statistics.median(run[1] for run in runs)
+            print(f"{name:<16}{import_ms:>12.1f}{schema_ms:>12.2f}{'yes' if runs[0][2] else 'no':>8}")
+
+
+if __name__ == "__main__":
+    main()
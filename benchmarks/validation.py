@@ -0,0 +1,50 @@
+"""Throughput of alfa.validation on clean and dirty batches of bars.
+
+Run from the repository root with `python benchmarks/validation.py [--bars N]`.
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+
+from alfa.validation import Rules, as_price_array, repair_prices, validate_prices
+
+
+MINUTE = 60_000
+START = 1_700_000_000_000
+
+
+def _bars(count, dirty):
+    rng = np.random.default_rng(0)
+    close = 100.0 + np.cumsum(rng.normal(0.0, 0.1, count))
+    bars = np.column_stack((START + np.arange(count) * MINUTE, close, close + 1.0, close - 1.0, close, close, np.full(count, 100.0)))
+    if dirty:
+        # One bar in a thousand with its high and low swapped, and a few duplicates
+        swapped = rng.choice(count, count // 1000, replace=False)
+        bars[swapped, 2], bars[swapped, 3] = bars[swapped, 3], bars[swapped, 2].copy()
+        bars[rng.choice(count - 1, count // 10_000, replace=False) + 1, 0] -= MINUTE
+    return bars
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bars", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    rules = Rules(max_move=0.2, max_interval=3_600_000)
+    tuples = [tuple(bar) for bar in _bars(args.bars, False).tolist()]
+    cases = [
+        ("clean", lambda bars: validate_prices("AAPL", bars, rules), _bars(args.bars, False)),
+        ("dirty", lambda bars: validate_prices("AAPL", bars, rules), _bars(args.bars, True)),
+        ("dirty + repair", lambda bars: repair_prices(bars, validate_prices("AAPL", bars, rules)), _bars(args.bars, True)),
+        ("tuples", lambda bars: validate_prices("AAPL", as_price_array(bars), rules), tuples),
+    ]
+    print(f"{'batch':<16}{'bars/s':>16}")
+    for name, run, bars in cases:
+        seconds = min(timeit.repeat(lambda run=run, bars=bars: run(bars), number=1, repeat=3))
+        print(f"{name:<16}{args.bars / seconds:>16,.0f}")
+
+
+if __name__ == "__main__":
+    main()
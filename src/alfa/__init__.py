@@ -0,0 +1,35 @@
+import importlib
+
+
+# Subsystems are imported on first access, e.g. `alfa.risk`, so importing the package costs nothing until they are used
+_SUBMODULES = (
+    "audit",
+    "blocks",
+    "cache",
+    "calendar",
+    "db",
+    "fastpath",
+    "feed",
+    "fx",
+    "history",
+    "indicators",
+    "lots",
+    "orders",
+    "partitions",
+    "rebalance",
+    "risk",
+    "runner",
+    "shards",
+    "trace",
+    "validation",
+)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES))
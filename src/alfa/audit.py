@@ -0,0 +1,279 @@
+import argparse
+import logging
+from collections import namedtuple
+from enum import Enum
+
+from peewee import BigIntegerField, ForeignKeyField, IntegerField
+
+from alfa.db import Account, Balance, BaseModel, Position, TransactionType, _get_symbol, db, get_history_models, open_db, strtimestamp
+
+
+log = logging.getLogger("alfa")
+
+
+class AuditMark(BaseModel):
+    """High-water mark of an account's audit: its balances and positions matched the ledgers up to `timestamp`,
+    which held the entries up to `cash_ledger_id` and `transaction_ledger_id`.
+    """
+
+    account = ForeignKeyField(Account, primary_key=True, backref="audit_mark", on_delete="CASCADE")
+    timestamp = BigIntegerField()  # Unix epoch time
+    cash_ledger_id = IntegerField()
+    transaction_ledger_id = IntegerField()
+
+    class Meta:
+        table_name = "audit_mark"
+
+
+class AuditCheck(Enum):
+    CASH = "cash"
+    SIZE = "size"
+    AVERAGE_PRICE = "average price"
+
+
+# The first point where an account's derived state differs from its ledgers. `actual` is None for a missing history
+# row, `expected` for a history row no ledger entry explains.
+Divergence = namedtuple("Divergence", ["account", "timestamp", "check", "symbol", "expected", "actual"])
+
+# Number of accounts audited, how many of them from their mark, and the first divergence of each divergent account
+AuditReport = namedtuple("AuditReport", ["accounts", "incremental", "divergences"])
+
+
+# Balance and position history, archived years included, then the accounts to audit with the timestamp and cash of
+# their mark when they are audited from it. A mark is ignored once an entry was written at or before it, as the history
+# after that entry was rewritten.
+_AUDITED_SQL = """
+balances AS ({balances}),
+positions AS ({positions}),
+marks AS (
+    SELECT m.account_id, m.timestamp,
+        (SELECT b.cash FROM balances AS b WHERE b.account_id = m.account_id AND b.timestamp <= m.timestamp ORDER BY b.timestamp DESC LIMIT 1) AS cash
+    FROM audit_mark AS m
+    WHERE ?
+        AND NOT EXISTS (
+            SELECT 1 FROM cash_ledger AS c WHERE c.account_id = m.account_id AND c.id > m.cash_ledger_id AND c.timestamp <= m.timestamp
+        )
+        AND NOT EXISTS (
+            SELECT 1 FROM transaction_ledger AS t WHERE t.account_id = m.account_id AND t.id > m.transaction_ledger_id AND t.timestamp <= m.timestamp
+        )
+),
+audited AS (
+    SELECT a.id AS account_id, m.timestamp AS since, m.cash FROM account AS a LEFT JOIN marks AS m ON m.account_id = a.id WHERE {where}
+)"""
+
+# The running cash of the ledgers at each timestamp against the latest balance at or before it. The balance is the
+# last non-null cash, found by numbering the groups of rows that start at each balance.
+_CASH_SQL = f"""
+WITH {_AUDITED_SQL},
+changes AS (
+    SELECT account_id, since AS timestamp, COALESCE(cash, 0.0) AS delta, COALESCE(cash, 0.0) AS cash FROM audited WHERE since IS NOT NULL
+    UNION ALL
+    SELECT c.account_id, c.timestamp,
+        CASE c.type WHEN '{TransactionType.DEPOSIT.value}' THEN c.amount - c.fees ELSE -(c.amount + c.fees) END, NULL
+    FROM cash_ledger AS c JOIN audited AS u ON u.account_id = c.account_id
+    WHERE u.since IS NULL OR c.timestamp > u.since
+    UNION ALL
+    SELECT t.account_id, t.timestamp,
+        CASE t.type
+            WHEN '{TransactionType.BUY.value}' THEN -(t.quantity * t.price + t.fees)
+            WHEN '{TransactionType.SELL.value}' THEN t.quantity * t.price - t.fees
+            ELSE -t.fees
+        END,
+        NULL
+    FROM transaction_ledger AS t JOIN audited AS u ON u.account_id = t.account_id
+    WHERE u.since IS NULL OR t.timestamp > u.since
+    UNION ALL
+    SELECT b.account_id, b.timestamp, 0.0, b.cash
+    FROM balances AS b JOIN audited AS u ON u.account_id = b.account_id
+    WHERE u.since IS NULL OR b.timestamp > u.since
+),
+steps AS (
+    SELECT account_id, timestamp, SUM(delta) AS delta, MAX(cash) AS cash FROM changes GROUP BY account_id, timestamp
+),
+running AS (
+    SELECT account_id, timestamp, cash, SUM(delta) OVER w AS expected, COUNT(cash) OVER w AS balance_group
+    FROM steps
+    WINDOW w AS (PARTITION BY account_id ORDER BY timestamp)
+),
+compared AS (
+    SELECT account_id, timestamp, expected, MAX(cash) OVER (PARTITION BY account_id, balance_group) AS actual FROM running
+)
+SELECT account_id, MIN(timestamp), expected, actual
+FROM compared
+WHERE ABS(COALESCE(actual, 0.0) - expected) > ? * MAX(1.0, ABS(expected))
+GROUP BY account_id
+"""
+
+# The trades of each account and stock in order, with the running size and the position at the trade's timestamp.
+# Accounts audited from their mark start from their positions at the mark, as trades of their size at their price.
+_POSITION_SQL = f"""
+WITH {_AUDITED_SQL},
+seeds AS (
+    SELECT p.account_id, p.stock_id, u.since AS timestamp, p.size, p.average_price,
+        ROW_NUMBER() OVER (PARTITION BY p.account_id, p.stock_id ORDER BY p.timestamp DESC) AS row_rank
+    FROM positions AS p JOIN audited AS u ON u.account_id = p.account_id
+    WHERE p.timestamp <= u.since
+),
+trades AS (
+    SELECT account_id, stock_id, timestamp, 0 AS id, size AS quantity, average_price AS price FROM seeds WHERE row_rank = 1
+    UNION ALL
+    SELECT t.account_id, t.stock_id, t.timestamp, t.id,
+        CASE t.type WHEN '{TransactionType.SELL.value}' THEN -t.quantity ELSE t.quantity END, t.price
+    FROM transaction_ledger AS t JOIN audited AS u ON u.account_id = t.account_id
+    WHERE u.since IS NULL OR t.timestamp > u.since
+)
+SELECT e.account_id, e.stock_id, e.timestamp, e.quantity, e.price,
+    SUM(e.quantity) OVER w AS expected,
+    LEAD(e.timestamp) OVER w IS NOT e.timestamp AS last,
+    CASE e.id WHEN 0 THEN e.quantity ELSE p.size END,
+    CASE e.id WHEN 0 THEN e.price ELSE p.average_price END
+FROM trades AS e
+LEFT JOIN positions AS p ON p.account_id = e.account_id AND p.stock_id = e.stock_id AND p.timestamp = e.timestamp
+WINDOW w AS (PARTITION BY e.account_id, e.stock_id ORDER BY e.timestamp, e.id)
+ORDER BY e.account_id, e.stock_id, e.timestamp, e.id
+"""
+
+# Positions written at a timestamp without a trade of their account and stock
+_ORPHAN_POSITION_SQL = f"""
+WITH {_AUDITED_SQL}
+SELECT p.account_id, p.stock_id, MIN(p.timestamp), p.size
+FROM positions AS p JOIN audited AS u ON u.account_id = p.account_id
+WHERE (u.since IS NULL OR p.timestamp > u.since)
+    AND NOT EXISTS (
+        SELECT 1 FROM transaction_ledger AS t WHERE t.account_id = p.account_id AND t.stock_id = p.stock_id AND t.timestamp = p.timestamp
+    )
+GROUP BY p.account_id
+"""
+
+# The last timestamp and ledger ids of each audited account, for its next mark
+_MARK_SQL = """
+WITH {audited},
+rows AS (
+    SELECT m.account_id, m.timestamp, m.cash_ledger_id, m.transaction_ledger_id
+    FROM audit_mark AS m JOIN audited AS u ON u.account_id = m.account_id
+    WHERE u.since IS NOT NULL
+    UNION ALL
+    SELECT c.account_id, c.timestamp, c.id, 0
+    FROM cash_ledger AS c JOIN audited AS u ON u.account_id = c.account_id
+    WHERE u.since IS NULL OR c.timestamp > u.since
+    UNION ALL
+    SELECT t.account_id, t.timestamp, 0, t.id
+    FROM transaction_ledger AS t JOIN audited AS u ON u.account_id = t.account_id
+    WHERE u.since IS NULL OR t.timestamp > u.since
+    UNION ALL
+    SELECT b.account_id, b.timestamp, 0, 0
+    FROM balances AS b JOIN audited AS u ON u.account_id = b.account_id
+    WHERE u.since IS NULL OR b.timestamp > u.since
+    UNION ALL
+    SELECT p.account_id, p.timestamp, 0, 0
+    FROM positions AS p JOIN audited AS u ON u.account_id = p.account_id
+    WHERE u.since IS NULL OR p.timestamp > u.since
+)
+SELECT account_id, MAX(timestamp), MAX(cash_ledger_id), MAX(transaction_ledger_id) FROM rows GROUP BY account_id
+""".format(audited=_AUDITED_SQL)
+
+
+def _get_history_sql(model, columns):
+    # The model's rows from the hot table and the partitions of archived years
+    tables = (f'"{history_model._meta.schema or "main"}"."{history_model._meta.table_name}"' for history_model in get_history_models(model))
+    return " UNION ALL ".join(f"SELECT {columns} FROM {table}" for table in tables)
+
+
+def _differs(expected, actual, tolerance):
+    return actual is None or abs(actual - expected) > tolerance * max(1.0, abs(expected))
+
+
+def _get_position_divergences(clauses, params, tolerance):
+    # Sizes are running sums, but an average price depends on the order of the trades, so it is replayed
+    divergences = {}
+    key = size = average_price = None
+    for account_id, stock_id, timestamp, quantity, price, expected, last, actual_size, actual_average_price in db.execute_sql(
+        _POSITION_SQL.format(**clauses), params
+    ):
+        if (account_id, stock_id) != key:
+            key, size, average_price = (account_id, stock_id), 0, 0.0
+        if expected == 0:
+            average_price = 0.0
+        elif quantity > 0:
+            average_price = (average_price * size + price * quantity) / expected
+        size = expected
+        if not last or account_id in divergences and divergences[account_id].timestamp <= timestamp:
+            continue
+        if actual_size != expected:
+            divergences[account_id] = Divergence(account_id, timestamp, AuditCheck.SIZE, _get_symbol(stock_id), expected, actual_size)
+        elif _differs(average_price, actual_average_price, tolerance):
+            divergences[account_id] = Divergence(
+                account_id, timestamp, AuditCheck.AVERAGE_PRICE, _get_symbol(stock_id), average_price, actual_average_price
+            )
+    for account_id, stock_id, timestamp, actual_size in db.execute_sql(_ORPHAN_POSITION_SQL.format(**clauses), params):
+        if account_id not in divergences or timestamp < divergences[account_id].timestamp:
+            divergences[account_id] = Divergence(account_id, timestamp, AuditCheck.SIZE, _get_symbol(stock_id), None, actual_size)
+    return divergences
+
+
+def audit(accounts=None, full=False, tolerance=1e-6):
+    """Reconcile the balances and positions of `accounts` (accounts or ids, all by default) with their ledgers.
+
+    An account whose state matches moves its AuditMark to its last entry, and the next audit only checks what was
+    written after it; `full` ignores the marks. Cash and average prices match within `tolerance`, relative above 1.
+    Returns an AuditReport with the first divergence of each divergent account.
+    """
+    try:
+        ids = None if accounts is None else [getattr(account, "id", account) for account in accounts]
+        clauses = {
+            "where": "1" if ids is None else f"a.id IN ({', '.join('?' * len(ids))})",
+            "balances": _get_history_sql(Balance, "account_id, timestamp, cash"),
+            "positions": _get_history_sql(Position, "account_id, stock_id, timestamp, size, average_price"),
+        }
+        params = [not full] + (ids or [])
+        with db.atomic():
+            audited, incremental = db.execute_sql(
+                f"WITH {_AUDITED_SQL.format(**clauses)} SELECT COUNT(*), COUNT(since) FROM audited", params
+            ).fetchone()
+            divergences = _get_position_divergences(clauses, params, tolerance)
+            for account_id, timestamp, expected, actual in db.execute_sql(_CASH_SQL.format(**clauses), params + [tolerance]):
+                if account_id not in divergences or timestamp < divergences[account_id].timestamp:
+                    divergences[account_id] = Divergence(account_id, timestamp, AuditCheck.CASH, None, expected, actual)
+
+            marks = [
+                {"account": account_id, "timestamp": timestamp, "cash_ledger_id": cash_ledger_id, "transaction_ledger_id": transaction_ledger_id}
+                for account_id, timestamp, cash_ledger_id, transaction_ledger_id in db.execute_sql(_MARK_SQL.format(**clauses), params)
+                if account_id not in divergences
+            ]
+            if marks:
+                AuditMark.replace_many(marks).execute()
+
+        divergences = [divergences[account_id] for account_id in sorted(divergences)]
+        if divergences:
+            log.warning("Found %s of %s audited accounts diverging from their ledgers.", len(divergences), audited)
+        log.info("Audited %s accounts, %s from their mark.", audited, incremental)
+        return AuditReport(audited, incremental, divergences)
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to audit accounts: {type(e).__name__} : {e}")
+        raise e
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile the balances and positions of an alfa database with its ledgers.")
+    parser.add_argument("path", help="Database file")
+    parser.add_argument("--account", type=int, action="append", help="Id of an account to audit, all by default")
+    parser.add_argument("--full", action="store_true", help="Audit the whole history rather than from each account's mark")
+    args = parser.parse_args()
+
+    open_db(args.path).connect()
+    try:
+        report = audit(args.account, args.full)
+    finally:
+        db.close()
+    for divergence in report.divergences:
+        symbol = f" {divergence.symbol}" if divergence.symbol else ""
+        print(
+            f"Account {divergence.account}: {divergence.check.value}{symbol} diverges at {strtimestamp(divergence.timestamp)}. "
+            f"Expected: {divergence.expected}. Actual: {divergence.actual}."
+        )
+    print(f"Audited {report.accounts} accounts, {report.incremental} from their mark. {len(report.divergences)} diverge.")
+    return 1 if report.divergences else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,199 @@
+import logging
+import lzma
+import zlib
+from enum import Enum
+
+import numpy as np
+from peewee import BigIntegerField, BlobField, ForeignKeyField, IntegerField, TextField
+
+from alfa.db import BaseModel, Price, Stock, add_history_store, db, get_history_models, strtimestamp
+
+
+log = logging.getLogger("alfa")
+
+
+class Compression(str, Enum):
+    ZLIB = "ZLIB"
+    LZMA = "LZMA"
+
+
+_COMPRESSORS = {
+    Compression.ZLIB.value: (zlib.compress, zlib.decompress),
+    Compression.LZMA.value: (lzma.compress, lzma.decompress),
+}
+
+PRICE_DTYPE = np.dtype(
+    [
+        ("timestamp", np.int64),
+        ("open", np.float64),
+        ("high", np.float64),
+        ("low", np.float64),
+        ("close", np.float64),
+        ("adjusted_close", np.float64),
+        ("volume", np.int64),
+    ]
+)
+
+
+class PriceBlock(BaseModel):
+    reference = True
+
+    id = IntegerField(primary_key=True)
+    stock = ForeignKeyField(Stock, backref="price_blocks", on_delete="CASCADE")
+    month = IntegerField()  # YYYYMM, in UTC
+    first_timestamp = BigIntegerField()  # Unix epoch time
+    last_timestamp = BigIntegerField()  # Unix epoch time
+    count = IntegerField()
+    compression = TextField(choices=[c.value for c in Compression])
+    data = BlobField()
+
+    class Meta:
+        table_name = "price_block"
+        indexes = (
+            (("stock", "month"), True),  # Unique constraint on stock and month
+            (("stock", "first_timestamp"), False),
+        )
+
+
+def encode(bars, compression=Compression.ZLIB):
+    """Compress bars sorted by timestamp: delta-encoded timestamps followed by one array per column."""
+    timestamps = bars["timestamp"]
+    columns = [np.diff(timestamps, prepend=0)] + [bars[name] for name in PRICE_DTYPE.names[1:]]
+    compress, _ = _COMPRESSORS[Compression(compression).value]
+    return compress(b"".join(np.ascontiguousarray(column).tobytes() for column in columns))
+
+
+def decode(data, count, compression):
+    _, decompress = _COMPRESSORS[Compression(compression).value]
+    raw = decompress(data)
+    bars = np.empty(count, dtype=PRICE_DTYPE)
+    for i, name in enumerate(PRICE_DTYPE.names):
+        bars[name] = np.frombuffer(raw, dtype=PRICE_DTYPE[name], count=count, offset=i * 8 * count)
+    bars["timestamp"] = np.cumsum(bars["timestamp"])
+    return bars
+
+
+def _months(timestamps):
+    months = timestamps.astype("datetime64[ms]").astype("datetime64[M]").astype(np.int64)
+    return (1970 + months // 12) * 100 + months % 12 + 1
+
+
+def _merge(old, new):
+    # Union of two bar arrays sorted by timestamp, the new bars replacing old ones with the same timestamp
+    old = old[~np.isin(old["timestamp"], new["timestamp"])]
+    bars = np.concatenate((old, new))
+    return bars[np.argsort(bars["timestamp"], kind="stable")]
+
+
+def _select_rows(stock, from_timestamp=None, to_timestamp=None, model=Price):
+    where_clause = model.stock == stock
+    if from_timestamp is not None:
+        where_clause &= model.timestamp >= from_timestamp
+    if to_timestamp is not None:
+        where_clause &= model.timestamp <= to_timestamp
+    fields = [getattr(model, name) for name in PRICE_DTYPE.names]
+    return np.array(list(model.select(*fields).where(where_clause).order_by(model.timestamp).tuples()), dtype=PRICE_DTYPE)
+
+
+def _select_blocks(stock, from_timestamp=None, to_timestamp=None):
+    where_clause = PriceBlock.stock == stock
+    if from_timestamp is not None:
+        where_clause &= PriceBlock.last_timestamp >= from_timestamp
+    if to_timestamp is not None:
+        where_clause &= PriceBlock.first_timestamp <= to_timestamp
+    return PriceBlock.select().where(where_clause).order_by(PriceBlock.first_timestamp)
+
+
+def pack_prices(stock, to_timestamp=None, compression=Compression.ZLIB):
+    """Move the stock's bars up to `to_timestamp` from the price table into monthly blocks.
+
+    Bars are merged into the blocks already stored for their month. Returns the number of bars packed.
+    """
+    try:
+        compression = Compression(compression)
+        with db.atomic():
+            bars = _select_rows(stock, to_timestamp=to_timestamp)
+            if not len(bars):
+                return 0
+            months = _months(bars["timestamp"])
+            existing = PriceBlock.select().where((PriceBlock.stock == stock) & PriceBlock.month.in_(np.unique(months).tolist()))
+            existing = {block.month: block for block in existing}
+            for month in np.unique(months):
+                month_bars = bars[months == month]
+                block = existing.get(int(month))
+                if block:
+                    month_bars = _merge(decode(block.data, block.count, block.compression), month_bars)
+                PriceBlock.insert(
+                    stock=stock,
+                    month=int(month),
+                    first_timestamp=int(month_bars["timestamp"][0]),
+                    last_timestamp=int(month_bars["timestamp"][-1]),
+                    count=len(month_bars),
+                    compression=compression.value,
+                    data=encode(month_bars, compression),
+                ).on_conflict_replace().execute()
+            Price.delete().where((Price.stock == stock) & (Price.timestamp <= int(bars["timestamp"][-1]))).execute()
+        log.debug(f"Packed {len(bars)} prices for {stock.symbol} up to {strtimestamp(int(bars['timestamp'][-1]))}.")
+        return len(bars)
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to pack prices for {stock.symbol}: {type(e).__name__} : {e}")
+        raise e
+
+
+def unpack_prices(stock, batch_size=500):
+    """Move the stock's blocks back into the price table. Returns the number of bars unpacked."""
+    try:
+        count = 0
+        with db.atomic():
+            for block in _select_blocks(stock):
+                bars = read_block(block)
+                rows = [dict(zip(PRICE_DTYPE.names, bar.tolist(), strict=True), stock=stock.id, symbol=stock.symbol) for bar in bars]
+                for i in range(0, len(rows), batch_size):
+                    # Bars written to the price table after packing are kept
+                    Price.insert_many(rows[i : i + batch_size]).on_conflict_ignore().execute()
+                count += len(rows)
+            PriceBlock.delete().where(PriceBlock.stock == stock).execute()
+        log.debug(f"Unpacked {count} prices for {stock.symbol}.")
+        return count
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to unpack prices for {stock.symbol}: {type(e).__name__} : {e}")
+        raise e
+
+
+def read_block(block):
+    return decode(block.data, block.count, block.compression)
+
+
+def read_prices(stock, from_timestamp=None, to_timestamp=None):
+    """The stock's bars between `from_timestamp` and `to_timestamp` from the blocks, the price table and its archived
+    years, as a structured array of PRICE_DTYPE sorted by timestamp."""
+    try:
+        parts = [read_block(block) for block in _select_blocks(stock, from_timestamp, to_timestamp)]
+        bars = np.concatenate(parts) if parts else np.empty(0, dtype=PRICE_DTYPE)
+        if from_timestamp is not None or to_timestamp is not None:
+            timestamps = bars["timestamp"]
+            lo = np.searchsorted(timestamps, from_timestamp, side="left") if from_timestamp is not None else 0
+            hi = np.searchsorted(timestamps, to_timestamp, side="right") if to_timestamp is not None else len(bars)
+            bars = bars[lo:hi]
+        rows = [_select_rows(stock, from_timestamp, to_timestamp, model) for model in get_history_models(Price, from_timestamp, to_timestamp)]
+        return _merge(bars, np.concatenate(rows))
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to read prices for {stock.symbol}: {type(e).__name__} : {e}")
+        raise e
+
+
+def _get_packed_price(keys, from_timestamp, to_timestamp):
+    stock = keys["stock"]
+    # Block index lookup: the latest block starting by to_timestamp holds the most recent packed bar
+    block = _select_blocks(stock, from_timestamp, to_timestamp).order_by(PriceBlock.first_timestamp.desc()).first()
+    if not block:
+        return None
+    bars = read_block(block)
+    i = np.searchsorted(bars["timestamp"], to_timestamp, side="right") - 1 if to_timestamp else len(bars) - 1
+    if i < 0 or (from_timestamp and bars["timestamp"][i] < from_timestamp):
+        return None
+    bar = dict(zip(PRICE_DTYPE.names, bars[i].tolist(), strict=True))
+    return Price(stock=stock, symbol=stock.symbol, **bar)
+
+
+add_history_store(Price, _get_packed_price)
@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+
+CacheStats = namedtuple("CacheStats", ["hits", "misses", "evictions", "size", "maxsize"])
+
+# Marks a missing entry, as None can be cached
+MISSING = object()
+
+
+class LRUCache:
+    """Bounded, thread-safe mapping that evicts the least recently used entry and counts hits and misses."""
+
+    def __init__(self, maxsize):
+        if maxsize <= 0:
+            raise ValueError("Cache size must be positive.")
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            value = self._entries.get(key, MISSING)
+            if value is MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=MISSING):
+        """The entry for `key`, without counting a hit or a miss or refreshing it."""
+        with self._lock:
+            return self._entries.get(key, default)
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_where(self, predicate):
+        """Drop the entries whose key matches `predicate`."""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
+
+    @property
+    def stats(self):
+        return CacheStats(self.hits, self.misses, self.evictions, len(self._entries), self.maxsize)
+
+
+# Named process-local caches
+_caches = {}
+
+
+def get_cache(name, maxsize=1024):
+    """The cache registered under `name`, created with `maxsize` entries on first use."""
+    if name not in _caches:
+        _caches[name] = LRUCache(maxsize)
+    return _caches[name]
+
+
+def get_stats():
+    return {name: cache.stats for name, cache in _caches.items()}
+
+
+def clear_caches():
+    for cache in _caches.values():
+        cache.clear()
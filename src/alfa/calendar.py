@@ -0,0 +1,226 @@
+import logging
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta
+from enum import Enum
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+
+log = logging.getLogger("alfa")
+
+
+FIRST_YEAR = 1970
+LAST_YEAR = 2099
+
+
+class Exchange(str, Enum):
+    NYSE = "NYSE"
+    TSX = "TSX"
+
+
+DEFAULT_EXCHANGE = Exchange.NYSE
+
+
+def _easter(year):
+    # Anonymous Gregorian algorithm
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = divmod(b, 4)
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7  # noqa: E741
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def _nth_weekday(year, month, weekday, n):
+    """The n-th `weekday` (Monday is 0) of the month, counting from the end when n is negative."""
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7 + 7 * (-n - 1))
+
+
+def _nearest_weekday(day):
+    # Saturday holidays are observed on Friday, Sunday holidays on Monday
+    return day + timedelta(days={5: -1, 6: 1}.get(day.weekday(), 0))
+
+
+def _next_weekday(day):
+    return day + timedelta(days={5: 2, 6: 1}.get(day.weekday(), 0))
+
+
+# One-off NYSE closures since 2001: September 11, Reagan, Ford, Hurricane Sandy, Bush and Carter.
+_NYSE_CLOSURES = {
+    date(2001, 9, 11),
+    date(2001, 9, 12),
+    date(2001, 9, 13),
+    date(2001, 9, 14),
+    date(2004, 6, 11),
+    date(2007, 1, 2),
+    date(2012, 10, 29),
+    date(2012, 10, 30),
+    date(2018, 12, 5),
+    date(2025, 1, 9),
+}
+
+
+def _nyse_holidays(year):
+    new_year = date(year, 1, 1)
+    holidays = {
+        # A Saturday New Year's Day is not observed on the previous Friday
+        _next_weekday(new_year) if new_year.weekday() == 6 else new_year,
+        _nth_weekday(year, 2, 0, 3) if year >= 1971 else _nearest_weekday(date(year, 2, 22)),
+        _easter(year) - timedelta(days=2),
+        _nth_weekday(year, 5, 0, -1) if year >= 1971 else _nearest_weekday(date(year, 5, 30)),
+        _nearest_weekday(date(year, 7, 4)),
+        _nth_weekday(year, 9, 0, 1),
+        _nth_weekday(year, 11, 3, 4),
+        _nearest_weekday(date(year, 12, 25)),
+    }
+    if year >= 1998:
+        holidays.add(_nth_weekday(year, 1, 0, 3))
+    if year >= 2022:
+        holidays.add(_nearest_weekday(date(year, 6, 19)))
+    holidays.update(day for day in _NYSE_CLOSURES if day.year == year)
+    early_closes = {date(year, 7, 3), _nth_weekday(year, 11, 3, 4) + timedelta(days=1), date(year, 12, 24)}
+    return holidays, early_closes
+
+
+def _tsx_holidays(year):
+    christmas = _next_weekday(date(year, 12, 25))
+    holidays = {
+        _next_weekday(date(year, 1, 1)),
+        _easter(year) - timedelta(days=2),
+        # Victoria Day is the Monday before May 25
+        date(year, 5, 24) - timedelta(days=date(year, 5, 24).weekday()),
+        _next_weekday(date(year, 7, 1)),
+        _nth_weekday(year, 8, 0, 1),
+        _nth_weekday(year, 9, 0, 1),
+        _nth_weekday(year, 10, 0, 2),
+        christmas,
+        _next_weekday(christmas + timedelta(days=1)),
+    }
+    if year >= 2008:
+        holidays.add(_nth_weekday(year, 2, 0, 3))
+    return holidays, {date(year, 12, 24)}
+
+
+_Rules = namedtuple("_Rules", ["timezone", "open", "close", "early_close", "holidays"])
+
+_RULES = {
+    Exchange.NYSE: _Rules("America/New_York", time(9, 30), time(16, 0), time(13, 0), _nyse_holidays),
+    Exchange.TSX: _Rules("America/Toronto", time(9, 30), time(16, 0), time(13, 0), _tsx_holidays),
+}
+
+
+_EPOCH = date(1970, 1, 1).toordinal()
+
+
+def _ms(at):
+    return ((at.hour * 60 + at.minute) * 60 + at.second) * 1000
+
+
+class TradingCalendar:
+    """Sessions of an exchange from `first_year` to `last_year`, precomputed as sorted epoch millisecond arrays.
+
+    Holidays and early closes follow each exchange's rules rather than a historical record, plus the known NYSE
+    one-off closures since 2001. Lookups bisect the arrays; the bulk variants take and return numpy arrays.
+    """
+
+    def __init__(self, exchange=DEFAULT_EXCHANGE, first_year=FIRST_YEAR, last_year=LAST_YEAR):
+        self.exchange = Exchange(exchange)
+        rules = _RULES[self.exchange]
+        self.tz = ZoneInfo(rules.timezone)
+
+        self.days, self.day_starts, self.opens, self.closes = [], [], [], []
+        for year in range(first_year, last_year + 1):
+            holidays, early_closes = rules.holidays(year)
+            day = date(year, 1, 1)
+            while day.year == year:
+                if day.weekday() < 5 and day not in holidays:
+                    # Local midnight in epoch milliseconds; the sessions start after any DST change at 2 a.m.
+                    midnight = (day.toordinal() - _EPOCH) * 86_400_000
+                    offset = int(self.tz.utcoffset(datetime.combine(day, time(12))).total_seconds() * 1000)
+                    close = rules.early_close if day in early_closes else rules.close
+                    self.days.append(day.toordinal())
+                    self.day_starts.append(midnight - int(self.tz.utcoffset(datetime.combine(day, time.min)).total_seconds() * 1000))
+                    self.opens.append(midnight + _ms(rules.open) - offset)
+                    self.closes.append(midnight + _ms(close) - offset)
+                day += timedelta(days=1)
+
+        self._days = np.array(self.days, dtype=np.int64) - _EPOCH
+        self._day_starts = np.array(self.day_starts, dtype=np.int64)
+        self._opens = np.array(self.opens, dtype=np.int64)
+        self._closes = np.array(self.closes, dtype=np.int64)
+        log.debug(f"Precomputed {len(self.days)} {self.exchange.value} sessions from {first_year} to {last_year}.")
+
+    def __len__(self):
+        return len(self.days)
+
+    def today(self):
+        return datetime.now(self.tz).date()
+
+    def is_session(self, day):
+        i = bisect_right(self.days, day.toordinal()) - 1
+        return i >= 0 and self.days[i] == day.toordinal()
+
+    def get_session(self, timestamp):
+        """Index of the session open at `timestamp`, None outside trading hours."""
+        i = bisect_right(self.opens, timestamp) - 1
+        return i if i >= 0 and timestamp <= self.closes[i] else None
+
+    def get_session_day(self, timestamp):
+        """Index of the latest session whose day started at or before `timestamp`."""
+        i = bisect_right(self.day_starts, timestamp) - 1
+        if i < 0 or timestamp >= self.day_starts[-1] + 86_400_000:
+            raise ValueError(f"{timestamp} is outside the {self.exchange.value} calendar.")
+        return i
+
+    def get_day(self, timestamp):
+        return date.fromordinal(self.days[self.get_session_day(timestamp)])
+
+    def get_day_start(self, timestamp):
+        return self.day_starts[self.get_session_day(timestamp)]
+
+    def get_eod_timestamp(self, day):
+        """Close of the session on `day`, or of the last session before it when the exchange is closed that day."""
+        i = bisect_right(self.days, day.toordinal()) - 1
+        if i < 0 or day.toordinal() > self.days[-1]:
+            raise ValueError(f"{day} is outside the {self.exchange.value} calendar.")
+        return self.closes[i]
+
+    def get_sessions(self, timestamps):
+        """Bulk `get_session`, -1 outside trading hours."""
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        index = np.searchsorted(self._opens, timestamps, side="right") - 1
+        inside = (index >= 0) & (timestamps <= self._closes[np.maximum(index, 0)])
+        return np.where(inside, index, -1)
+
+    def get_days(self, timestamps):
+        """Bulk `get_day` as datetime64[D], NaT before the first session."""
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        index = np.searchsorted(self._day_starts, timestamps, side="right") - 1
+        days = self._days[np.maximum(index, 0)].astype("datetime64[D]")
+        return np.where(index >= 0, days, np.datetime64("NaT"))
+
+    def get_eod_timestamps(self, timestamps):
+        """Close of the session day each of `timestamps` belongs to, -1 before the first session."""
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        index = np.searchsorted(self._day_starts, timestamps, side="right") - 1
+        return np.where(index >= 0, self._closes[np.maximum(index, 0)], -1)
+
+
+_calendars = {}
+
+
+def get_calendar(exchange=None):
+    """The exchange's calendar, built on first use."""
+    exchange = Exchange(exchange or DEFAULT_EXCHANGE)
+    if exchange not in _calendars:
+        _calendars[exchange] = TradingCalendar(exchange)
+    return _calendars[exchange]
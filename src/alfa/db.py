@@ -1,37 +1,261 @@
+import importlib
 import logging
+import math
 import os
-from datetime import datetime, time
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
 from enum import Enum
-
-from peewee import BigIntegerField, FloatField, ForeignKeyField, IntegerField, Model, SqliteDatabase, TextField
+from functools import partial
+
+from peewee import (
+    BigIntegerField,
+    CompositeKey,
+    FloatField,
+    ForeignKeyField,
+    IntegerField,
+    Model,
+    SqliteDatabase,
+    TextField,
+    _ConnectionState,
+    _savepoint,
+)
+
+from alfa.cache import MISSING, clear_caches, get_cache
+from alfa.calendar import Exchange, get_calendar
+from alfa.feed import Event, EventType, feed
+from alfa.trace import tracer
 
 
 log = logging.getLogger("alfa")
 logging.getLogger("peewee").setLevel(max(log.getEffectiveLevel(), logging.ERROR))
 
 
-db = SqliteDatabase(None, pragmas={"foreign_keys": 1})
+class _RoutedState(threading.local):
+    # Connection state of the calling thread for each database file it was routed to, None being the opened database
+    def __init__(self):
+        self.path = None
+        self.states = {}
+        # Callbacks waiting for the transaction on each path to commit
+        self.pending = {}
+
+    def __getattr__(self, name):
+        return getattr(self.states.setdefault(self.path, _ConnectionState()), name)
+
+
+class RoutedSqliteDatabase(SqliteDatabase):
+    """SqliteDatabase whose queries can be routed, per thread, to another database file.
+
+    A routed connection attaches the opened database as `ref`, so tables missing from the routed file resolve to it,
+    and the databases attached to the opened one, e.g. the history partitions of its reference tables.
+    Each thread keeps one connection per file it was routed to.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._state = _RoutedState()
+
+    @property
+    def route(self):
+        return self._state.path
+
+    @contextmanager
+    def routed(self, path):
+        previous = self._state.path
+        self._state.path = path
+        try:
+            yield self
+        finally:
+            self._state.path = previous
+
+    def close_routes(self):
+        """Close the calling thread's routed connections."""
+        previous = self._state.path
+        try:
+            for path in [path for path in self._state.states if path]:
+                self._state.path = path
+                self.close()
+                del self._state.states[path]
+        finally:
+            self._state.path = previous
+
+    def _connect(self):
+        if not self._state.path:
+            conn = super()._connect()
+            _load_price_blocks(conn)
+            return conn
+        conn = sqlite3.connect(self._state.path, timeout=self._timeout, isolation_level=None, **self.connect_params)
+        try:
+            conn.execute("ATTACH DATABASE ? AS ref", (self.database,))
+            self._add_conn_hooks(conn)
+        except Exception:  # pragma: no cover
+            conn.close()
+            raise
+        return conn
+
+    def _get_pending(self):
+        return self._state.pending.setdefault(self._state.path, [])
+
+    def run_after_commit(self, callback):
+        """Call `callback` once the calling thread's transaction commits, or now outside of one. Rolled back writes drop it."""
+        if self.in_transaction():
+            self._get_pending().append(callback)
+        else:
+            callback()
+
+    def commit(self):
+        super().commit()
+        pending = self._get_pending()
+        callbacks, pending[:] = list(pending), []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        super().rollback()
+        del self._get_pending()[:]
+        _notify_rollback()
+
+    def savepoint(self):
+        return _Savepoint(self)
+
+
+class _Savepoint(_savepoint):
+    def _begin(self):
+        super()._begin()
+        # Callbacks queued before the savepoint survive its rollback
+        self._pending = len(self.db._get_pending())
+
+    def rollback(self, begin=True):
+        del self.db._get_pending()[self._pending :]
+        super().rollback(begin)
+        _notify_rollback()
+
+
+db = RoutedSqliteDatabase(None, pragmas={"foreign_keys": 1})
 
 
 def open_db(path):
-    log.debug(f"Initializing database at {path}.")
+    log.debug("Initializing database at %s.", path)
     # Extract the directory portion of the path
     directory = os.path.dirname(path)
     # Create directories if they are missing
     if directory:  # Avoid creating root directory if path is just a file name
         os.makedirs(directory, exist_ok=True)
     db.init(path)
+    _attach_partitions()
+    for listener in _open_listeners:
+        listener()
     return db
 
 
+def _load_price_blocks(conn):
+    # Packed bars are read through alfa.blocks' price history store, imported only for databases holding blocks
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'price_block'").fetchone():
+        if conn.execute("SELECT 1 FROM price_block LIMIT 1").fetchone():
+            # Imported here as alfa.blocks depends on this module
+            importlib.import_module("alfa.blocks")
+
+
+def _attach_partitions():
+    # Imported here as alfa.partitions depends on this module
+    from alfa.partitions import attach_partitions
+
+    attach_partitions()
+
+
+# Callbacks invoked with no arguments after a database is opened, so process-local caches can be dropped.
+_open_listeners = []
+
+
+def add_open_listener(listener):
+    if listener not in _open_listeners:
+        _open_listeners.append(listener)
+
+
+# Callbacks invoked with no arguments after a transaction or savepoint is rolled back, so cached rows can be dropped.
+_rollback_listeners = []
+
+
+def add_rollback_listener(listener):
+    if listener not in _rollback_listeners:
+        _rollback_listeners.append(listener)
+
+
+def _notify_rollback():
+    for listener in _rollback_listeners:
+        listener()
+
+
+# Symbol -> (stock id, name), stock id -> symbol and (stock id, interval, exchange, day start, day end) -> latest Price of the day
+_symbol_cache = get_cache("symbol", 4096)
+_stock_symbol_cache = get_cache("stock_symbol", 4096)
+_price_cache = get_cache("price", 16384)
+add_open_listener(clear_caches)
+add_rollback_listener(clear_caches)
+
+
 class BaseModel(Model):
+    # CREATE TRIGGER IF NOT EXISTS statements run after the model's table is created
+    triggers = ()
+    # Reference data shared by every portfolio, kept in the opened database when portfolios are sharded
+    reference = False
+
     class Meta:
         database = db
 
     @staticmethod
     def get_models():
+        # Every database has the tables of every module, whichever of them this process imported
+        for module in SCHEMA_VERSIONS:
+            importlib.import_module(module)
         return BaseModel.__subclasses__()
 
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        super().create_table(safe=safe, **options)
+        for trigger in cls.triggers:
+            cls._meta.database.execute_sql(trigger)
+
+
+# Module defining tables -> version of its schema. Bump a module's version when it adds a table, index or trigger, so
+# that `ensure_schema` creates it in existing databases. Existing tables, indexes and triggers are never altered.
+SCHEMA_VERSIONS = {
+    "alfa.audit": 1,
+    "alfa.blocks": 1,
+    "alfa.db": 1,
+    "alfa.fx": 1,
+    "alfa.indicators": 1,
+    "alfa.lots": 1,
+    "alfa.orders": 1,
+    "alfa.partitions": 1,
+}
+
+
+def get_schema_version():
+    """Fingerprint of the schemas of every module, stored in the database's user_version once they are applied."""
+    key = ",".join(f"{module}={version}" for module, version in sorted(SCHEMA_VERSIONS.items()))
+    return zlib.crc32(key.encode()) & 0x7FFFFFFF
+
+
+def ensure_schema():
+    """Create the missing tables, indexes and triggers of the models, unless the database's user_version shows the
+    current schemas were already applied. Existing ones are left as they are. Returns whether the DDL ran.
+    """
+    version = get_schema_version()
+    if db.user_version == version:
+        return False
+    try:
+        with db.atomic():
+            db.create_tables(BaseModel.get_models())
+            db.user_version = version
+        log.debug("Applied schema version %s to %s.", version, db.route or db.database)
+        return True
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to apply schema version {version}: {type(e).__name__} : {e}")
+        raise e
+
 
 class IntervalType(Enum):
     DAY = "DAY"
@@ -47,40 +271,197 @@ def strtimestamp(timestamp):
     return dt.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
 
 
-def get_eod_timestamp(day):
+class _LazyTimestamp:
+    # Log argument formatting a timestamp only when the message is emitted
+    __slots__ = ("timestamp",)
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+
+    def __str__(self):
+        return strtimestamp(self.timestamp)
+
+
+# Callbacks invoked as listener(stock, first_timestamp, last_timestamp) after prices are written.
+_price_listeners = []
+
+
+def add_price_listener(listener):
+    if listener not in _price_listeners:
+        _price_listeners.append(listener)
+
+
+def remove_price_listener(listener):
+    if listener in _price_listeners:
+        _price_listeners.remove(listener)
+
+
+def _get_indicator_listener():
+    # Imported here as alfa.indicators depends on this module
+    from alfa.indicators import on_prices_added
+
+    return on_prices_added
+
+
+def _notify_prices_added(stock, first_timestamp, last_timestamp):
+    # Tracked indicators are recomputed from revised bars whether or not this process imported alfa.indicators
+    _get_indicator_listener()(stock, first_timestamp, last_timestamp)
+    for listener in _price_listeners:
+        listener(stock, first_timestamp, last_timestamp)
+    if feed.active:
+        _publish(EventType.PRICE, None, stock.symbol, last_timestamp, first_timestamp=first_timestamp, last_timestamp=last_timestamp)
+
+
+# Additional storage of Price, Balance and Position history, consulted by reads "as of" a timestamp. Each store is called
+# as store(keys, from_timestamp, to_timestamp), with keys such as {"stock": stock}, and returns the most recent row between
+# the timestamps, or None. Stores are only asked for rows more recent than the one found in the model's own table.
+_history_stores = {}
+
+
+def add_history_store(model, store):
+    stores = _history_stores.setdefault(model, [])
+    if store not in stores:
+        stores.append(store)
+
+
+def remove_history_store(model, store):
+    if store in _history_stores.get(model, ()):
+        _history_stores[model].remove(store)
+
+
+def _get_latest_stored(model, keys, row, from_timestamp, to_timestamp):
+    for store in _history_stores.get(model, ()):
+        stored = store(keys, row.timestamp + 1 if row else from_timestamp, to_timestamp)
+        if stored and (not row or stored.timestamp > row.timestamp):
+            row = stored
+    return row
+
+
+# Tables holding more of the Price, Balance and Position history, consulted by reads scanning that history. Each source
+# is called as source(from_timestamp, to_timestamp) and returns models, with the fields of the history model, bound to
+# the tables that may hold rows between the timestamps.
+_history_sources = {}
+
+
+def add_history_source(model, source):
+    sources = _history_sources.setdefault(model, [])
+    if source not in sources:
+        sources.append(source)
+
+
+def remove_history_source(model, source):
+    if source in _history_sources.get(model, ()):
+        _history_sources[model].remove(source)
+
+
+def get_history_models(model, from_timestamp=None, to_timestamp=None):
+    """The model followed by the models of every other table holding its history between the timestamps."""
+    models = [model]
+    for source in _history_sources.get(model, ()):
+        models.extend(source(from_timestamp, to_timestamp))
+    return models
+
+
+# Callbacks invoked as listener(transaction) for each TransactionLedger row, inside the database transaction writing it.
+_transaction_listeners = []
+
+
+def add_transaction_listener(listener):
+    if listener not in _transaction_listeners:
+        _transaction_listeners.append(listener)
+
+
+def remove_transaction_listener(listener):
+    if listener in _transaction_listeners:
+        _transaction_listeners.remove(listener)
+
+
+def _get_lot_engine():
+    # Imported here as alfa.lots depends on this module
+    from alfa.lots import engine
+
+    return engine
+
+
+def _notify_transaction(transaction):
+    _get_lot_engine().on_transaction(transaction)
+    for listener in _transaction_listeners:
+        listener(transaction)
+    if feed.active:
+        _publish(
+            EventType.TRANSACTION,
+            transaction.account_id,
+            _get_symbol(transaction.stock_id),
+            transaction.timestamp,
+            external_id=transaction.external_id,
+            type=transaction.type,
+            quantity=transaction.quantity,
+            price=transaction.price,
+            fees=transaction.fees,
+        )
+
+
+def _publish(event_type, account_id, symbol, timestamp, **data):
+    # Published to alfa.feed subscribers once the transaction writing the change commits
+    db.run_after_commit(partial(feed.publish, Event(event_type, db.route, account_id, symbol, timestamp, data)))
+
+
+def get_eod_timestamp(day, exchange=None):
+    """Close of the exchange's session on `day`, or of its last session before `day`. Defaults to today."""
+    calendar = get_calendar(exchange)
     if not day:
-        day = datetime.now().date()
-    return int(datetime.combine(day, time.max).timestamp() * 1000)
+        day = calendar.today()
+    return calendar.get_eod_timestamp(day)
 
 
 class Stock(BaseModel):
+    reference = True
+
     id = IntegerField(primary_key=True)
     symbol = TextField(unique=True)
     name = TextField(null=True)
 
-    def get_price(self, to_timestamp=None, interval_type=IntervalType.DAY.value):
-        def _get_from_for_to(to_timestamp, interval_type):
+    def get_price(self, to_timestamp=None, interval_type=IntervalType.DAY.value, exchange=None):
+        def _get_day_for_to(to_timestamp, interval_type):
             if interval_type == IntervalType.DAY.value:
-                # Convert milliseconds to seconds
-                to_timestamp = to_timestamp / 1000
-                # Convert to datetime object
-                day = datetime.fromtimestamp(to_timestamp).date()
-                from_timestamp = int(datetime.combine(day, time.min).timestamp() * 1000)
-                return from_timestamp
+                # Start of the exchange's trading day containing to_timestamp, and of the next one
+                calendar = get_calendar(exchange)
+                i = calendar.get_session_day(to_timestamp)
+                from_timestamp = calendar.day_starts[i]
+                return from_timestamp, calendar.day_starts[i + 1] if i + 1 < len(calendar) else from_timestamp + 86_400_000
             raise ValueError("Not implemented. {interval_type}.")
 
-        try:
+        def _get_latest(from_timestamp, to_timestamp):
             where_clause = True
-            from_and_to_str = "Without from and to constraints."
             if to_timestamp:
-                from_timestamp = _get_from_for_to(to_timestamp, interval_type)
                 where_clause = (Price.timestamp >= from_timestamp) & (Price.timestamp <= to_timestamp)
-                from_and_to_str = f"From {strtimestamp(from_timestamp)} to {strtimestamp(to_timestamp)}."
             price = self.prices.where(where_clause).order_by(Price.timestamp.desc()).first()
+            return _get_latest_stored(Price, {"stock": self}, price, from_timestamp, to_timestamp)
+
+        try:
+            from_timestamp = next_from_timestamp = None
+            if to_timestamp:
+                from_timestamp, next_from_timestamp = _get_day_for_to(to_timestamp, interval_type)
+
+            # The cache holds the latest price of the whole day, which answers any to_timestamp at or after it
+            key = (self.id, interval_type, exchange and Exchange(exchange).value, from_timestamp, next_from_timestamp)
+            price = _price_cache.get(key)
+            if price is MISSING:
+                price = _get_latest(from_timestamp, next_from_timestamp - 1 if to_timestamp else None)
+                _price_cache.put(key, price)
+            if price and to_timestamp and price.timestamp > to_timestamp:
+                price = _get_latest(from_timestamp, to_timestamp)
             if price:
-                log.debug(f"{self.symbol}'s most recent price is from {strtimestamp(price.timestamp)}. {price.adjusted_close:.2f}, {from_and_to_str}")
+                log.debug(
+                    "%s's most recent price is from %s. %.2f, from %s to %s.",
+                    self.symbol,
+                    _LazyTimestamp(price.timestamp),
+                    price.adjusted_close,
+                    _LazyTimestamp(from_timestamp),
+                    _LazyTimestamp(to_timestamp),
+                )
             else:
-                log.debug(f"{self.symbol} has no prices. {from_and_to_str}")
+                log.debug("%s has no prices from %s to %s.", self.symbol, _LazyTimestamp(from_timestamp), _LazyTimestamp(to_timestamp))
             return price
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to get the price for {self.symbol}: {type(e).__name__} : {e}")
@@ -91,7 +472,7 @@ class Stock(BaseModel):
             if volume < 0:
                 raise ValueError("Volume cannot be negative.")
 
-            log.debug(f"Adding price for {self.symbol} on {strtimestamp(timestamp)}.")
+            log.debug("Adding price for %s on %s.", self.symbol, _LazyTimestamp(timestamp))
 
             # TODO: switch to get_or_create
             price = Price.create(
@@ -105,18 +486,83 @@ class Stock(BaseModel):
                 adjusted_close=adjusted_close,
                 volume=volume,
             )
-            log.debug(f"Added price for {self.symbol} on {strtimestamp(timestamp)} successfully.")
+            log.debug("Added price for %s on %s successfully.", self.symbol, _LazyTimestamp(timestamp))
+            _notify_prices_added(self, timestamp, timestamp)
             return price
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to add price for {self.symbol}: {type(e).__name__} : {e}")
             raise e
 
-    def get_eod_price(self, day=None):
-        to_timestamp = get_eod_timestamp(day)
-        return self.get_price(to_timestamp, IntervalType.DAY.value)
+    def add_prices(self, bars, batch_size=500, action=None, rules=None):
+        """Bulk load bars given as (timestamp, open, high, low, close, adjusted_close, volume) tuples.
+
+        Bars already stored for the same timestamp are replaced, which is how revised history is loaded.
+        The batch is validated first, see `alfa.validation`; depending on `action`, a ValidationAction defaulting to WARN,
+        invalid bars are only logged, fail the whole load, or are repaired or set aside in PriceQuarantine.
+        Returns the number of bars loaded.
+        """
+        # Imported here as only loading prices validates them
+        from alfa.validation import Check, ValidationAction, as_price_array, describe, get_reasons, repair_prices, validate_prices
+
+        try:
+            action = ValidationAction(action or ValidationAction.WARN)
+            array = as_price_array(bars)
+            if not len(array):
+                return 0
+            report = validate_prices(self.symbol, array, rules)
+            quarantined = array[:0]
+            if report.violations:
+                log.warning("Invalid prices for %s: %s.", self.symbol, describe(report))
+                if action == ValidationAction.REJECT:
+                    raise ValueError(f"Invalid prices for {self.symbol}: {describe(report)}.")
+                if action == ValidationAction.WARN:
+                    # Bars that cannot be stored
+                    if Check.NEGATIVE_VOLUME in report.violations:
+                        raise ValueError("Volume cannot be negative.")
+                    if Check.INVALID_TIMESTAMP in report.violations:
+                        raise ValueError("Timestamp must be a non-negative number.")
+                else:
+                    reasons = get_reasons(report)
+                    invalid = report.invalid
+                    if action == ValidationAction.REPAIR:
+                        array, invalid, rows = repair_prices(array, report)
+                        reasons = reasons[rows]
+                    quarantined, reasons, array = array[invalid], reasons[invalid], array[~invalid]
+
+            fields = ("timestamp", "open", "high", "low", "close", "adjusted_close", "volume")
+            rows = [
+                dict(zip(fields, (int(timestamp), *prices, int(volume)), strict=True), stock=self.id, symbol=self.symbol)
+                for timestamp, *prices, volume in array.tolist()
+            ]
+
+            log.debug("Adding %s prices for %s.", len(rows), self.symbol)
+
+            with db.atomic():
+                if len(quarantined):
+                    _quarantine(self, quarantined, reasons)
+                for i in range(0, len(rows), batch_size):
+                    Price.insert_many(rows[i : i + batch_size]).on_conflict_replace().execute()
+            if not rows:
+                return 0
+
+            timestamps = [row["timestamp"] for row in rows]
+            log.debug(
+                "Added %s prices for %s from %s to %s.", len(rows), self.symbol, _LazyTimestamp(min(timestamps)), _LazyTimestamp(max(timestamps))
+            )
+            _notify_prices_added(self, min(timestamps), max(timestamps))
+            return len(rows)
+        except Exception as e:  # pragma: no cover
+            log.error(f"Failed to add prices for {self.symbol}: {type(e).__name__} : {e}")
+            raise e
+
+    def get_eod_price(self, day=None, exchange=None):
+        to_timestamp = get_eod_timestamp(day, exchange)
+        return self.get_price(to_timestamp, IntervalType.DAY.value, exchange)
 
 
 class Price(BaseModel):
+    reference = True
+
     id = IntegerField(primary_key=True)
     stock = ForeignKeyField(Stock, backref="prices", on_delete="CASCADE")
     symbol = TextField()
@@ -133,11 +579,50 @@ class Price(BaseModel):
         indexes = ((("stock", "timestamp"), True),)  # Unique constraint on stock and timestamp
 
 
+class PriceQuarantine(BaseModel):
+    """Bars set aside by `Stock.add_prices` for failing validation."""
+
+    reference = True
+
+    id = IntegerField(primary_key=True)
+    stock = ForeignKeyField(Stock, backref="quarantined_prices", on_delete="CASCADE")
+    timestamp = BigIntegerField(null=True)  # Unix epoch time, non-finite values are stored as null as for prices
+    open = FloatField(null=True)
+    high = FloatField(null=True)
+    low = FloatField(null=True)
+    close = FloatField(null=True)
+    adjusted_close = FloatField(null=True)
+    volume = FloatField(null=True)
+    reasons = TextField()
+    quarantined_at = BigIntegerField()  # Unix epoch time
+
+    class Meta:
+        table_name = "price_quarantine"
+        indexes = ((("stock", "timestamp"), False),)
+
+
+def _quarantine(stock, bars, reasons, batch_size=500):
+    quarantined_at = int(datetime.now().timestamp() * 1000)
+    fields = ("timestamp", "open", "high", "low", "close", "adjusted_close", "volume")
+    rows = [
+        dict(zip(fields, [value if math.isfinite(value) else None for value in bar], strict=True))
+        | {"stock": stock.id, "reasons": reason, "quarantined_at": quarantined_at}
+        for bar, reason in zip(bars.tolist(), reasons, strict=True)
+    ]
+    for i in range(0, len(rows), batch_size):
+        PriceQuarantine.insert_many(rows[i : i + batch_size]).execute()
+    log.debug("Quarantined %s prices for %s.", len(rows), stock.symbol)
+
+
 class CurrencyType(Enum):
     CAD = "CAD"
     USD = "USD"
 
 
+# Exchange whose calendar closes the trading day of accounts in each currency
+CURRENCY_EXCHANGES = {CurrencyType.CAD.value: Exchange.TSX, CurrencyType.USD.value: Exchange.NYSE}
+
+
 class TransactionType(str, Enum):
     BUY = "BUY"
     DEPOSIT = "DEPOSIT"
@@ -146,6 +631,33 @@ class TransactionType(str, Enum):
     WITHDRAW = "WITHDRAW"
 
 
+def _get_stock(symbol):
+    """Stock with the validated `symbol`, or None, resolved through the symbol cache."""
+    cached = _symbol_cache.get(symbol)
+    if cached is MISSING:
+        stock = Stock.get_or_none(Stock.symbol == symbol)
+        if stock:
+            _symbol_cache.put(symbol, (stock.id, stock.name))
+        return stock
+    return Stock(id=cached[0], symbol=symbol, name=cached[1])
+
+
+def _get_symbol(stock_id):
+    symbol = _stock_symbol_cache.get(stock_id)
+    if symbol is MISSING:
+        symbol = Stock.select(Stock.symbol).where(Stock.id == stock_id).scalar()
+        _stock_symbol_cache.put(stock_id, symbol)
+    return symbol
+
+
+def _invalidate_prices(stock, first_timestamp, last_timestamp):
+    # Drop the latest price and the days overlapping the prices added
+    _price_cache.discard_where(lambda key: key[0] == stock.id and (key[3] is None or (key[3] <= last_timestamp and key[4] > first_timestamp)))
+
+
+add_price_listener(_invalidate_prices)
+
+
 def _as_validated_symbol(symbol):
     if not isinstance(symbol, str) or not symbol.strip():
         raise ValueError("Symbol must be a non-empty string.")
@@ -161,7 +673,7 @@ class Portfolio(BaseModel):
         try:
             portfolio, created = Portfolio.get_or_create(name=name)
             if created:
-                log.debug(f"Created portfolio {name}.")
+                log.debug("Created portfolio %s.", name)
             return portfolio
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to add portfolio {name}: {type(e).__name__} : {e}")
@@ -191,14 +703,14 @@ class Portfolio(BaseModel):
 
             stock, created = Stock.get_or_create(symbol=symbol, defaults={"name": name})
             if created:
-                log.debug(f"Portfolio {self.name} added new stock {symbol}.")
+                log.debug("Portfolio %s added new stock %s.", self.name, symbol)
 
             if self.is_watching(symbol):
-                log.debug(f"Portfolio {self.name} is already watching {symbol}.")
+                log.debug("Portfolio %s is already watching %s.", self.name, symbol)
                 return stock
 
             StockToWatch.create(stock=stock, portfolio=self)
-            log.debug(f"Portfolio {self.name} started watching {symbol}.")
+            log.debug("Portfolio %s started watching %s.", self.name, symbol)
 
             return stock
         except Exception as e:  # pragma: no cover
@@ -210,25 +722,75 @@ class Portfolio(BaseModel):
             symbol = _as_validated_symbol(symbol)
 
             if not self.is_watching(symbol):
-                log.debug(f"Portfolio {self.name} is not watching {symbol}.")
+                log.debug("Portfolio %s is not watching %s.", self.name, symbol)
                 return
 
             for a in self.get_accounts():
                 position = a.get_position(symbol)
                 if position:
-                    log.debug(f"Cannot remove {symbol} from watchlist in portfolio {self.name} due to active position in account {a.name}.")
+                    log.debug("Cannot remove %s from watchlist in portfolio %s due to active position in account %s.", symbol, self.name, a.name)
                     return
 
-            stock = Stock.get_or_none(Stock.symbol == symbol)
+            stock = _get_stock(symbol)
             rows_deleted = StockToWatch.delete().where((StockToWatch.stock == stock) & (StockToWatch.portfolio == self)).execute()
             if rows_deleted > 0:
-                log.debug(f"Removed {symbol} from watchlist in portfolio {self.name}.")
+                log.debug("Removed %s from watchlist in portfolio %s.", symbol, self.name)
             else:  # pragma: no cover
-                log.debug(f"No watchlist entry found for {symbol} in portfolio {self.name}.")
+                log.debug("No watchlist entry found for %s in portfolio %s.", symbol, self.name)
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to remove {symbol} from watchlist in portfolio {self.name}: {type(e).__name__} : {e}")
             raise e
 
+    def sync_watchlist(self, symbols, batch_size=500):
+        """Make the watchlist match `symbols`, except for symbols still held in any of the portfolio's accounts.
+
+        Returns the (added, removed) symbols.
+        """
+        try:
+            symbols = {_as_validated_symbol(symbol) for symbol in symbols}
+            log.debug("Syncing watchlist in portfolio %s to %s symbols.", self.name, len(symbols))
+
+            with db.atomic():
+                watching = dict(StockToWatch.select(Stock.symbol, StockToWatch.id).join(Stock).where(StockToWatch.portfolio == self).tuples())
+                added = sorted(symbols - watching.keys())
+                removed = watching.keys() - symbols
+
+                if added:
+                    stocks = dict(Stock.select(Stock.symbol, Stock.id).where(Stock.symbol.in_(added)).tuples())
+                    missing = [{"symbol": symbol} for symbol in added if symbol not in stocks]
+                    for i in range(0, len(missing), batch_size):
+                        Stock.insert_many(missing[i : i + batch_size]).execute()
+                    if missing:
+                        log.debug("Portfolio %s added %s new stocks.", self.name, len(missing))
+                        stocks = dict(Stock.select(Stock.symbol, Stock.id).where(Stock.symbol.in_(added)).tuples())
+                    rows = [{"portfolio": self.id, "stock": stocks[symbol]} for symbol in added]
+                    for i in range(0, len(rows), batch_size):
+                        StockToWatch.insert_many(rows[i : i + batch_size]).execute()
+
+                if removed:
+                    query = (
+                        CurrentPosition.select(Stock.symbol)
+                        .join(Stock)
+                        .switch(CurrentPosition)
+                        .join(Account)
+                        .where((Account.portfolio == self) & (CurrentPosition.size > 0) & Stock.symbol.in_(list(removed)))
+                        .distinct()
+                        .tuples()
+                    )
+                    held = {symbol for (symbol,) in query}
+                    if held:
+                        log.debug("Portfolio %s keeps watching %s symbols with active positions.", self.name, len(held))
+                    removed = sorted(removed - held)
+                    ids = [watching[symbol] for symbol in removed]
+                    for i in range(0, len(ids), batch_size):
+                        StockToWatch.delete().where(StockToWatch.id.in_(ids[i : i + batch_size])).execute()
+
+            log.debug("Synced watchlist in portfolio %s: added %s and removed %s symbols.", self.name, len(added), len(removed))
+            return added, sorted(removed)
+        except Exception as e:  # pragma: no cover
+            log.error(f"Failed to sync watchlist in portfolio {self.name}: {type(e).__name__} : {e}")
+            raise e
+
     def get_watchlist(self):
         try:
             return list(Stock.select().join(StockToWatch).where(StockToWatch.portfolio == self))
@@ -240,7 +802,7 @@ class Portfolio(BaseModel):
         try:
             # TODO: validate inputs
 
-            log.debug(f"Adding account {name} in {currency} to portfolio {self.name}.")
+            log.debug("Adding account %s in %s to portfolio %s.", name, currency, self.name)
 
             # TODO: switch to get_or_create
             account = Account.create(
@@ -248,7 +810,7 @@ class Portfolio(BaseModel):
                 name=name,
                 currency=currency.value,
             )
-            log.debug(f"Adding account {name} to portfolio {self.name}.")
+            log.debug("Adding account %s to portfolio %s.", name, self.name)
             return account
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to add account {name}: {type(e).__name__} : {e}")
@@ -257,6 +819,13 @@ class Portfolio(BaseModel):
     def get_accounts(self):
         return self.accounts
 
+    def rebalance(self, targets, as_of, constraints=None, dry_run=False):
+        """Trade every account to the `targets` symbol weights at `as_of`, see `alfa.rebalance.rebalance`."""
+        # Imported here as alfa.rebalance depends on this module
+        from alfa.rebalance import rebalance
+
+        return rebalance(self, targets, as_of, constraints, dry_run)
+
     def get_account(self, name, currency):
         try:
             # TODO: validate inputs
@@ -279,6 +848,13 @@ class StockToWatch(BaseModel):
         indexes = ((("portfolio", "stock"), True),)  # Unique constraint on portfolio and stock
 
 
+# Fields of the account operations traced by `tracer`
+tracer.register("balance", "timestamp", "amount", "cash")
+tracer.register("position", "timestamp", "symbol", "quantity", "price", "size", "average_price")
+tracer.register("cash", "external_id", "timestamp", "type", "amount", "fees")
+tracer.register("transaction", "external_id", "timestamp", "type", "symbol", "quantity", "price", "fees")
+
+
 class Account(BaseModel):
     id = IntegerField(primary_key=True)
     portfolio = ForeignKeyField(Portfolio, backref="accounts", on_delete="CASCADE")
@@ -294,17 +870,26 @@ class Account(BaseModel):
             ),
         )  # Unique constraint on portfolio, name, and currency
 
+    @property
+    def exchange(self):
+        return CURRENCY_EXCHANGES[self.currency]
+
+    def get_trace(self):
+        """Operations traced for the account while `alfa.trace.tracer` is enabled, oldest first."""
+        return tracer.dump((db.route, self.id))
+
     def get_cash(self, to_timestamp=None):
         try:
-            where_clause = True
             if to_timestamp:
-                where_clause = Balance.timestamp <= to_timestamp
-            balance = self.balances.where(where_clause).order_by(Balance.timestamp.desc()).first()
+                balance = self.balances.where(Balance.timestamp <= to_timestamp).order_by(Balance.timestamp.desc()).first()
+                balance = _get_latest_stored(Balance, {"account": self}, balance, None, to_timestamp)
+            else:
+                balance = CurrentBalance.get_or_none(CurrentBalance.account == self)
             if balance:
-                log.debug(f"Account {self.name}'s most recent cash balance is from {strtimestamp(balance.timestamp)}. Cash: {balance.cash:.2f}.")
+                log.debug("Account %s's most recent cash balance is from %s. Cash: %.2f.", self.name, _LazyTimestamp(balance.timestamp), balance.cash)
                 return balance.cash
 
-            log.debug(f"Account {self.name} has no balances.")
+            log.debug("Account %s has no balances.", self.name)
             return 0.0
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to get cash balance for account {self.name}: {type(e).__name__} : {e}")
@@ -312,16 +897,21 @@ class Account(BaseModel):
 
     def update_balance(self, timestamp, amount):
         try:
-            log.debug(f"Updating cash balance in account {self.name} at {strtimestamp(timestamp)} with {amount}.")
+            log.debug("Updating cash balance in account %s at %s with %s.", self.name, _LazyTimestamp(timestamp), amount)
 
             current_balance = self.get_cash()
             new_balance = current_balance + amount
             if new_balance < 0:
                 raise ValueError(f"Insufficient funds in account {self.name} to update by {amount:.2f} amount.")
 
-            Balance.create(account=self, timestamp=timestamp, cash=new_balance)
+            # Several updates at the same timestamp collapse into the last balance
+            Balance.replace(account=self, timestamp=timestamp, cash=new_balance).execute()
+            if feed.active:
+                _publish(EventType.BALANCE, self.id, None, timestamp, cash=new_balance)
+            if tracer.enabled:
+                tracer.record((db.route, self.id), "balance", timestamp, amount, new_balance)
 
-            log.debug(f"Updated cash balance in account {self.name}: Previous Balance={current_balance:.2f}. New Balance={new_balance:.2f}")
+            log.debug("Updated cash balance in account %s: Previous Balance=%.2f. New Balance=%.2f", self.name, current_balance, new_balance)
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to update cash balance in account {self.name}: {type(e).__name__} : {e}")
             raise e
@@ -329,36 +919,44 @@ class Account(BaseModel):
     def get_position(self, symbol, to_timestamp=None):
         try:
             symbol = _as_validated_symbol(symbol)
-            stock = Stock.get_or_none(Stock.symbol == symbol)
+            stock = _get_stock(symbol)
             if not stock:
-                log.debug(f"Stock {symbol} does not exist in the database.")
+                log.debug("Stock %s does not exist in the database.", symbol)
                 return None
-            where_clause = Position.stock == stock
             if to_timestamp:
-                where_clause &= Position.timestamp <= to_timestamp
-            position = self.positions.where(where_clause).order_by(Position.timestamp.desc()).first()
+                where_clause = (Position.stock == stock) & (Position.timestamp <= to_timestamp)
+                position = self.positions.where(where_clause).order_by(Position.timestamp.desc()).first()
+                position = _get_latest_stored(Position, {"account": self, "stock": stock}, position, None, to_timestamp)
+            else:
+                current = CurrentPosition.get_or_none((CurrentPosition.account == self) & (CurrentPosition.stock == stock))
+                position = current.as_position() if current else None
             if position:
                 # Fetch the latest price up to the specified timestamp
                 latest_price = stock.get_price(to_timestamp)
                 if latest_price:
                     position.market_price = latest_price.adjusted_close
                     log.debug(
-                        f"Updated market price for {symbol} to {position.market_price:.2f} "
-                        f"based on price from {strtimestamp(latest_price.timestamp)}."
+                        "Updated market price for %s to %.2f based on price from %s.",
+                        symbol,
+                        position.market_price,
+                        _LazyTimestamp(latest_price.timestamp),
                     )
                 else:
                     # Handle the case where no price is available
-                    log.debug(f"No available market price for {symbol}.")
+                    log.debug("No available market price for %s.", symbol)
 
                 log.debug(
-                    f"Account {self.name}'s most recent {symbol} position is from {strtimestamp(position.timestamp)}."
-                    f"Size:{position.size}. "
-                    f"Average Price:{position.average_price:.2f}. "
-                    f"Market Price:{position.market_price:.2f}"
+                    "Account %s's most recent %s position is from %s.Size:%s. Average Price:%.2f. Market Price:%.2f",
+                    self.name,
+                    symbol,
+                    _LazyTimestamp(position.timestamp),
+                    position.size,
+                    position.average_price,
+                    position.market_price,
                 )
                 if position.size > 0.0:
                     return position
-            log.debug(f"Account {self.name} has no position in {symbol}.")
+            log.debug("Account %s has no position in %s.", self.name, symbol)
             return None
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to get position for {symbol} in account {self.name}: {type(e).__name__} : {e}")
@@ -367,11 +965,13 @@ class Account(BaseModel):
     def update_position(self, timestamp, symbol, quantity, price):
         try:
             symbol = _as_validated_symbol(symbol)
-            stock = Stock.get_or_none(Stock.symbol == symbol)
+            stock = _get_stock(symbol)
             if not stock:
                 raise ValueError(f"Stock {symbol} does not exist in the database.")
 
-            log.debug(f"Updating account {self.name}'s {symbol} position at {strtimestamp(timestamp)} with {quantity} shares at {price:.2f} each.")
+            log.debug(
+                "Updating account %s's %s position at %s with %s shares at %.2f each.", self.name, symbol, _LazyTimestamp(timestamp), quantity, price
+            )
 
             position = self.get_position(symbol)
 
@@ -383,7 +983,7 @@ class Account(BaseModel):
                 raise ValueError(f"Cannot remove {abs(quantity)} shares from {symbol}; only {current_size} available.")
 
             if new_size == 0:
-                log.debug(f"Liquidating position for {symbol} in account {self.name}.")
+                log.debug("Liquidating position for %s in account %s.", symbol, self.name)
                 new_average_price = 0.0
                 new_market_price = 0.0
             else:
@@ -393,7 +993,8 @@ class Account(BaseModel):
                     total_cost = (current_average_price * current_size) + (price * quantity)
                     new_average_price = total_cost / new_size
 
-            new_position = Position.create(
+            # Several updates at the same timestamp collapse into the last position
+            new_position = Position(
                 account=self,
                 stock=stock,
                 timestamp=timestamp,
@@ -401,11 +1002,21 @@ class Account(BaseModel):
                 average_price=new_average_price,
                 market_price=new_market_price,
             )
+            new_position.id = Position.replace(**new_position.__data__).execute()
+            if feed.active:
+                _publish(
+                    EventType.POSITION, self.id, symbol, timestamp, size=new_size, average_price=new_average_price, market_price=new_market_price
+                )
+            if tracer.enabled:
+                tracer.record((db.route, self.id), "position", timestamp, symbol, quantity, price, new_size, new_average_price)
 
             log.debug(
-                f"Updated account {self.name}'s {symbol} position: "
-                f"Size={new_position.size}, Average Price={new_position.average_price:.2f}. "
-                f"Market Price={new_position.market_price:.2f}."
+                "Updated account %s's %s position: Size=%s, Average Price=%.2f. Market Price=%.2f.",
+                self.name,
+                symbol,
+                new_position.size,
+                new_position.average_price,
+                new_position.market_price,
             )
 
             return new_position
@@ -423,11 +1034,17 @@ class Account(BaseModel):
             type=type,
             fees=fees,
         )
+        if tracer.enabled:
+            tracer.record((db.route, self.id), "cash", external_id, timestamp, type, amount, fees)
+        if feed.active:
+            _publish(EventType.CASH, self.id, None, timestamp, external_id=external_id, type=type, amount=amount, fees=fees)
 
     def update_transaction_ledger(self, external_id, timestamp, type, symbol, fees, quantity, price):
         # Record Transaction
-        stock = Stock.get(Stock.symbol == symbol)
-        TransactionLedger.create(
+        stock = _get_stock(symbol)
+        if not stock:
+            raise Stock.DoesNotExist(f"Stock {symbol} does not exist in the database.")
+        transaction = TransactionLedger.create(
             external_id=external_id,
             account=self,
             timestamp=timestamp,
@@ -437,16 +1054,19 @@ class Account(BaseModel):
             type=type,
             fees=fees,
         )
+        if tracer.enabled:
+            tracer.record((db.route, self.id), "transaction", external_id, timestamp, type, symbol, quantity, price, fees)
+        _notify_transaction(transaction)
 
     def deposit(self, external_id, timestamp, amount, fees=0.0):
         try:
-            log.info(f"Depositing {amount} into account {self.name}.")
+            log.info("Depositing %s into account %s.", amount, self.name)
             with db.atomic():
                 self.update_cash_ledger(external_id, timestamp, TransactionType.DEPOSIT.value, fees, amount)
                 total_amount_to_deposit = amount - fees
                 self.update_balance(timestamp, total_amount_to_deposit)
 
-            log.info(f"Deposited {amount} into account {self.name}.")
+            log.info("Deposited %s into account %s.", amount, self.name)
             return self
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to deposit {amount} into account {self.name}: {type(e).__name__} : {e}")
@@ -454,7 +1074,7 @@ class Account(BaseModel):
 
     def withdraw(self, external_id, timestamp, amount, fees=0.0):
         try:
-            log.info(f"Withdrawing {amount} from account {self.name}.")
+            log.info("Withdrawing %s from account %s.", amount, self.name)
 
             with db.atomic():
                 total_amount_to_withdraw = amount + fees
@@ -465,7 +1085,7 @@ class Account(BaseModel):
                 self.update_cash_ledger(external_id, timestamp, TransactionType.WITHDRAW.value, fees, amount)
                 self.update_balance(timestamp, -total_amount_to_withdraw)
 
-            log.info(f"Withdrew {amount} from account {self.name}.")
+            log.info("Withdrew %s from account %s.", amount, self.name)
             return self
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to withdraw {amount} from account {self.name}: {type(e).__name__} : {e}")
@@ -473,7 +1093,7 @@ class Account(BaseModel):
 
     def buy(self, external_id, timestamp, symbol, quantity, price, fees=0.0):
         try:
-            log.info(f"Buying {quantity} shares of {symbol} at ${price:.2f} each in account {self.name}.")
+            log.info("Buying %s shares of %s at $%.2f each in account %s.", quantity, symbol, price, self.name)
 
             symbol = _as_validated_symbol(symbol)
 
@@ -500,7 +1120,7 @@ class Account(BaseModel):
                 # Update position
                 self.update_position(timestamp, symbol, quantity, price)
 
-            log.info(f"Bought {quantity} shares of {symbol} at ${price:.2f} each. Total Cost: ${total_cost:.2f}. Fees: ${fees:.2f}.")
+            log.info("Bought %s shares of %s at $%.2f each. Total Cost: $%.2f. Fees: $%.2f.", quantity, symbol, price, total_cost, fees)
             return self
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to buy {quantity} shares of {symbol} at ${price:.2f}: {type(e).__name__} : {e}")
@@ -508,7 +1128,7 @@ class Account(BaseModel):
 
     def deposit_in_kind(self, external_id, timestamp, symbol, quantity, cost_basis_per_share, fees=0.0):
         try:
-            log.info(f"Depositing {quantity} shares of {symbol} at ${cost_basis_per_share:.2f} each in {self.name}.")
+            log.info("Depositing %s shares of %s at $%.2f each in %s.", quantity, symbol, cost_basis_per_share, self.name)
 
             symbol = _as_validated_symbol(symbol)
 
@@ -539,7 +1159,7 @@ class Account(BaseModel):
                 # Update position
                 self.update_position(timestamp, symbol, quantity, cost_basis_per_share)
 
-            log.info(f"Deposited {quantity} shares of {symbol} at ${cost_basis_per_share:.2f} each. Fees: ${fees:.2f}.")
+            log.info("Deposited %s shares of %s at $%.2f each. Fees: $%.2f.", quantity, symbol, cost_basis_per_share, fees)
             return self
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to deposit {quantity} shares of {symbol} at ${cost_basis_per_share:.2f}: {type(e).__name__} : {e}")
@@ -547,7 +1167,7 @@ class Account(BaseModel):
 
     def sell(self, external_id, timestamp, symbol, quantity, price, fees=0.0):
         try:
-            log.info(f"Selling {quantity} shares of {symbol} at ${price:.2f} each in {self.name}.")
+            log.info("Selling %s shares of %s at $%.2f each in %s.", quantity, symbol, price, self.name)
 
             symbol = _as_validated_symbol(symbol)
 
@@ -579,39 +1199,44 @@ class Account(BaseModel):
                     # Position was liquidated, stop watching
                     self.portfolio.stop_watching(symbol)
 
-            log.info(f"Sold {quantity} shares of {symbol} at ${price:.2f} each. Total Proceeds: ${total_proceeds:.2f}. Fees: ${fees:.2f}.")
+            log.info("Sold %s shares of %s at $%.2f each. Total Proceeds: $%.2f. Fees: $%.2f.", quantity, symbol, price, total_proceeds, fees)
             return self
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to sell {quantity} shares of {symbol} at ${price:.2f}: {type(e).__name__} : {e}")
             raise e
 
     def get_eod_balance(self, day=None):
-        to_timestamp = get_eod_timestamp(day)
-        day = datetime.fromtimestamp(to_timestamp / 1000).date()
+        to_timestamp = get_eod_timestamp(day, self.exchange)
+        day = get_calendar(self.exchange).get_day(to_timestamp)
 
         try:
             cash = self.get_cash(to_timestamp)
-            log.debug(f"Account {self.name}'s {day} end of day balance is {cash:.2f}.")
+            log.debug("Account %s's %s end of day balance is %.2f.", self.name, day, cash)
             return cash
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to retrieve {day} end of day balance for {self.name}: {type(e).__name__} : {e}")
             raise e
 
     def get_eod_position(self, symbol, day=None):
-        to_timestamp = get_eod_timestamp(day)
-        day = datetime.fromtimestamp(to_timestamp / 1000).date()
+        to_timestamp = get_eod_timestamp(day, self.exchange)
+        day = get_calendar(self.exchange).get_day(to_timestamp)
 
         try:
             symbol = _as_validated_symbol(symbol)
             position = self.get_position(symbol, to_timestamp)
             if position:
                 log.debug(
-                    f"Account {self.name}'s {day} end of day position for {symbol}, "
-                    f"as of {strtimestamp(position.timestamp)}, is {position.size} shares."
-                    f"Average Price: {position.average_price:.2f}. Market Price: {position.market_price:.2f}."
+                    "Account %s's %s end of day position for %s, as of %s, is %s shares.Average Price: %.2f. Market Price: %.2f.",
+                    self.name,
+                    day,
+                    symbol,
+                    _LazyTimestamp(position.timestamp),
+                    position.size,
+                    position.average_price,
+                    position.market_price,
                 )
             else:
-                log.debug(f"Account {self.name} has no {day} end of day positions for {symbol}.")
+                log.debug("Account %s has no %s end of day positions for %s.", self.name, day, symbol)
             return position
         except Exception as e:  # pragma: no cover
             log.error(f"Failed to retrieve {day} end of day position for {symbol} in account {self.name}: {type(e).__name__} : {e}")
@@ -629,7 +1254,10 @@ class CashLedger(BaseModel):
 
     class Meta:
         table_name = "cash_ledger"
-        indexes = ((("external_id",), True),)
+        indexes = (
+            (("external_id",), True),
+            (("account", "timestamp"), False),  # Account history in (timestamp, id) order
+        )
 
 
 class TransactionLedger(BaseModel):
@@ -651,7 +1279,37 @@ class TransactionLedger(BaseModel):
 
     class Meta:
         table_name = "transaction_ledger"
-        indexes = ((("external_id",), True),)
+        indexes = (
+            (("external_id",), True),
+            (("account", "timestamp"), False),  # Account history in (timestamp, id) order
+        )
+
+
+def _current_state_triggers(table, current_table, keys, values):
+    # Upsert the inserted or updated history row into the current table unless a more recent row is already there
+    columns = ", ".join(keys + values)
+    new_columns = ", ".join(f"NEW.{column}" for column in keys + values)
+    updates = ", ".join(f"{column} = excluded.{column}" for column in values)
+    return tuple(
+        f"CREATE TRIGGER IF NOT EXISTS {table}_after_{event.lower()} AFTER {event} ON {table} BEGIN "
+        f"INSERT INTO {current_table} ({columns}) VALUES ({new_columns}) "
+        f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {updates} WHERE excluded.timestamp >= {current_table}.timestamp; "
+        f"END"
+        for event in ("INSERT", "UPDATE")
+    )
+
+
+def _latest_rows_sql(table, keys):
+    # The most recent history row per key
+    partition = ", ".join(keys)
+    ranked = f"SELECT *, ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY timestamp DESC) AS row_rank FROM {table}"
+    return f"SELECT * FROM ({ranked}) WHERE row_rank = 1"
+
+
+_CURRENT_STATE_TABLES = (
+    ("balance", "current_balance", ("account_id",), ("timestamp", "cash")),
+    ("position", "current_position", ("account_id", "stock_id"), ("timestamp", "size", "average_price", "market_price")),
+)
 
 
 class Position(BaseModel):
@@ -663,9 +1321,14 @@ class Position(BaseModel):
     average_price = FloatField()
     market_price = FloatField()
 
+    triggers = _current_state_triggers(*_CURRENT_STATE_TABLES[1])
+
     class Meta:
         table_name = "position"
-        indexes = ((("account", "stock", "timestamp"), True),)  # Unique constraint on account, timestamp, and stock
+        indexes = (
+            (("account", "stock", "timestamp"), True),  # Unique constraint on account, timestamp, and stock
+            (("account", "timestamp"), False),  # Account history in (timestamp, id) order
+        )
 
 
 class Balance(BaseModel):
@@ -674,10 +1337,104 @@ class Balance(BaseModel):
     account = ForeignKeyField(Account, backref="balances", on_delete="CASCADE")
     cash = FloatField(default=0.0)
 
+    triggers = _current_state_triggers(*_CURRENT_STATE_TABLES[0])
+
     class Meta:
         table_name = "balance"
         indexes = ((("account", "timestamp"), True),)  # Unique constraint on account and timestamp
-        indexes = ((("account", "timestamp"), True),)  # Unique constraint on account and timestamp
-        indexes = ((("account", "timestamp"), True),)  # Unique constraint on account and timestamp
-        indexes = ((("account", "timestamp"), True),)  # Unique constraint on account and timestamp
-        indexes = ((("account", "timestamp"), True),)  # Unique constraint on account and timestamp
+
+
+class CurrentBalance(BaseModel):
+    """Most recent balance of each account, maintained by triggers on balance."""
+
+    account = ForeignKeyField(Account, primary_key=True, backref="current_balance", on_delete="CASCADE")
+    timestamp = BigIntegerField()  # Unix epoch time
+    cash = FloatField()
+
+    class Meta:
+        table_name = "current_balance"
+
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        created = not cls.table_exists()
+        super().create_table(safe=safe, **options)
+        if created:
+            _fill_current_state(cls._meta.table_name)
+
+
+class CurrentPosition(BaseModel):
+    """Most recent position of each account in each stock, maintained by triggers on position."""
+
+    account = ForeignKeyField(Account, backref="current_positions", on_delete="CASCADE")
+    stock = ForeignKeyField(Stock, on_delete="CASCADE")
+    timestamp = BigIntegerField()  # Unix epoch time
+    size = IntegerField()
+    average_price = FloatField()
+    market_price = FloatField()
+
+    class Meta:
+        table_name = "current_position"
+        primary_key = CompositeKey("account", "stock")
+
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        created = not cls.table_exists()
+        super().create_table(safe=safe, **options)
+        if created:
+            _fill_current_state(cls._meta.table_name)
+
+    def as_position(self):
+        return Position(
+            account=self.account_id,
+            stock=self.stock_id,
+            timestamp=self.timestamp,
+            size=self.size,
+            average_price=self.average_price,
+            market_price=self.market_price,
+        )
+
+
+def _fill_current_state(current_table):
+    # Copy the most recent history rows into a current table, e.g. one just added to a database that has history
+    for table, current, keys, values in _CURRENT_STATE_TABLES:
+        if current == current_table and db.table_exists(table):
+            columns = ", ".join(keys + values)
+            db.execute_sql(f"INSERT INTO {current_table} ({columns}) SELECT {columns} FROM ({_latest_rows_sql(table, keys)})")
+            log.debug("Filled %s from %s.", current_table, table)
+
+
+def rebuild_current_state():
+    """Repopulate current_balance and current_position from the history tables, e.g. after history rows were deleted."""
+    try:
+        with db.atomic():
+            for _, current_table, _, _ in _CURRENT_STATE_TABLES:
+                db.execute_sql(f"DELETE FROM {current_table}")
+                _fill_current_state(current_table)
+        log.info("Rebuilt current balances and positions.")
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to rebuild current balances and positions: {type(e).__name__} : {e}")
+        raise e
+
+
+def check_current_state():
+    """Return (table, key) for every current row that does not match the most recent history row, or is missing."""
+    try:
+        mismatches = []
+        for table, current_table, keys, values in _CURRENT_STATE_TABLES:
+            latest = f"({_latest_rows_sql(table, keys)})"
+            on = " AND ".join(f"l.{key} = c.{key}" for key in keys)
+            differs = " OR ".join(f"c.{value} IS NOT l.{value}" for value in values)
+            cursor = db.execute_sql(
+                f"SELECT {', '.join(f'l.{key}' for key in keys)} FROM {latest} AS l LEFT JOIN {current_table} AS c ON {on} "
+                f"WHERE c.{keys[0]} IS NULL OR {differs} "
+                f"UNION ALL "
+                f"SELECT {', '.join(f'c.{key}' for key in keys)} FROM {current_table} AS c LEFT JOIN {latest} AS l ON {on} "
+                f"WHERE l.{keys[0]} IS NULL"
+            )
+            mismatches.extend((table, key) for key in cursor.fetchall())
+        if mismatches:
+            log.warning("Found %s current balances and positions out of sync with their history.", len(mismatches))
+        return mismatches
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to check current balances and positions: {type(e).__name__} : {e}")
+        raise e
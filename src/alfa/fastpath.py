@@ -0,0 +1,77 @@
+import logging
+from collections import namedtuple
+
+from alfa.calendar import get_calendar
+from alfa.db import Balance, Position, Price, _as_validated_symbol, _get_latest_stored, _get_stock, _history_stores, db
+
+
+log = logging.getLogger("alfa")
+
+
+PriceBar = namedtuple("PriceBar", ["timestamp", "open", "high", "low", "close", "adjusted_close", "volume"])
+PositionState = namedtuple("PositionState", ["timestamp", "size", "average_price", "market_price"])
+
+# The statements are reused verbatim so sqlite3 keeps them prepared in each connection's statement cache
+_PRICE_COLUMNS = "timestamp, open, high, low, close, adjusted_close, volume"
+_LATEST_PRICE = f"SELECT {_PRICE_COLUMNS} FROM price WHERE stock_id = ? ORDER BY timestamp DESC LIMIT 1"
+_PRICE_BETWEEN = f"SELECT {_PRICE_COLUMNS} FROM price WHERE stock_id = ? AND timestamp >= ? AND timestamp <= ? ORDER BY timestamp DESC LIMIT 1"
+_CURRENT_CASH = "SELECT cash FROM current_balance WHERE account_id = ?"
+_CASH_AS_OF = "SELECT timestamp, cash FROM balance WHERE account_id = ? AND timestamp <= ? ORDER BY timestamp DESC LIMIT 1"
+_CURRENT_POSITION = "SELECT timestamp, size, average_price, market_price FROM current_position WHERE account_id = ? AND stock_id = ?"
+_POSITION_AS_OF = (
+    "SELECT timestamp, size, average_price, market_price FROM position "
+    "WHERE account_id = ? AND stock_id = ? AND timestamp <= ? ORDER BY timestamp DESC LIMIT 1"
+)
+
+
+def _fetch(sql, params):
+    return db.connection().execute(sql, params).fetchone()
+
+
+def get_price(stock, to_timestamp=None, exchange=None):
+    """Stock.get_price for daily bars, as a PriceBar."""
+    if to_timestamp:
+        from_timestamp = get_calendar(exchange).get_day_start(to_timestamp)
+        row = _fetch(_PRICE_BETWEEN, (stock.id, from_timestamp, to_timestamp))
+    else:
+        from_timestamp = None
+        row = _fetch(_LATEST_PRICE, (stock.id,))
+    price = PriceBar._make(row) if row else None
+    if _history_stores.get(Price):
+        stored = _get_latest_stored(Price, {"stock": stock}, price, from_timestamp, to_timestamp)
+        if stored is not price:
+            price = PriceBar(*(getattr(stored, field) for field in PriceBar._fields))
+    return price
+
+
+def get_cash(account, to_timestamp=None):
+    """Account.get_cash."""
+    if not to_timestamp:
+        row = _fetch(_CURRENT_CASH, (account.id,))
+        return row[0] if row else 0.0
+    row = _fetch(_CASH_AS_OF, (account.id, to_timestamp))
+    if _history_stores.get(Balance):
+        balance = Balance(timestamp=row[0], cash=row[1]) if row else None
+        balance = _get_latest_stored(Balance, {"account": account}, balance, None, to_timestamp)
+        return balance.cash if balance else 0.0
+    return row[1] if row else 0.0
+
+
+def get_position(account, symbol, to_timestamp=None):
+    """Account.get_position as a PositionState, valued at the latest adjusted close up to `to_timestamp`."""
+    stock = _get_stock(_as_validated_symbol(symbol))
+    if not stock:
+        return None
+    if to_timestamp:
+        row = _fetch(_POSITION_AS_OF, (account.id, stock.id, to_timestamp))
+        if _history_stores.get(Position):
+            position = Position(**dict(zip(PositionState._fields, row, strict=True))) if row else None
+            position = _get_latest_stored(Position, {"account": account, "stock": stock}, position, None, to_timestamp)
+            row = tuple(getattr(position, field) for field in PositionState._fields) if position else None
+    else:
+        row = _fetch(_CURRENT_POSITION, (account.id, stock.id))
+    if not row or row[1] <= 0:
+        return None
+    position = PositionState._make(row)
+    price = get_price(stock, to_timestamp)
+    return position._replace(market_price=price.adjusted_close) if price else position
@@ -0,0 +1,125 @@
+import itertools
+import threading
+from collections import OrderedDict, namedtuple
+from enum import Enum
+from time import monotonic
+
+
+class EventType(Enum):
+    CASH = "CASH"  # CashLedger entry
+    TRANSACTION = "TRANSACTION"  # TransactionLedger entry
+    BALANCE = "BALANCE"
+    POSITION = "POSITION"
+    PRICE = "PRICE"  # Bars added between data["first_timestamp"] and data["last_timestamp"]
+
+
+# Events of these types carry the latest state, so a newer one can replace a queued one for the same account and symbol
+STATE_EVENTS = frozenset((EventType.BALANCE, EventType.POSITION, EventType.PRICE))
+
+# `route` is the database file the change was written to, None for the opened database; `account` is an account id
+Event = namedtuple("Event", ["type", "route", "account", "symbol", "timestamp", "data"])
+
+
+class Subscription:
+    """Bounded queue of the committed changes matching a subscriber's filters.
+
+    With `coalesce`, a state event replaces the queued event of the same type, account and symbol, so a slow
+    consumer sees the latest state without falling behind. Once the queue is full the oldest event is dropped
+    and counted in `dropped`.
+    """
+
+    def __init__(self, feed, types, accounts, symbols, maxsize, coalesce):
+        if maxsize <= 0:
+            raise ValueError("Subscription queue size must be positive.")
+        self.feed = feed
+        self.types = frozenset(EventType(t) for t in types) if types else None
+        self.accounts = frozenset(getattr(account, "id", account) for account in accounts) if accounts else None
+        self.symbols = frozenset(symbol.upper() for symbol in symbols) if symbols else None
+        self.maxsize = maxsize
+        self.coalesce = coalesce
+        self.dropped = 0
+        self._events = OrderedDict()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self._events)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def matches(self, event):
+        return (
+            (self.types is None or event.type in self.types)
+            and (self.accounts is None or event.account in self.accounts)
+            and (self.symbols is None or event.symbol in self.symbols)
+        )
+
+    def put(self, event):
+        if self.coalesce and event.type in STATE_EVENTS:
+            key = (event.type, event.route, event.account, event.symbol)
+        else:
+            key = next(self._sequence)
+        with self._condition:
+            self._events[key] = event
+            if len(self._events) > self.maxsize:
+                self._events.popitem(last=False)
+                self.dropped += 1
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """The oldest queued event, waiting up to `timeout` seconds for one; None on timeout."""
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._condition:
+            while not self._events:
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            return self._events.popitem(last=False)[1]
+
+    def drain(self):
+        """All queued events, oldest first, without waiting."""
+        with self._condition:
+            events = list(self._events.values())
+            self._events.clear()
+            return events
+
+    def close(self):
+        self.feed.unsubscribe(self)
+
+
+class ChangeFeed:
+    """Publishes committed ledger, balance, position and price changes to in-process subscribers.
+
+    Writers check `active` before building an event, so the feed costs an attribute read while nobody subscribes.
+    """
+
+    def __init__(self):
+        self.active = False
+        self._subscriptions = ()
+        self._lock = threading.Lock()
+
+    def subscribe(self, types=None, accounts=None, symbols=None, maxsize=1024, coalesce=True):
+        """Subscribe to the events of `types`, for `accounts` (accounts or ids) and `symbols`; None matches all."""
+        subscription = Subscription(self, types, accounts, symbols, maxsize, coalesce)
+        with self._lock:
+            self._subscriptions += (subscription,)
+            self.active = True
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions = tuple(s for s in self._subscriptions if s is not subscription)
+            self.active = bool(self._subscriptions)
+
+    def publish(self, event):
+        for subscription in self._subscriptions:
+            if subscription.matches(event):
+                subscription.put(event)
+
+
+feed = ChangeFeed()
@@ -0,0 +1,178 @@
+import logging
+
+import numpy as np
+from peewee import BigIntegerField, FloatField, IntegerField, TextField
+
+from alfa.db import Balance, BaseModel, CurrencyType, Position, Price, db, get_history_models, strtimestamp
+
+
+log = logging.getLogger("alfa")
+
+
+class FxRate(BaseModel):
+    reference = True
+
+    id = IntegerField(primary_key=True)
+    base = TextField(choices=[c.value for c in CurrencyType])
+    quote = TextField(choices=[c.value for c in CurrencyType])
+    timestamp = BigIntegerField()  # Unix epoch time
+    rate = FloatField()  # Units of quote currency per unit of base currency
+
+    class Meta:
+        table_name = "fx_rate"
+        indexes = ((("base", "quote", "timestamp"), True),)  # Unique constraint on currency pair and timestamp
+
+
+def add_rates(base, quote, rates, batch_size=500):
+    """Bulk load (timestamp, rate) pairs for base/quote, replacing rates already stored for a timestamp."""
+    try:
+        base, quote = CurrencyType(base).value, CurrencyType(quote).value
+        rows = [{"base": base, "quote": quote, "timestamp": timestamp, "rate": rate} for timestamp, rate in rates]
+        if any(row["rate"] <= 0 for row in rows):
+            raise ValueError("FX rates must be positive.")
+        with db.atomic():
+            for i in range(0, len(rows), batch_size):
+                FxRate.insert_many(rows[i : i + batch_size]).on_conflict_replace().execute()
+        log.debug(f"Added {len(rows)} {base}/{quote} rates.")
+        return len(rows)
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to add {base}/{quote} rates: {type(e).__name__} : {e}")
+        raise e
+
+
+def _get_series(base, quote, to_timestamp=None):
+    # (timestamps, rates) for base/quote, inverting the quote/base series when only that one is stored
+    for pair, inverse in (((base, quote), False), ((quote, base), True)):
+        where_clause = (FxRate.base == pair[0]) & (FxRate.quote == pair[1])
+        if to_timestamp:
+            where_clause &= FxRate.timestamp <= to_timestamp
+        rows = list(FxRate.select(FxRate.timestamp, FxRate.rate).where(where_clause).order_by(FxRate.timestamp).tuples())
+        if rows:
+            timestamps = np.array([row[0] for row in rows], dtype=np.int64)
+            rates = np.array([row[1] for row in rows], dtype=np.float64)
+            return timestamps, 1.0 / rates if inverse else rates
+    raise ValueError(f"No {base}/{quote} rates are available.")
+
+
+def _as_of(timestamps, values, at, fill=np.nan):
+    """Vectorized as-of lookup: the last of `values` whose timestamp is at or before each of `at`."""
+    index = np.searchsorted(timestamps, at, side="right") - 1
+    if not len(values):
+        return np.full(len(at), fill, dtype=np.float64)
+    return np.where(index >= 0, values[np.maximum(index, 0)], fill)
+
+
+def _group(rows, key_size):
+    """Split rows sorted by their first `key_size` columns, then timestamp, into {key: (timestamps, last column)}."""
+    if not rows:
+        return {}
+    array = np.array(rows, dtype=np.float64)
+    keys = array[:, :key_size].astype(np.int64)
+    starts = np.concatenate(([0], np.flatnonzero((np.diff(keys, axis=0) != 0).any(axis=1)) + 1))
+    ends = np.append(starts[1:], len(array))
+    groups = {}
+    for start, end in zip(starts, ends, strict=True):
+        groups[tuple(int(k) for k in keys[start])] = (array[start:end, key_size].astype(np.int64), array[start:end, -1])
+    return groups
+
+
+def _load_history(model, select):
+    """Rows of `select(model)` from every table holding the model's history, archived years included, sorted by column."""
+    return sorted(row for history_model in get_history_models(model) for row in select(history_model).tuples())
+
+
+def get_rates(base, quote, timestamps):
+    """Rates for base/quote as of each timestamp, NaN before the first stored rate."""
+    base, quote = CurrencyType(base).value, CurrencyType(quote).value
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if base == quote:
+        return np.ones(len(timestamps), dtype=np.float64)
+    series = _get_series(base, quote, int(timestamps.max()) if len(timestamps) else None)
+    return _as_of(*series, timestamps)
+
+
+def get_rate(base, quote, timestamp=None):
+    base, quote = CurrencyType(base).value, CurrencyType(quote).value
+    if base == quote:
+        return 1.0
+    for pair, inverse in (((base, quote), False), ((quote, base), True)):
+        where_clause = (FxRate.base == pair[0]) & (FxRate.quote == pair[1])
+        if timestamp:
+            where_clause &= FxRate.timestamp <= timestamp
+        rate = FxRate.select(FxRate.rate).where(where_clause).order_by(FxRate.timestamp.desc()).scalar()
+        if rate:
+            return 1.0 / rate if inverse else rate
+    raise ValueError(f"No {base}/{quote} rate is available as of {strtimestamp(timestamp)}.")
+
+
+def equity_curves(accounts, currency, timestamps=None):
+    """Equity of each account, converted to `currency`, as of each timestamp.
+
+    Cash, positions, prices and rates are each loaded in a single query per table, archived years included, and aligned
+    with vectorized as-of lookups. Positions are valued at their stock's adjusted close, in the account's currency. When
+    `timestamps` is omitted the curves are aligned to the timestamps of the prices of every stock the accounts have held.
+
+    Returns (timestamps, equity) where equity has one row per account.
+    """
+    try:
+        currency = CurrencyType(currency).value
+        accounts = list(accounts)
+        account_ids = [account.id for account in accounts]
+
+        positions = _load_history(
+            Position,
+            lambda model: (
+                model.select(model.account, model.stock, model.timestamp, model.size)
+                .where(model.account.in_(account_ids))
+                .order_by(model.account, model.stock, model.timestamp)
+            ),
+        )
+        stock_ids = sorted({row[1] for row in positions})
+        prices = _load_history(
+            Price,
+            lambda model: (
+                model.select(model.stock, model.timestamp, model.adjusted_close)
+                .where(model.stock.in_(stock_ids))
+                .order_by(model.stock, model.timestamp)
+            ),
+        )
+        if timestamps is None:
+            timestamps = np.unique(np.array([row[1] for row in prices], dtype=np.int64))
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+
+        balances = _group(
+            _load_history(
+                Balance,
+                lambda model: (
+                    model.select(model.account, model.timestamp, model.cash)
+                    .where(model.account.in_(account_ids))
+                    .order_by(model.account, model.timestamp)
+                ),
+            ),
+            1,
+        )
+        sizes = _group(positions, 2)
+        closes = _group(prices, 1)
+        rates = {c: get_rates(c, currency, timestamps) for c in {account.currency for account in accounts}}
+
+        rows = {account.id: i for i, account in enumerate(accounts)}
+        equity = np.zeros((len(accounts), len(timestamps)), dtype=np.float64)
+        for (account_id,), series in balances.items():
+            equity[rows[account_id]] += _as_of(*series, timestamps, fill=0.0)
+        for (account_id, stock_id), series in sizes.items():
+            size = _as_of(*series, timestamps, fill=0.0)
+            close = _as_of(*closes[(stock_id,)], timestamps) if (stock_id,) in closes else np.nan
+            equity[rows[account_id]] += np.where(size != 0, size * close, 0.0)
+        for i, account in enumerate(accounts):
+            equity[i] *= rates[account.currency]
+
+        return timestamps, equity
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to value accounts in {currency}: {type(e).__name__} : {e}")
+        raise e
+
+
+def portfolio_equity(portfolio, currency, timestamps=None):
+    """Total equity of the portfolio's accounts in `currency`, as (timestamps, equity)."""
+    timestamps, equity = equity_curves(portfolio.get_accounts(), currency, timestamps)
+    return timestamps, equity.sum(axis=0)
@@ -0,0 +1,159 @@
+import heapq
+import logging
+from collections import namedtuple
+
+from peewee import Tuple
+
+from alfa.db import Balance, CashLedger, Position, Stock, TransactionLedger, TransactionType, get_history_models, strtimestamp
+
+
+log = logging.getLogger("alfa")
+
+
+CashEntry = namedtuple("CashEntry", ["id", "external_id", "timestamp", "type", "amount", "fees"])
+TransactionEntry = namedtuple("TransactionEntry", ["id", "external_id", "timestamp", "type", "symbol", "quantity", "price", "fees"])
+BalanceEntry = namedtuple("BalanceEntry", ["id", "timestamp", "cash"])
+PositionEntry = namedtuple("PositionEntry", ["id", "timestamp", "symbol", "size", "average_price", "market_price"])
+
+StatementSummary = namedtuple("StatementSummary", ["entries", "opening_cash", "closing_cash", "deposits", "withdrawals", "fees"])
+
+
+def _paginate(model, query, entry, from_timestamp, to_timestamp, page_size):
+    # Pages of `query` in (timestamp, id) order, each starting after the last row of the previous one
+    if from_timestamp:
+        query = query.where(model.timestamp >= from_timestamp)
+    if to_timestamp:
+        query = query.where(model.timestamp <= to_timestamp)
+    query = query.order_by(model.timestamp, model.id).limit(page_size)
+    timestamp = entry._fields.index("timestamp")
+    page = query
+    while True:
+        rows = list(page.tuples())
+        for row in rows:
+            yield entry._make(row)
+        if len(rows) < page_size:
+            return
+        page = query.where(Tuple(model.timestamp, model.id) > Tuple(rows[-1][timestamp], rows[-1][0]))
+
+
+def _paginate_history(model, select, entry, from_timestamp, to_timestamp, page_size):
+    # Archived history is paged from each table holding it, `select(model)` building the query, and merged back in order
+    streams = [
+        _paginate(m, select(m), entry, from_timestamp, to_timestamp, page_size) for m in get_history_models(model, from_timestamp, to_timestamp)
+    ]
+    return heapq.merge(*streams, key=lambda row: (row.timestamp, row.id))
+
+
+def iter_cash(account, from_timestamp=None, to_timestamp=None, page_size=1000):
+    """Deposits and withdrawals of the account as CashEntry tuples, in (timestamp, id) order."""
+    query = CashLedger.select(CashLedger.id, CashLedger.external_id, CashLedger.timestamp, CashLedger.type, CashLedger.amount, CashLedger.fees).where(
+        CashLedger.account == account
+    )
+    return _paginate(CashLedger, query, CashEntry, from_timestamp, to_timestamp, page_size)
+
+
+def iter_transactions(account, from_timestamp=None, to_timestamp=None, page_size=1000):
+    """Trades of the account as TransactionEntry tuples, in (timestamp, id) order."""
+    query = (
+        TransactionLedger.select(
+            TransactionLedger.id,
+            TransactionLedger.external_id,
+            TransactionLedger.timestamp,
+            TransactionLedger.type,
+            Stock.symbol,
+            TransactionLedger.quantity,
+            TransactionLedger.price,
+            TransactionLedger.fees,
+        )
+        .join(Stock)
+        .where(TransactionLedger.account == account)
+    )
+    return _paginate(TransactionLedger, query, TransactionEntry, from_timestamp, to_timestamp, page_size)
+
+
+def iter_balances(account, from_timestamp=None, to_timestamp=None, page_size=1000):
+    """Balance history of the account, archived years included, as BalanceEntry tuples, in (timestamp, id) order."""
+
+    def select(model):
+        return model.select(model.id, model.timestamp, model.cash).where(model.account == account)
+
+    return _paginate_history(Balance, select, BalanceEntry, from_timestamp, to_timestamp, page_size)
+
+
+def iter_positions(account, from_timestamp=None, to_timestamp=None, page_size=1000):
+    """Position history of the account, archived years included, as PositionEntry tuples, in (timestamp, id) order."""
+
+    def select(model):
+        return (
+            model.select(model.id, model.timestamp, Stock.symbol, model.size, model.average_price, model.market_price)
+            .join(Stock)
+            .where(model.account == account)
+        )
+
+    return _paginate_history(Position, select, PositionEntry, from_timestamp, to_timestamp, page_size)
+
+
+def iter_ledger(account, from_timestamp=None, to_timestamp=None, page_size=1000):
+    """Cash and trade entries of the account merged into one chronological stream, cash entries first on ties."""
+    streams = (
+        ((entry.timestamp, 0, entry.id, entry) for entry in iter_cash(account, from_timestamp, to_timestamp, page_size)),
+        ((entry.timestamp, 1, entry.id, entry) for entry in iter_transactions(account, from_timestamp, to_timestamp, page_size)),
+    )
+    for *_, entry in heapq.merge(*streams):
+        yield entry
+
+
+def get_cash_change(entry):
+    """Change of the account's cash due to a ledger entry, fees included."""
+    if isinstance(entry, CashEntry):
+        return entry.amount - entry.fees if entry.type == TransactionType.DEPOSIT.value else -(entry.amount + entry.fees)
+    if entry.type == TransactionType.BUY.value:
+        return -(entry.quantity * entry.price + entry.fees)
+    if entry.type == TransactionType.SELL.value:
+        return entry.quantity * entry.price - entry.fees
+    return -entry.fees
+
+
+_STATEMENT_HEADER = (
+    f"{'Date':<23} {'Type':<15} {'Reference':<16} {'Symbol':<8} {'Quantity':>10} {'Price':>12} {'Fees':>10} {'Amount':>14} {'Cash':>14}"
+)
+
+
+def render_statement(account, out, from_timestamp=None, to_timestamp=None, page_size=1000):
+    """Write the account's statement between the timestamps to the text stream `out`.
+
+    Each ledger entry is a line with its cash amount and the running cash balance. The ledger is streamed, so memory
+    does not grow with the number of entries. Returns a StatementSummary.
+    """
+    try:
+        opening_cash = account.get_cash(from_timestamp - 1) if from_timestamp else 0.0
+        cash = opening_cash
+        entries = 0
+        deposits = withdrawals = fees = 0.0
+
+        out.write(f"Statement for account {account.name} ({account.currency})\n")
+        out.write(f"From {strtimestamp(from_timestamp) or 'the first entry'} to {strtimestamp(to_timestamp) or 'the last entry'}\n\n")
+        out.write(_STATEMENT_HEADER + "\n")
+        out.write(f"{'Opening cash':<23} {'':<15} {'':<16} {'':<8} {'':>10} {'':>12} {'':>10} {'':>14} {opening_cash:>14,.2f}\n")
+        for entry in iter_ledger(account, from_timestamp, to_timestamp, page_size):
+            change = get_cash_change(entry)
+            cash += change
+            entries += 1
+            fees += entry.fees
+            if isinstance(entry, CashEntry):
+                if entry.type == TransactionType.DEPOSIT.value:
+                    deposits += entry.amount
+                else:
+                    withdrawals += entry.amount
+                symbol, quantity, price = "", "", ""
+            else:
+                symbol, quantity, price = entry.symbol, f"{entry.quantity:,}", f"{entry.price:,.2f}"
+            out.write(
+                f"{strtimestamp(entry.timestamp):<23} {entry.type:<15} {entry.external_id[:16]:<16} {symbol:<8} {quantity:>10} {price:>12} "
+                f"{entry.fees:>10,.2f} {change:>14,.2f} {cash:>14,.2f}\n"
+            )
+        out.write(f"\n{entries} entries. Deposits: {deposits:,.2f}. Withdrawals: {withdrawals:,.2f}. Fees: {fees:,.2f}. Closing cash: {cash:,.2f}.\n")
+        return StatementSummary(entries, opening_cash, cash, deposits, withdrawals, fees)
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to render statement for account {account.name}: {type(e).__name__} : {e}")
+        raise e
@@ -0,0 +1,328 @@
+import logging
+from collections import deque
+
+import numpy as np
+from peewee import BigIntegerField, FloatField, ForeignKeyField, IntegerField, TextField
+
+from alfa.blocks import read_prices
+from alfa.db import (
+    BaseModel,
+    IntervalType,
+    Stock,
+    _as_validated_symbol,
+    add_open_listener,
+    db,
+    strtimestamp,
+)
+
+
+log = logging.getLogger("alfa")
+
+
+class _State:
+    __slots__ = ("count", "value", "a", "b", "prev_close", "window")
+
+    def __init__(self, count=0, value=None, a=0.0, b=0.0, prev_close=None, window=None):
+        self.count = count
+        self.value = value
+        self.a = a
+        self.b = b
+        self.prev_close = prev_close
+        self.window = window
+
+
+# Bars are read as (timestamp, high, low, close, adjusted_close) tuples.
+_BAR_FIELDS = ["timestamp", "high", "low", "close", "adjusted_close"]
+_HIGH, _LOW, _CLOSE, _ADJUSTED_CLOSE = 1, 2, 3, 4
+
+
+def _read_bars(stock, from_timestamp=None, to_timestamp=None):
+    # Packed and archived bars included
+    return read_prices(stock, from_timestamp, to_timestamp)[_BAR_FIELDS].tolist()
+
+
+class Indicator:
+    """An indicator computed one bar at a time from a small state that can be persisted and restored."""
+
+    name = None
+
+    def __init__(self, period):
+        if not isinstance(period, int) or period < 1:
+            raise ValueError(f"{self.name} period must be a positive integer.")
+        self.period = period
+
+    @property
+    def params(self):
+        return str(self.period)
+
+    @property
+    def lookback(self):
+        # Number of bars, up to and including the last computed one, needed to restore the state
+        return 1
+
+    def new_state(self):
+        return _State()
+
+    def restore(self, count, value, a, b, bars):
+        return _State(count=count, value=value, a=a or 0.0, b=b or 0.0, prev_close=self._price(bars[-1]) if bars else None)
+
+    def step(self, state, bar):  # pragma: no cover
+        raise NotImplementedError
+
+    def _price(self, bar):
+        return bar[_ADJUSTED_CLOSE]
+
+    def __repr__(self):
+        return f"{self.name}({self.params})"
+
+
+class SMA(Indicator):
+    name = "SMA"
+
+    @property
+    def lookback(self):
+        return self.period
+
+    def new_state(self):
+        return _State(window=deque(maxlen=self.period))
+
+    def restore(self, count, value, a, b, bars):
+        window = deque((self._price(bar) for bar in bars), maxlen=self.period)
+        return _State(count=count, value=value, a=sum(window), window=window)
+
+    def step(self, state, bar):
+        price = self._price(bar)
+        if len(state.window) == self.period:
+            state.a -= state.window[0]
+        state.window.append(price)
+        state.a += price
+        state.count += 1
+        state.value = state.a / self.period if len(state.window) == self.period else None
+        return state.value
+
+
+class EMA(Indicator):
+    """Exponential moving average seeded with the simple average of the first `period` bars."""
+
+    name = "EMA"
+
+    def step(self, state, bar):
+        price = self._price(bar)
+        state.count += 1
+        if state.count < self.period:
+            state.a += price
+        elif state.count == self.period:
+            state.a += price
+            state.value = state.a / self.period
+        else:
+            state.value += (price - state.value) * 2.0 / (self.period + 1)
+        return state.value
+
+
+class RSI(Indicator):
+    """Relative strength index using Wilder's smoothing of average gains (a) and losses (b)."""
+
+    name = "RSI"
+
+    def step(self, state, bar):
+        price = self._price(bar)
+        state.count += 1
+        if state.prev_close is not None:
+            change = price - state.prev_close
+            gain, loss = max(change, 0.0), max(-change, 0.0)
+            changes = state.count - 1
+            if changes < self.period:
+                state.a += gain
+                state.b += loss
+            elif changes == self.period:
+                state.a = (state.a + gain) / self.period
+                state.b = (state.b + loss) / self.period
+            else:
+                state.a = (state.a * (self.period - 1) + gain) / self.period
+                state.b = (state.b * (self.period - 1) + loss) / self.period
+            if changes >= self.period:
+                state.value = 100.0 - 100.0 / (1.0 + state.a / state.b) if state.b else 100.0
+        state.prev_close = price
+        return state.value
+
+
+class ATR(Indicator):
+    """Average true range using Wilder's smoothing; the first bar's true range is its high-low range."""
+
+    name = "ATR"
+
+    def _price(self, bar):
+        return bar[_CLOSE]
+
+    def step(self, state, bar):
+        high, low = bar[_HIGH], bar[_LOW]
+        true_range = high - low
+        if state.prev_close is not None:
+            true_range = max(true_range, abs(high - state.prev_close), abs(low - state.prev_close))
+        state.count += 1
+        if state.count < self.period:
+            state.a += true_range
+        elif state.count == self.period:
+            state.a = (state.a + true_range) / self.period
+        else:
+            state.a = (state.a * (self.period - 1) + true_range) / self.period
+        if state.count >= self.period:
+            state.value = state.a
+        state.prev_close = bar[_CLOSE]
+        return state.value
+
+
+INDICATORS = {indicator.name: indicator for indicator in (SMA, EMA, RSI, ATR)}
+
+
+class IndicatorSeries(BaseModel):
+    reference = True
+
+    id = IntegerField(primary_key=True)
+    stock = ForeignKeyField(Stock, backref="indicators", on_delete="CASCADE")
+    interval = TextField(choices=[i.value for i in IntervalType])
+    indicator = TextField(choices=list(INDICATORS))
+    params = TextField()
+    last_timestamp = BigIntegerField(null=True)  # Unix epoch time of the last computed bar
+
+    class Meta:
+        table_name = "indicator_series"
+        indexes = ((("stock", "interval", "indicator", "params"), True),)  # Unique constraint on the series key
+
+    def get_indicator(self):
+        return INDICATORS[self.indicator](int(self.params))
+
+
+class IndicatorValue(BaseModel):
+    reference = True
+
+    id = IntegerField(primary_key=True)
+    series = ForeignKeyField(IndicatorSeries, backref="values", on_delete="CASCADE")
+    timestamp = BigIntegerField()  # Unix epoch time
+    count = IntegerField()  # Number of bars seen up to and including this one
+    value = FloatField(null=True)  # Null while the indicator is warming up
+    state_a = FloatField(null=True)
+    state_b = FloatField(null=True)
+
+    class Meta:
+        table_name = "indicator_value"
+        indexes = ((("series", "timestamp"), True),)  # Unique constraint on series and timestamp
+
+
+# In-process states keyed by series id, as (last_timestamp, state), so appending a bar is O(1).
+_states = {}
+
+
+def _load_state(series, indicator):
+    cached = _states.pop(series.id, None)
+    if cached and cached[0] == series.last_timestamp:
+        return cached[1]
+    if series.last_timestamp is None:
+        return indicator.new_state()
+
+    row = IndicatorValue.get((IndicatorValue.series == series) & (IndicatorValue.timestamp == series.last_timestamp))
+    # Each computed bar has a value, the one `lookback` bars back is where the bars restoring the state start
+    first_timestamp = (
+        IndicatorValue.select(IndicatorValue.timestamp)
+        .where((IndicatorValue.series == series) & (IndicatorValue.timestamp <= series.last_timestamp))
+        .order_by(IndicatorValue.timestamp.desc())
+        .offset(indicator.lookback - 1)
+        .limit(1)
+        .scalar()
+    )
+    bars = _read_bars(series.stock, first_timestamp, series.last_timestamp)[-indicator.lookback :]
+    return indicator.restore(row.count, row.value, row.state_a, row.state_b, bars)
+
+
+def _update(series, from_timestamp=None, batch_size=500):
+    indicator = series.get_indicator()
+    with db.atomic():
+        if from_timestamp is not None and series.last_timestamp is not None and from_timestamp <= series.last_timestamp:
+            log.debug(f"Recomputing {indicator} for {series.stock.symbol} from {strtimestamp(from_timestamp)}.")
+            IndicatorValue.delete().where((IndicatorValue.series == series) & (IndicatorValue.timestamp >= from_timestamp)).execute()
+            _states.pop(series.id, None)
+            series.last_timestamp = (
+                IndicatorValue.select(IndicatorValue.timestamp)
+                .where((IndicatorValue.series == series) & (IndicatorValue.timestamp < from_timestamp))
+                .order_by(IndicatorValue.timestamp.desc())
+                .scalar()
+            )
+
+        state = _load_state(series, indicator)
+        bars = _read_bars(series.stock, None if series.last_timestamp is None else series.last_timestamp + 1)
+
+        rows = []
+        for bar in bars:
+            indicator.step(state, bar)
+            rows.append(
+                {
+                    "series": series.id,
+                    "timestamp": bar[0],
+                    "count": state.count,
+                    "value": state.value,
+                    "state_a": state.a,
+                    "state_b": state.b,
+                }
+            )
+        for i in range(0, len(rows), batch_size):
+            IndicatorValue.insert_many(rows[i : i + batch_size]).execute()
+
+        if rows:
+            series.last_timestamp = rows[-1]["timestamp"]
+        series.save()
+
+    _states[series.id] = (series.last_timestamp, state)
+    return series
+
+
+def track(symbol, indicator, interval_type=IntervalType.DAY.value):
+    """Start maintaining `indicator` for `symbol` and bring it up to date with the stored prices."""
+    try:
+        if IntervalType(interval_type) != IntervalType.DAY:
+            # Price rows carry no interval, the stored bars are daily
+            raise ValueError(f"Indicators on {IntervalType(interval_type).value} bars are not supported, prices are stored as daily bars.")
+        symbol = _as_validated_symbol(symbol)
+        stock = Stock.get_or_none(Stock.symbol == symbol)
+        if not stock:
+            raise ValueError(f"Stock {symbol} does not exist in the database.")
+
+        series, created = IndicatorSeries.get_or_create(
+            stock=stock,
+            interval=IntervalType.DAY.value,
+            indicator=indicator.name,
+            params=indicator.params,
+        )
+        if created:
+            log.debug(f"Tracking {indicator} for {symbol}.")
+        return _update(series)
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to track {indicator} for {symbol}: {type(e).__name__} : {e}")
+        raise e
+
+
+def get_indicator(symbol, indicator, from_timestamp=None, to_timestamp=None, interval_type=IntervalType.DAY.value):
+    """Return (timestamps, values) NumPy arrays for `indicator`; values are NaN while the indicator warms up.
+
+    The series is read through `track`, so the first call for an indicator starts storing and maintaining it.
+    """
+    series = track(symbol, indicator, interval_type)
+
+    where_clause = IndicatorValue.series == series
+    if from_timestamp:
+        where_clause &= IndicatorValue.timestamp >= from_timestamp
+    if to_timestamp:
+        where_clause &= IndicatorValue.timestamp <= to_timestamp
+    rows = list(IndicatorValue.select(IndicatorValue.timestamp, IndicatorValue.value).where(where_clause).order_by(IndicatorValue.timestamp).tuples())
+
+    timestamps = np.array([row[0] for row in rows], dtype=np.int64)
+    values = np.array([row[1] for row in rows], dtype=np.float64)
+    return timestamps, values
+
+
+def on_prices_added(stock, first_timestamp, last_timestamp):
+    """Bring the stock's series up to date with bars added or revised from `first_timestamp`. Called by alfa.db."""
+    for series in IndicatorSeries.select().where((IndicatorSeries.stock == stock) & (IndicatorSeries.interval == IntervalType.DAY.value)):
+        _update(series, first_timestamp)
+
+
+add_open_listener(_states.clear)
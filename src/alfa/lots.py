@@ -0,0 +1,289 @@
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from enum import Enum
+
+from peewee import JOIN, BigIntegerField, FloatField, ForeignKeyField, IntegerField, TextField, fn
+
+from alfa.db import (
+    Account,
+    BaseModel,
+    CurrentPosition,
+    Stock,
+    TransactionType,
+    _as_validated_symbol,
+    _get_stock,
+    add_open_listener,
+    add_rollback_listener,
+    db,
+    strtimestamp,
+)
+
+
+log = logging.getLogger("alfa")
+
+
+class LotMethod(str, Enum):
+    FIFO = "FIFO"
+    LIFO = "LIFO"
+    SPECIFIC_ID = "SPECIFIC_ID"
+
+
+class LotPolicy(BaseModel):
+    account = ForeignKeyField(Account, primary_key=True, backref="lot_policy", on_delete="CASCADE")
+    method = TextField(choices=[m.value for m in LotMethod], default=LotMethod.FIFO.value)
+
+    class Meta:
+        table_name = "lot_policy"
+
+
+class Lot(BaseModel):
+    id = IntegerField(primary_key=True)
+    account = ForeignKeyField(Account, backref="lots", on_delete="CASCADE")
+    stock = ForeignKeyField(Stock, on_delete="CASCADE")
+    external_id = TextField(null=True)  # Opening transaction, null for lots seeded from a position held before lots were tracked
+    timestamp = BigIntegerField()  # Unix epoch time
+    quantity = IntegerField()
+    remaining = IntegerField()
+    cost_per_share = FloatField()  # Including the opening fees
+
+    class Meta:
+        table_name = "lot"
+        indexes = ((("account", "stock", "timestamp"), False),)
+
+
+class LotClosure(BaseModel):
+    id = IntegerField(primary_key=True)
+    lot = ForeignKeyField(Lot, backref="closures", on_delete="CASCADE")
+    account = ForeignKeyField(Account, on_delete="CASCADE")
+    stock = ForeignKeyField(Stock, on_delete="CASCADE")
+    external_id = TextField()  # Closing transaction
+    timestamp = BigIntegerField()  # Unix epoch time
+    quantity = IntegerField()
+    cost_per_share = FloatField()
+    proceeds_per_share = FloatField()  # Net of the closing fees
+    realized = FloatField()
+
+    class Meta:
+        table_name = "lot_closure"
+        indexes = (
+            (("account", "timestamp"), False),
+            (("lot", "timestamp"), False),
+        )
+
+
+class LotEngine:
+    """Open lots per (account, stock), kept in deques ordered by opening time and persisted as they change.
+
+    Buys and deposits in kind open lots and sells close them, matched by the account's `LotMethod`. Sells made
+    inside `matching(lot_ids)` close the selected lots first. Fees are part of the cost basis of a lot and are
+    deducted from the proceeds of a closure.
+    """
+
+    def __init__(self):
+        # Keyed by the database route too, as account and stock ids repeat across portfolio shards
+        self._lots = {}
+        self._methods = {}
+        self._selection = threading.local()
+
+    def clear(self):
+        self._lots.clear()
+        self._methods.clear()
+
+    def get_method(self, account):
+        account_id = getattr(account, "id", account)
+        key = (db.route, account_id)
+        if key not in self._methods:
+            policy = LotPolicy.get_or_none(LotPolicy.account == account_id)
+            self._methods[key] = LotMethod(policy.method) if policy else LotMethod.FIFO
+        return self._methods[key]
+
+    def set_method(self, account, method):
+        method = LotMethod(method)
+        LotPolicy.replace(account=account, method=method.value).execute()
+        self._methods[(db.route, account.id)] = method
+        log.debug(f"Account {account.name} matches lots by {method.value}.")
+
+    @contextmanager
+    def matching(self, lot_ids):
+        previous = getattr(self._selection, "lot_ids", None)
+        self._selection.lot_ids = list(lot_ids)
+        try:
+            yield self
+        finally:
+            self._selection.lot_ids = previous
+
+    def _get_lots(self, account_id, stock_id):
+        key = (db.route, account_id, stock_id)
+        lots = self._lots.get(key)
+        if lots is None:
+            where_clause = (Lot.account == account_id) & (Lot.stock == stock_id)
+            lots = deque(Lot.select().where(where_clause & (Lot.remaining > 0)).order_by(Lot.timestamp, Lot.id))
+            if not lots and not Lot.select().where(where_clause).exists():
+                # Positions opened before lots were tracked become a single lot at their average price
+                position = CurrentPosition.get_or_none((CurrentPosition.account == account_id) & (CurrentPosition.stock == stock_id))
+                if position and position.size > 0:
+                    lots.append(
+                        Lot.create(
+                            account=account_id,
+                            stock=stock_id,
+                            timestamp=position.timestamp,
+                            quantity=position.size,
+                            remaining=position.size,
+                            cost_per_share=position.average_price,
+                        )
+                    )
+            self._lots[key] = lots
+        return lots
+
+    def get_open_lots(self, account, symbol):
+        stock = _get_stock(_as_validated_symbol(symbol))
+        if not stock:
+            return []
+        return list(self._get_lots(account.id, stock.id))
+
+    def on_transaction(self, transaction):
+        key = (db.route, transaction.account_id, transaction.stock_id)
+        try:
+            if transaction.type in (TransactionType.BUY.value, TransactionType.DEPOSIT_IN_KIND.value):
+                self._open(transaction)
+            elif transaction.type == TransactionType.SELL.value:
+                self._close(transaction)
+        except Exception as e:
+            # The in-memory lots may be ahead of the database now, reload them next time
+            self._lots.pop(key, None)
+            log.error(f"Failed to update lots for transaction {transaction.external_id}: {type(e).__name__} : {e}")
+            raise e
+
+    def _open(self, transaction):
+        if transaction.quantity <= 0:
+            raise ValueError(f"Transaction {transaction.external_id} must open a positive quantity, not {transaction.quantity}.")
+        lots = self._get_lots(transaction.account_id, transaction.stock_id)
+        lot = Lot.create(
+            account=transaction.account_id,
+            stock=transaction.stock_id,
+            external_id=transaction.external_id,
+            timestamp=transaction.timestamp,
+            quantity=transaction.quantity,
+            remaining=transaction.quantity,
+            cost_per_share=transaction.price + transaction.fees / transaction.quantity,
+        )
+        lots.append(lot)
+
+    def _close(self, transaction):
+        if transaction.quantity <= 0:
+            raise ValueError(f"Transaction {transaction.external_id} must close a positive quantity, not {transaction.quantity}.")
+        lots = self._get_lots(transaction.account_id, transaction.stock_id)
+        method = self.get_method(transaction.account_id)
+        proceeds_per_share = transaction.price - transaction.fees / transaction.quantity
+        quantity = transaction.quantity
+        closures = []
+        touched = {}
+
+        def close(lot):
+            nonlocal quantity
+            closed = min(lot.remaining, quantity)
+            lot.remaining -= closed
+            quantity -= closed
+            touched[lot.id] = lot
+            closures.append(
+                {
+                    "lot": lot.id,
+                    "account": transaction.account_id,
+                    "stock": transaction.stock_id,
+                    "external_id": transaction.external_id,
+                    "timestamp": transaction.timestamp,
+                    "quantity": closed,
+                    "cost_per_share": lot.cost_per_share,
+                    "proceeds_per_share": proceeds_per_share,
+                    "realized": closed * (proceeds_per_share - lot.cost_per_share),
+                }
+            )
+
+        selection = getattr(self._selection, "lot_ids", None)
+        if selection:
+            by_id = {lot.id: lot for lot in lots}
+            for lot_id in selection:
+                if quantity and lot_id in by_id and by_id[lot_id].remaining:
+                    close(by_id[lot_id])
+        if quantity and method == LotMethod.SPECIFIC_ID:
+            raise ValueError(f"Select the lots to sell for transaction {transaction.external_id}; {quantity} shares are not matched.")
+        while quantity and lots:
+            if method == LotMethod.FIFO:
+                close(lots[0])
+                if not lots[0].remaining:
+                    lots.popleft()
+            else:
+                close(lots[-1])
+                if not lots[-1].remaining:
+                    lots.pop()
+        if quantity:
+            log.warning(f"Transaction {transaction.external_id} sold {quantity} shares more than its open lots.")
+
+        for lot in touched.values():
+            if not lot.remaining and lot in lots:
+                lots.remove(lot)
+            Lot.update(remaining=lot.remaining).where(Lot.id == lot.id).execute()
+        if closures:
+            LotClosure.insert_many(closures).execute()
+        log.debug(f"Transaction {transaction.external_id} closed {len(closures)} lots on {strtimestamp(transaction.timestamp)}.")
+
+
+# Fed every transaction by alfa.db as it is written
+engine = LotEngine()
+add_open_listener(engine.clear)
+# Rolled back lots are reloaded from the database
+add_rollback_listener(engine.clear)
+
+
+def realized_pnl(account, from_timestamp=None, to_timestamp=None, symbol=None):
+    """Realized P&L of the lots closed between `from_timestamp` and `to_timestamp`."""
+    try:
+        where_clause = LotClosure.account == account
+        if from_timestamp:
+            where_clause &= LotClosure.timestamp >= from_timestamp
+        if to_timestamp:
+            where_clause &= LotClosure.timestamp <= to_timestamp
+        if symbol:
+            where_clause &= LotClosure.stock == Stock.select(Stock.id).where(Stock.symbol == _as_validated_symbol(symbol))
+        return LotClosure.select(fn.COALESCE(fn.SUM(LotClosure.realized), 0.0)).where(where_clause).scalar()
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to compute realized P&L for account {account.name}: {type(e).__name__} : {e}")
+        raise e
+
+
+def unrealized_pnl(account, to_timestamp=None, symbol=None):
+    """Unrealized P&L at `to_timestamp` of the lots open at that time, valued at the latest adjusted close."""
+    try:
+        where_clause = Lot.account == account
+        if symbol:
+            where_clause &= Lot.stock == Stock.select(Stock.id).where(Stock.symbol == _as_validated_symbol(symbol))
+        if to_timestamp:
+            closed = (
+                LotClosure.select(LotClosure.lot, fn.SUM(LotClosure.quantity).alias("quantity"))
+                .where((LotClosure.account == account) & (LotClosure.timestamp <= to_timestamp))
+                .group_by(LotClosure.lot)
+            )
+            open_quantity = Lot.quantity - fn.COALESCE(closed.c.quantity, 0)
+            query = Lot.select(Lot.stock, fn.SUM(open_quantity), fn.SUM(open_quantity * Lot.cost_per_share)).join(
+                closed, JOIN.LEFT_OUTER, on=(closed.c.lot_id == Lot.id)
+            )
+            where_clause &= Lot.timestamp <= to_timestamp
+        else:
+            query = Lot.select(Lot.stock, fn.SUM(Lot.remaining), fn.SUM(Lot.remaining * Lot.cost_per_share))
+
+        pnl = 0.0
+        for stock_id, quantity, cost in query.where(where_clause).group_by(Lot.stock).tuples():
+            if not quantity:
+                continue
+            stock = Stock.get_by_id(stock_id)
+            price = stock.get_price(to_timestamp)
+            if not price:
+                log.warning(f"No price to value {quantity} shares of {stock.symbol} in account {account.name}.")
+                continue
+            pnl += quantity * price.adjusted_close - cost
+        return pnl
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to compute unrealized P&L for account {account.name}: {type(e).__name__} : {e}")
+        raise e
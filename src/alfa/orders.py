@@ -0,0 +1,222 @@
+import heapq
+import logging
+from enum import Enum
+from itertools import count
+
+from peewee import BigIntegerField, FloatField, ForeignKeyField, IntegerField, TextField
+
+from alfa.db import Account, BaseModel, Stock, TransactionType, _as_validated_symbol, db, strtimestamp
+
+
+log = logging.getLogger("alfa")
+
+
+class OrderType(str, Enum):
+    LIMIT = "LIMIT"
+    STOP = "STOP"
+
+
+class OrderStatus(str, Enum):
+    OPEN = "OPEN"
+    FILLED = "FILLED"
+    CANCELLED = "CANCELLED"
+    REJECTED = "REJECTED"
+
+
+class Order(BaseModel):
+    id = IntegerField(primary_key=True)
+    external_id = TextField(unique=True)
+    account = ForeignKeyField(Account, backref="orders", on_delete="CASCADE")
+    stock = ForeignKeyField(Stock, on_delete="CASCADE")
+    timestamp = BigIntegerField()  # Unix epoch time the order was placed
+    side = TextField(choices=[TransactionType.BUY, TransactionType.SELL])
+    type = TextField(choices=[OrderType.LIMIT, OrderType.STOP])
+    quantity = IntegerField()
+    price = FloatField()  # Limit price, or trigger price for stops
+    fees = FloatField(default=0.0)
+    status = TextField(choices=[s.value for s in OrderStatus], default=OrderStatus.OPEN.value)
+    fill_timestamp = BigIntegerField(null=True)
+    fill_price = FloatField(null=True)
+
+    class Meta:
+        table_name = "pending_order"
+        indexes = ((("status", "stock"), False),)
+
+
+def _post_to_ledger(order, timestamp, price):
+    if order.side == TransactionType.BUY.value:
+        order.account.buy(order.external_id, timestamp, order.stock.symbol, order.quantity, price, order.fees)
+    else:
+        order.account.sell(order.external_id, timestamp, order.stock.symbol, order.quantity, price, order.fees)
+
+
+class _SymbolBook:
+    """Resting orders for one symbol, in four heaps ordered so the next order a bar can trigger is on top.
+
+    Entries are (key, sequence, order id); keys are negated for the heaps that trigger from the highest price.
+    """
+
+    __slots__ = ("buy_limits", "sell_limits", "buy_stops", "sell_stops")
+
+    def __init__(self):
+        self.buy_limits = []  # Triggered by low <= limit, highest limit first
+        self.sell_limits = []  # Triggered by high >= limit, lowest limit first
+        self.buy_stops = []  # Triggered by high >= stop, lowest stop first
+        self.sell_stops = []  # Triggered by low <= stop, highest stop first
+
+    def push(self, order, sequence):
+        if order.type == OrderType.LIMIT.value:
+            if order.side == TransactionType.BUY.value:
+                heapq.heappush(self.buy_limits, (-order.price, sequence, order.id))
+            else:
+                heapq.heappush(self.sell_limits, (order.price, sequence, order.id))
+        elif order.side == TransactionType.BUY.value:
+            heapq.heappush(self.buy_stops, (order.price, sequence, order.id))
+        else:
+            heapq.heappush(self.sell_stops, (-order.price, sequence, order.id))
+
+    def pop_triggered(self, high, low):
+        triggered = []
+        for heap, crossed in (
+            (self.buy_limits, lambda key: -key >= low),
+            (self.sell_limits, lambda key: key <= high),
+            (self.buy_stops, lambda key: key <= high),
+            (self.sell_stops, lambda key: -key >= low),
+        ):
+            while heap and crossed(heap[0][0]):
+                _, sequence, order_id = heapq.heappop(heap)
+                triggered.append((sequence, order_id))
+        return triggered
+
+
+class OrderBook:
+    """Resting limit and stop orders matched against incoming bars.
+
+    Each bar only pops the orders it crosses off per-symbol heaps, so matching costs O(k log n) for k triggered
+    orders out of n resting ones. Cancelled orders are dropped lazily when they reach the top of a heap. Fills are
+    posted through `executor(order, timestamp, price)`, which defaults to the account's `buy`/`sell`; an order
+    whose execution raises ValueError (e.g. insufficient cash) is rejected.
+    """
+
+    def __init__(self, executor=None):
+        self.executor = executor or _post_to_ledger
+        self._books = {}
+        self._orders = {}
+        self._sequence = count()
+
+    def __len__(self):
+        return len(self._orders)
+
+    def _add(self, order):
+        self._orders[order.id] = order
+        book = self._books.get(order.stock.symbol)
+        if book is None:
+            book = self._books[order.stock.symbol] = _SymbolBook()
+        book.push(order, next(self._sequence))
+
+    def load(self):
+        """Load open orders from the database, oldest first."""
+        try:
+            query = (
+                Order.select(Order, Account, Stock)
+                .join(Account)
+                .switch(Order)
+                .join(Stock)
+                .where(Order.status == OrderStatus.OPEN.value)
+                .order_by(Order.timestamp, Order.id)
+            )
+            for order in query:
+                if order.id not in self._orders:
+                    self._add(order)
+            log.debug(f"Loaded {len(self._orders)} open orders.")
+            return self
+        except Exception as e:  # pragma: no cover
+            log.error(f"Failed to load open orders: {type(e).__name__} : {e}")
+            raise e
+
+    def place(self, account, external_id, timestamp, symbol, side, order_type, quantity, price, fees=0.0):
+        try:
+            symbol = _as_validated_symbol(symbol)
+            side, order_type = TransactionType(side), OrderType(order_type)
+            if side not in (TransactionType.BUY, TransactionType.SELL):
+                raise ValueError(f"Orders must be a {TransactionType.BUY.value} or a {TransactionType.SELL.value}.")
+            if quantity <= 0 or price <= 0:
+                raise ValueError(f"Invalid order for {quantity} shares of {symbol} at {price}.")
+
+            stock = account.portfolio.start_watching(symbol)
+            order = Order.create(
+                external_id=external_id,
+                account=account,
+                stock=stock,
+                timestamp=timestamp,
+                side=side.value,
+                type=order_type.value,
+                quantity=quantity,
+                price=price,
+                fees=fees,
+            )
+            self._add(order)
+            log.debug(f"Placed {order_type.value} order to {side.value} {quantity} shares of {symbol} at {price:.2f} in account {account.name}.")
+            return order
+        except Exception as e:  # pragma: no cover
+            log.error(f"Failed to place order for {quantity} shares of {symbol} at {price}: {type(e).__name__} : {e}")
+            raise e
+
+    def cancel(self, order):
+        order = self._orders.pop(order.id, None)
+        if not order:
+            return False
+        order.status = OrderStatus.CANCELLED.value
+        Order.update(status=order.status).where(Order.id == order.id).execute()
+        log.debug(f"Cancelled order {order.external_id}.")
+        return True
+
+    def match(self, symbol, timestamp, open, high, low):
+        """Execute the orders triggered by a bar and return them with their final status.
+
+        Each fill is posted and its order marked filled in one transaction. Orders placed after the bar keep resting,
+        and when an execution raises anything but ValueError the orders not yet executed go back to the book.
+        """
+        book = self._books.get(symbol)
+        if not book:
+            return []
+
+        executed = []
+        triggered = sorted(book.pop_triggered(high, low))
+        for i, (sequence, order_id) in enumerate(triggered):
+            order = self._orders.pop(order_id, None)
+            if not order:  # Cancelled
+                continue
+            if timestamp < order.timestamp:
+                self._requeue(book, sequence, order)
+                continue
+
+            if (order.type == OrderType.LIMIT.value) == (order.side == TransactionType.BUY.value):
+                # Buy limits and sell stops fill at their price, or at the open when the bar gapped through it
+                price = min(open, order.price)
+            else:
+                price = max(open, order.price)
+
+            try:
+                with db.atomic():
+                    self.executor(order, timestamp, price)
+                    Order.update(status=OrderStatus.FILLED.value, fill_timestamp=timestamp, fill_price=price).where(Order.id == order.id).execute()
+                order.status, order.fill_timestamp, order.fill_price = OrderStatus.FILLED.value, timestamp, price
+                log.debug(f"Filled order {order.external_id} for {order.quantity} shares of {symbol} at {price:.2f} on {strtimestamp(timestamp)}.")
+            except ValueError as e:
+                order.status = OrderStatus.REJECTED.value
+                Order.update(status=order.status).where(Order.id == order.id).execute()
+                log.info(f"Rejected order {order.external_id} for {order.quantity} shares of {symbol}: {e}")
+            except Exception:
+                # The order and those after it are still open
+                self._requeue(book, sequence, order)
+                for later_sequence, later_id in triggered[i + 1 :]:
+                    if later_id in self._orders:
+                        book.push(self._orders[later_id], later_sequence)
+                raise
+            executed.append(order)
+        return executed
+
+    def _requeue(self, book, sequence, order):
+        self._orders[order.id] = order
+        book.push(order, sequence)
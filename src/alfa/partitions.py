@@ -0,0 +1,206 @@
+import argparse
+import glob
+import logging
+import os
+import re
+from datetime import datetime, timezone
+from functools import partial
+
+from alfa.db import (
+    Balance,
+    Position,
+    Price,
+    _latest_rows_sql,
+    add_history_source,
+    add_history_store,
+    db,
+    open_db,
+    remove_history_source,
+    remove_history_store,
+)
+
+
+log = logging.getLogger("alfa")
+
+
+# History tables moved into yearly partitions, with the columns identifying a series in each
+PARTITIONED = (
+    (Price, ("stock_id",)),
+    (Balance, ("account_id",)),
+    (Position, ("account_id", "stock_id")),
+)
+
+# Years of the partitions attached to the open database, ascending
+_years = []
+
+# Models bound to the partitioned tables, by model and year
+_partition_models = {}
+
+
+def _year_start(year):
+    return int(datetime(year, 1, 1, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def _year_of(timestamp):
+    return datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc).year
+
+
+def _schema(year):
+    return f"p{year}"
+
+
+def get_partition_path(year, path=None):
+    """File of the partition holding `year`, next to the hot database file: data/alfa.db keeps 2020 in data/alfa_2020.db."""
+    stem, extension = os.path.splitext(path or db.database)
+    return f"{stem}_{year}{extension}"
+
+
+def get_partition_years():
+    return list(_years)
+
+
+def _attach(year):
+    db.attach(get_partition_path(year), _schema(year))
+    if year not in _years:
+        _years.append(year)
+        _years.sort()
+    # Reads consult the partitions only while some are attached
+    for model, _ in PARTITIONED:
+        add_history_store(model, _stores[model])
+        add_history_source(model, _sources[model])
+
+
+def attach_partitions():
+    """Attach every partition file found next to the open database. Runs from alfa.db whenever a database is opened."""
+    for year in _years:
+        db.detach(_schema(year))
+    _years.clear()
+    for model, _ in PARTITIONED:
+        remove_history_store(model, _stores[model])
+        remove_history_source(model, _sources[model])
+    if not db.database or db.database == ":memory:":
+        return
+    stem, extension = os.path.splitext(db.database)
+    pattern = re.compile(re.escape(stem) + r"_(\d{4})" + re.escape(extension) + "$")
+    for path in glob.glob(f"{glob.escape(stem)}_[0-9][0-9][0-9][0-9]{extension}"):
+        match = pattern.match(path)
+        if match:
+            _attach(int(match.group(1)))
+    if _years:
+        log.debug(f"Attached {len(_years)} history partitions from {_years[0]} to {_years[-1]}.")
+
+
+def _create_partition_tables(year):
+    schema = _schema(year)
+    for model, keys in PARTITIONED:
+        table = model._meta.table_name
+        columns = ", ".join(
+            f'"{name}" {type}{" PRIMARY KEY" if pk else ""}' for _, name, type, _, _, pk in db.execute_sql(f'PRAGMA main.table_info("{table}")')
+        )
+        db.execute_sql(f'CREATE TABLE IF NOT EXISTS "{schema}"."{table}" ({columns})')
+        db.execute_sql(f'CREATE UNIQUE INDEX IF NOT EXISTS "{schema}"."{table}_keys" ON "{table}" ({", ".join(keys)}, timestamp)')
+
+
+def archive(before_year, vacuum=False):
+    """Move Price, Balance and Position rows older than `before_year` out of the hot database into yearly partitions.
+
+    The most recent row of each series stays in the hot file so current state can still be rebuilt from it.
+    New rows keep going to the hot file. Returns the number of rows moved.
+    """
+    try:
+        cutoff = _year_start(before_year)
+        oldest = [model.select(model.timestamp).where(model.timestamp < cutoff).order_by(model.timestamp).scalar() for model, _ in PARTITIONED]
+        oldest = [timestamp for timestamp in oldest if timestamp is not None]
+        if not oldest:
+            return 0
+
+        moved = 0
+        for year in range(_year_of(min(oldest)), before_year):
+            # ATTACH is not allowed inside a transaction
+            _attach(year)
+            with db.atomic():
+                _create_partition_tables(year)
+                for model, keys in PARTITIONED:
+                    table = model._meta.table_name
+                    where_clause = (
+                        f"timestamp >= {_year_start(year)} AND timestamp < {_year_start(year + 1)} "
+                        f"AND id NOT IN (SELECT id FROM ({_latest_rows_sql(table, keys)}))"
+                    )
+                    db.execute_sql(f'INSERT OR REPLACE INTO "{_schema(year)}"."{table}" SELECT * FROM main."{table}" WHERE {where_clause}')
+                    moved += db.execute_sql(f'DELETE FROM main."{table}" WHERE {where_clause}').rowcount
+            log.debug(f"Archived {year} history to {get_partition_path(year)}.")
+        if vacuum:
+            db.execute_sql("VACUUM main")
+        log.info(f"Archived {moved} history rows from before {before_year}.")
+        return moved
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to archive history from before {before_year}: {type(e).__name__} : {e}")
+        raise e
+
+
+def _get_years(from_timestamp, to_timestamp):
+    # Years of the attached partitions that may hold rows between the timestamps, ascending
+    return [
+        year for year in _years if (not to_timestamp or year <= _year_of(to_timestamp)) and (not from_timestamp or year >= _year_of(from_timestamp))
+    ]
+
+
+def _get_archived(model, keys, from_timestamp, to_timestamp):
+    if db.route and not model.reference:
+        # The partitions hold the opened database's history, a portfolio shard's history is not partitioned
+        return None
+    # Only the partitions of the years between from_timestamp and to_timestamp, most recent first
+    years = _get_years(from_timestamp, to_timestamp)[::-1]
+    if not years:
+        return None
+    table = model._meta.table_name
+    where_clause = " AND ".join(f"{key}_id = ?" for key in keys)
+    params = [keys[key].id for key in keys]
+    if from_timestamp:
+        where_clause += f" AND timestamp >= {int(from_timestamp)}"
+    if to_timestamp:
+        where_clause += f" AND timestamp <= {int(to_timestamp)}"
+    for year in years:
+        cursor = db.execute_sql(f'SELECT * FROM "{_schema(year)}"."{table}" WHERE {where_clause} ORDER BY timestamp DESC LIMIT 1', params)
+        row = cursor.fetchone()
+        if row:
+            return model(**dict(zip([column[0] for column in cursor.description], row, strict=True)))
+    return None
+
+
+def _get_partition_model(model, year):
+    # The model's fields bound to the table in the year's partition
+    name = f"{model.__name__}{year}"
+    if name not in _partition_models:
+        meta = type("Meta", (), {"schema": _schema(year), "table_name": model._meta.table_name})
+        _partition_models[name] = type(name, (model,), {"Meta": meta, "__module__": __name__})
+    return _partition_models[name]
+
+
+def _get_partition_models(model, from_timestamp, to_timestamp):
+    if db.route and not model.reference:
+        # As for _get_archived, a portfolio shard's history is not partitioned
+        return []
+    return [_get_partition_model(model, year) for year in _get_years(from_timestamp, to_timestamp)]
+
+
+_stores = {model: partial(_get_archived, model) for model, _ in PARTITIONED}
+_sources = {model: partial(_get_partition_models, model) for model, _ in PARTITIONED}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move history older than a year out of an alfa database into yearly partitions.")
+    parser.add_argument("path", help="Database file")
+    parser.add_argument("before_year", type=int, help="Archive rows older than January 1st of this year (UTC)")
+    parser.add_argument("--vacuum", action="store_true", help="Reclaim the space freed in the database file")
+    args = parser.parse_args()
+
+    open_db(args.path).connect()
+    try:
+        print(f"Archived {archive(args.before_year, args.vacuum)} rows.")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
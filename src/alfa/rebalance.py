@@ -0,0 +1,215 @@
+import logging
+import uuid
+from collections import namedtuple
+
+import numpy as np
+from peewee import fn
+
+from alfa.db import (
+    Account,
+    CurrentBalance,
+    CurrentPosition,
+    Price,
+    Stock,
+    TransactionType,
+    _as_validated_symbol,
+    _get_latest_stored,
+    _get_stock,
+    db,
+    strtimestamp,
+)
+from alfa.runner import LedgerBatch
+
+
+log = logging.getLogger("alfa")
+
+
+# Shares are traded in multiples of `lot_size`, `cash_buffer` is the fraction of each account's value kept in cash,
+# trades worth less than `min_trade_value` are skipped unless they close a position and `fees` are charged per trade
+Constraints = namedtuple("Constraints", ["lot_size", "cash_buffer", "min_trade_value", "fees"], defaults=(1, 0.0, 0.0, 0.0))
+
+Trade = namedtuple("Trade", ["account", "symbol", "type", "quantity", "price", "fees", "external_id"])
+
+
+def _load_prices(stocks, as_of):
+    # Close of each stock's latest bar up to as_of: the price table in one query, then the packed and archived bars
+    latest = (
+        Price.select(Price.stock, fn.MAX(Price.timestamp).alias("timestamp"))
+        .where(Price.stock.in_([stock.id for stock in stocks]) & (Price.timestamp <= as_of))
+        .group_by(Price.stock)
+        .alias("latest")
+    )
+    rows = {
+        price.stock_id: price
+        for price in Price.select().join(latest, on=(Price.stock == latest.c.stock_id) & (Price.timestamp == latest.c.timestamp))
+    }
+    closes = {}
+    for stock in stocks:
+        price = _get_latest_stored(Price, {"stock": stock}, rows.get(stock.id), None, as_of)
+        if price:
+            closes[stock.id] = price.close
+    return closes
+
+
+def _check_as_of(account_ids, as_of):
+    # Plans start from the current balances and positions, which a past as_of would contradict
+    latest = max(
+        CurrentBalance.select(fn.MAX(CurrentBalance.timestamp)).where(CurrentBalance.account.in_(account_ids)).scalar() or 0,
+        CurrentPosition.select(fn.MAX(CurrentPosition.timestamp)).where(CurrentPosition.account.in_(account_ids)).scalar() or 0,
+    )
+    if as_of < latest:
+        raise ValueError(f"Cannot rebalance at {strtimestamp(as_of)}, before the accounts' latest update at {strtimestamp(latest)}.")
+
+
+def plan_rebalance(accounts, targets, as_of, constraints=None):
+    """Trades bringing each account to the `targets` weights, a symbol to weight mapping, at the closes up to `as_of`.
+
+    Holdings outside `targets` are sold. Sells come first; buys are scaled down per account to the cash available
+    after the sells and the fees.
+    """
+    constraints = constraints or Constraints()
+    accounts = list(accounts)
+    if not accounts:
+        return []
+    if any(weight < 0 for weight in targets.values()) or sum(targets.values()) > 1.0 + 1e-9:
+        raise ValueError("Target weights must be non-negative and add up to at most 1.")
+    if constraints.lot_size < 1 or not 0.0 <= constraints.cash_buffer < 1.0:
+        raise ValueError(f"Invalid rebalance constraints {constraints}.")
+
+    account_ids = [account.id for account in accounts]
+    _check_as_of(account_ids, as_of)
+
+    targets = {_as_validated_symbol(symbol): weight for symbol, weight in targets.items()}
+    symbols = {}
+    for symbol in targets:
+        stock = _get_stock(symbol)
+        if not stock:
+            raise ValueError(f"Stock {symbol} does not exist in the database.")
+        symbols[stock.id] = stock.symbol
+
+    rows = {account.id: i for i, account in enumerate(accounts)}
+    cash = np.zeros(len(accounts))
+    for account_id, balance in (
+        CurrentBalance.select(CurrentBalance.account, CurrentBalance.cash).where(CurrentBalance.account.in_(account_ids)).tuples()
+    ):
+        cash[rows[account_id]] = balance
+    holdings = list(
+        CurrentPosition.select(CurrentPosition.account, CurrentPosition.stock, Stock.symbol, CurrentPosition.size, CurrentPosition.average_price)
+        .join(Stock)
+        .where(CurrentPosition.account.in_(account_ids) & (CurrentPosition.size > 0))
+        .tuples()
+    )
+    for _, stock_id, symbol, _, _ in holdings:
+        symbols.setdefault(stock_id, symbol)
+
+    stock_ids = list(symbols)
+    columns = {stock_id: j for j, stock_id in enumerate(stock_ids)}
+    sizes = np.zeros((len(accounts), len(stock_ids)))
+    for account_id, stock_id, _, size, _ in holdings:
+        sizes[rows[account_id], columns[stock_id]] = size
+
+    closes = _load_prices([_get_stock(symbols[stock_id]) for stock_id in stock_ids], as_of)
+    missing = [symbols[stock_id] for stock_id in stock_ids if stock_id not in closes]
+    if missing:
+        raise ValueError(f"No price for {', '.join(missing)} at {strtimestamp(as_of)}.")
+    prices = np.array([closes[stock_id] for stock_id in stock_ids])
+    weights = np.array([targets.get(symbols[stock_id], 0.0) for stock_id in stock_ids])
+
+    lot = constraints.lot_size
+    value = cash + sizes @ prices
+    targeted = np.floor(np.outer(value * (1.0 - constraints.cash_buffer), weights) / prices / lot) * lot
+    delta = targeted - sizes
+    # Small trades are skipped, except the sells closing a position
+    small = np.abs(delta) * prices < constraints.min_trade_value
+    delta[small & (targeted > 0)] = 0.0
+
+    sells = np.minimum(delta, 0.0)
+    buys = np.maximum(delta, 0.0)
+    trades = (delta != 0).sum(axis=1)
+    available = cash - sells @ prices - trades * constraints.fees
+    cost = buys @ prices
+    scale = np.divide(available, cost, out=np.ones(len(accounts)), where=cost > available)
+    buys = np.floor(buys * np.clip(scale, 0.0, 1.0)[:, None] / lot) * lot
+
+    plan = []
+    for quantities, type in ((-sells, TransactionType.SELL), (buys, TransactionType.BUY)):
+        for i, j in zip(*np.nonzero(quantities), strict=True):
+            plan.append(Trade(accounts[i], symbols[stock_ids[j]], type.value, int(quantities[i, j]), float(prices[j]), constraints.fees, None))
+    log.debug("Planned %s trades in %s accounts.", len(plan), len(accounts))
+    return plan
+
+
+def execute_plan(plan, as_of, batch_size=500):
+    """Write the trades of `plan` at `as_of`, with the watchlist updates, in one transaction, in order. Returns the trades with their external ids."""
+    if not plan:
+        return []
+    account_ids = list({trade.account.id for trade in plan})
+    _check_as_of(account_ids, as_of)
+    cash = dict(CurrentBalance.select(CurrentBalance.account, CurrentBalance.cash).where(CurrentBalance.account.in_(account_ids)).tuples())
+    positions = {
+        (account_id, stock_id): [size, average_price]
+        for account_id, stock_id, size, average_price in CurrentPosition.select(
+            CurrentPosition.account, CurrentPosition.stock, CurrentPosition.size, CurrentPosition.average_price
+        )
+        .where(CurrentPosition.account.in_(account_ids))
+        .tuples()
+    }
+
+    run_id = uuid.uuid4().hex[:12]
+    batch = LedgerBatch()
+    executed = []
+    # Portfolio id -> (portfolio, {symbol: {(account id, stock id)}}) of the symbols traded, to update the watchlists
+    traded = {}
+    for trade in plan:
+        account_id, stock_id = trade.account.id, _get_stock(trade.symbol).id
+        portfolio = trade.account.portfolio
+        traded.setdefault(portfolio.id, (portfolio, {}))[1].setdefault(trade.symbol, set()).add((account_id, stock_id))
+        size, average_price = positions.setdefault((account_id, stock_id), [0, 0.0])
+        if trade.type == TransactionType.BUY.value:
+            cash[account_id] = cash.get(account_id, 0.0) - trade.quantity * trade.price - trade.fees
+            average_price = (average_price * size + trade.price * trade.quantity) / (size + trade.quantity)
+            size += trade.quantity
+        else:
+            if trade.quantity > size:
+                raise ValueError(f"Cannot sell {trade.quantity} shares of {trade.symbol}; only {size} available.")
+            cash[account_id] = cash.get(account_id, 0.0) + trade.quantity * trade.price - trade.fees
+            size -= trade.quantity
+            average_price = average_price if size else 0.0
+        if cash[account_id] < 0:
+            raise ValueError(f"Account {trade.account.name} does not have sufficient cash to buy {trade.quantity} shares of {trade.symbol}.")
+        positions[(account_id, stock_id)] = [size, average_price]
+
+        trade = trade._replace(external_id=f"{run_id}-{len(executed) + 1}")
+        batch.add_transaction(trade.external_id, account_id, as_of, trade.type, stock_id, trade.fees, trade.quantity, trade.price)
+        batch.set_balance(account_id, as_of, cash[account_id])
+        batch.set_position(account_id, stock_id, as_of, size, average_price, trade.price if size else 0.0)
+        executed.append(trade)
+
+    with db.atomic():
+        batch.flush(batch_size)
+        # As Account.buy and Account.sell do, watch the symbols held and stop watching the liquidated ones
+        for portfolio, symbols in traded.values():
+            for symbol, keys in sorted(symbols.items()):
+                if any(positions[key][0] for key in keys):
+                    portfolio.start_watching(symbol)
+                else:
+                    portfolio.stop_watching(symbol)
+    return executed
+
+
+def rebalance(portfolio, targets, as_of, constraints=None, dry_run=False):
+    """Rebalance every account of `portfolio` to the `targets` weights at `as_of`, see `plan_rebalance`.
+
+    Returns the planned trades; unless `dry_run`, they are also executed, sells first, in one batched write.
+    """
+    try:
+        log.info("Rebalancing portfolio %s at %s.", portfolio.name, strtimestamp(as_of))
+        plan = plan_rebalance(Account.select().where(Account.portfolio == portfolio), targets, as_of, constraints)
+        if dry_run:
+            return plan
+        plan = execute_plan(plan, as_of)
+        log.info("Executed %s rebalancing trades in portfolio %s.", len(plan), portfolio.name)
+        return plan
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to rebalance portfolio {portfolio.name}: {type(e).__name__} : {e}")
+        raise e
@@ -0,0 +1,190 @@
+import logging
+from collections import namedtuple
+from functools import reduce
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from alfa.blocks import read_prices
+from alfa.cache import MISSING, get_cache
+from alfa.calendar import Exchange, get_calendar
+from alfa.db import CurrentPosition, Position, Stock, _as_validated_symbol, _get_stock, add_price_listener, get_history_models
+
+
+log = logging.getLogger("alfa")
+
+
+TRADING_DAYS = 252
+
+Returns = namedtuple("Returns", ["timestamps", "symbols", "returns"])
+PortfolioRisk = namedtuple(
+    "PortfolioRisk", ["timestamps", "volatility", "value_at_risk", "max_drawdown", "beta", "symbols", "weights", "correlation"]
+)
+
+# Adjusted closes of a stock, one per session: the close timestamps, the closes and the timestamp of the last bar read
+_Series = namedtuple("_Series", ["eods", "closes", "last_timestamp"])
+
+# Series keyed by (stock id, exchange), extended with the bars added since they were read
+_series = get_cache("risk_series", 1024)
+# Returns matrices keyed by (stock ids, exchange), with the series they were built from
+_matrices = get_cache("risk_returns", 64)
+
+
+def _last_per_session(eods, closes):
+    # The last bar of each session, eods being sorted
+    last = np.append(eods[1:] != eods[:-1], True)
+    return eods[last], closes[last]
+
+
+def _get_series(stock, exchange):
+    key = (stock.id, exchange)
+    series = _series.get(key)
+    last_timestamp = series.last_timestamp if series is not MISSING else None
+
+    # Packed and archived bars included
+    bars = read_prices(stock, None if last_timestamp is None else last_timestamp + 1)
+    if not len(bars):
+        if series is MISSING:
+            series = _Series(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), None)
+            _series.put(key, series)
+        return series
+
+    timestamps = bars["timestamp"]
+    eods = get_calendar(exchange).get_eod_timestamps(timestamps)
+    # Bars before the first session of the calendar are left out
+    closes = bars["adjusted_close"][eods >= 0]
+    eods = eods[eods >= 0]
+    if series is not MISSING:
+        # A new bar in the last session read replaces its close
+        eods = np.concatenate((series.eods, eods))
+        closes = np.concatenate((series.closes, closes))
+    eods, closes = _last_per_session(eods, closes)
+    series = _Series(eods, closes, int(timestamps[-1]))
+    _series.put(key, series)
+    log.debug("Read %s bars of %s up to %s.", len(timestamps), stock.symbol, series.last_timestamp)
+    return series
+
+
+def _on_prices_added(stock, first_timestamp, last_timestamp):
+    # Bars appended after the ones read are picked up incrementally, revised bars need the series to be read again
+    for exchange in Exchange:
+        series = _series.peek((stock.id, exchange))
+        if series is not MISSING and series.last_timestamp is not None and first_timestamp <= series.last_timestamp:
+            _series.discard((stock.id, exchange))
+
+
+add_price_listener(_on_prices_added)
+
+
+def get_returns(symbols, to_timestamp=None, exchange=None):
+    """Daily simple returns of the adjusted closes of `symbols`, one column each, over the sessions they all traded.
+
+    Returns are taken between consecutive common sessions up to the last one closed by `to_timestamp`.
+    """
+    try:
+        stocks = []
+        for symbol in symbols:
+            stock = _get_stock(_as_validated_symbol(symbol))
+            if not stock:
+                raise ValueError(f"Stock {symbol} does not exist in the database.")
+            stocks.append(stock)
+
+        exchange = get_calendar(exchange).exchange
+        key = (tuple(stock.id for stock in stocks), exchange)
+        series = tuple(_get_series(stock, exchange) for stock in stocks)
+        cached = _matrices.get(key)
+        if cached is not MISSING and all(a is b for a, b in zip(cached[0], series, strict=True)):
+            eods, returns = cached[1], cached[2]
+        else:
+            eods = reduce(np.intersect1d, [s.eods for s in series]) if series else np.empty(0, dtype=np.int64)
+            closes = np.column_stack([s.closes[np.searchsorted(s.eods, eods)] for s in series]) if series else np.empty((0, 0))
+            returns = closes[1:] / closes[:-1] - 1.0
+            eods = eods[1:]
+            _matrices.put(key, (series, eods, returns))
+
+        if to_timestamp:
+            count = np.searchsorted(eods, to_timestamp, side="right")
+            eods, returns = eods[:count], returns[:count]
+        return Returns(eods, [stock.symbol for stock in stocks], returns)
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to get returns of {symbols}: {type(e).__name__} : {e}")
+        raise e
+
+
+def get_holdings(account, to_timestamp=None):
+    """Symbols and market values of the account's open positions at `to_timestamp`, or now."""
+    if to_timestamp:
+        # Archived years included, a position opened in one may have no hot row up to to_timestamp
+        held = {
+            symbol
+            for model in get_history_models(Position, None, to_timestamp)
+            for (symbol,) in Stock.select(Stock.symbol)
+            .join(model, on=model.stock == Stock.id)
+            .where((model.account == account) & (model.timestamp <= to_timestamp))
+            .distinct()
+            .tuples()
+        }
+    else:
+        held = {
+            symbol
+            for (symbol,) in Stock.select(Stock.symbol)
+            .join(CurrentPosition, on=CurrentPosition.stock == Stock.id)
+            .where(CurrentPosition.account == account)
+            .tuples()
+        }
+    symbols, values = [], []
+    for symbol in sorted(held):
+        position = account.get_position(symbol, to_timestamp)
+        if position:
+            symbols.append(symbol)
+            values.append(position.size * position.market_price)
+    return symbols, np.array(values, dtype=np.float64)
+
+
+def _rolling_max_drawdown(returns, window):
+    # Each window starts from the wealth before its first return
+    wealth = sliding_window_view(np.concatenate(([1.0], np.cumprod(1.0 + returns))), window + 1)
+    return (wealth / np.maximum.accumulate(wealth, axis=1) - 1.0).min(axis=1)
+
+
+def get_risk(account, window=63, benchmark=None, confidence=0.95, to_timestamp=None):
+    """Risk of the account's current holdings over rolling windows of `window` daily returns.
+
+    The holdings are weighted by market value and applied to the past returns. For each window ending on a session,
+    returns the annualized volatility, the historical value at risk at `confidence` as a positive fraction of the
+    holdings, the maximum drawdown and the beta to `benchmark` (NaN without one). The correlation matrix of the
+    holdings is over the last window.
+    """
+    try:
+        if window < 2:
+            raise ValueError("Risk window must be at least 2 returns.")
+        symbols, values = get_holdings(account, to_timestamp)
+        empty = np.empty(0, dtype=np.float64)
+        if not symbols or values.sum() <= 0:
+            log.debug("Account %s has no holdings.", account.name)
+            return PortfolioRisk(np.empty(0, dtype=np.int64), empty, empty, empty, empty, symbols, values, np.empty((0, 0)))
+        weights = values / values.sum()
+
+        returns = get_returns(symbols + ([benchmark] if benchmark else []), to_timestamp, account.exchange)
+        portfolio = returns.returns[:, : len(symbols)] @ weights
+        if len(portfolio) < window:
+            raise ValueError(f"Only {len(portfolio)} common daily returns for a {window} returns window.")
+
+        windows = sliding_window_view(portfolio, window)
+        volatility = windows.std(axis=1, ddof=1) * np.sqrt(TRADING_DAYS)
+        value_at_risk = -np.quantile(windows, 1.0 - confidence, axis=1)
+        max_drawdown = _rolling_max_drawdown(portfolio, window)
+        if benchmark:
+            market = sliding_window_view(returns.returns[:, -1], window)
+            market_deviations = market - market.mean(axis=1, keepdims=True)
+            covariance = ((windows - windows.mean(axis=1, keepdims=True)) * market_deviations).sum(axis=1)
+            variance = (market_deviations**2).sum(axis=1)
+            beta = np.divide(covariance, variance, out=np.full(len(variance), np.nan), where=variance > 0)
+        else:
+            beta = np.full(len(windows), np.nan)
+        correlation = np.corrcoef(returns.returns[-window:, : len(symbols)], rowvar=False).reshape(len(symbols), len(symbols))
+
+        return PortfolioRisk(returns.timestamps[window - 1 :], volatility, value_at_risk, max_drawdown, beta, symbols, weights, correlation)
+    except Exception as e:  # pragma: no cover
+        log.error(f"Failed to get risk of account {account.name}: {type(e).__name__} : {e}")
+        raise e
@@ -0,0 +1,315 @@
+import logging
+import uuid
+from collections import namedtuple
+from enum import Enum
+from time import perf_counter
+
+from peewee import Tuple
+
+from alfa.calendar import get_calendar
+from alfa.db import (
+    Balance,
+    Position,
+    Price,
+    TransactionLedger,
+    TransactionType,
+    _as_validated_symbol,
+    _get_symbol,
+    _LazyTimestamp,
+    _notify_transaction,
+    _publish,
+    db,
+    strtimestamp,
+)
+from alfa.feed import EventType, feed
+
+
+log = logging.getLogger("alfa")
+
+
+Bar = namedtuple("Bar", ["symbol", "timestamp", "open", "high", "low", "close", "adjusted_close", "volume"])
+
+RunStats = namedtuple("RunStats", ["bars", "orders", "flushes", "seconds", "bars_per_second"])
+
+
+class FlushType(Enum):
+    BAR = "BAR"
+    DAY = "DAY"
+
+
+class LedgerBatch:
+    """Transaction, balance and position rows accumulated in memory and written in one transaction.
+
+    Balances and positions are keyed like their unique indexes, so several trades in an account at the
+    same timestamp collapse into the last state instead of colliding.
+    """
+
+    def __init__(self):
+        self.transactions = []
+        self.balances = {}
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.transactions) + len(self.balances) + len(self.positions)
+
+    def add_transaction(self, external_id, account_id, timestamp, type, stock_id, fees, quantity, price):
+        self.transactions.append(
+            {
+                "external_id": external_id,
+                "account": account_id,
+                "timestamp": timestamp,
+                "stock": stock_id,
+                "quantity": quantity,
+                "price": price,
+                "type": type,
+                "fees": fees,
+            }
+        )
+
+    def set_balance(self, account_id, timestamp, cash):
+        self.balances[(account_id, timestamp)] = {"account": account_id, "timestamp": timestamp, "cash": cash}
+
+    def set_position(self, account_id, stock_id, timestamp, size, average_price, market_price):
+        self.positions[(account_id, stock_id, timestamp)] = {
+            "account": account_id,
+            "stock": stock_id,
+            "timestamp": timestamp,
+            "size": size,
+            "average_price": average_price,
+            "market_price": market_price,
+        }
+
+    def flush(self, batch_size=500):
+        if not self:
+            return 0
+
+        rows = len(self)
+        with db.atomic():
+            for i in range(0, len(self.transactions), batch_size):
+                TransactionLedger.insert_many(self.transactions[i : i + batch_size]).execute()
+            for transaction in self.transactions:
+                _notify_transaction(TransactionLedger(**transaction))
+            balances = list(self.balances.values())
+            for i in range(0, len(balances), batch_size):
+                Balance.insert_many(balances[i : i + batch_size]).on_conflict_replace().execute()
+            positions = list(self.positions.values())
+            for i in range(0, len(positions), batch_size):
+                Position.insert_many(positions[i : i + batch_size]).on_conflict_replace().execute()
+            if feed.active:
+                for row in balances:
+                    _publish(EventType.BALANCE, row["account"], None, row["timestamp"], cash=row["cash"])
+                for row in positions:
+                    values = {name: row[name] for name in ("size", "average_price", "market_price")}
+                    _publish(EventType.POSITION, row["account"], _get_symbol(row["stock"]), row["timestamp"], **values)
+
+        self.transactions.clear()
+        self.balances.clear()
+        self.positions.clear()
+        return rows
+
+
+class _AccountState:
+    __slots__ = ("account", "cash", "positions")
+
+    def __init__(self, account):
+        self.account = account
+        self.cash = account.get_cash()
+        self.positions = {}
+
+    def get_position(self, symbol):
+        # [size, average_price], loaded from the database the first time the symbol is traded
+        if symbol not in self.positions:
+            position = self.account.get_position(symbol)
+            self.positions[symbol] = [position.size, position.average_price] if position else [0, 0.0]
+        return self.positions[symbol]
+
+
+class Runner:
+    """Streams the portfolio's watchlist bars in timestamp order and dispatches them to strategies.
+
+    A strategy is either a callable or an object with an `on_bar` method, both taking (runner, bar); objects may
+    also define `on_start(runner)` and `on_end(runner)`. Strategies trade through `buy` and `sell`, which execute
+    against in-memory account state at the current bar's timestamp. The resulting ledger, balance and position
+    rows are written once per bar or once per day, depending on `flush_type`.
+    """
+
+    def __init__(self, portfolio, strategies, from_timestamp=None, to_timestamp=None, flush_type=FlushType.DAY, page_size=5000):
+        self.portfolio = portfolio
+        self.strategies = list(strategies)
+        self.from_timestamp = from_timestamp
+        self.to_timestamp = to_timestamp
+        self.flush_type = flush_type
+        self.page_size = page_size
+
+        self.timestamp = None
+        self.bars = {}  # Most recent bar per symbol
+        self._run_id = uuid.uuid4().hex[:12]
+        self._orders = 0
+        self._flushes = 0
+        self._accounts = {}
+        self._stock_ids = {}
+        self._liquidated = set()
+        self._batch = LedgerBatch()
+
+    def _stream(self):
+        symbols = {stock_id: symbol for symbol, stock_id in self._stock_ids.items()}
+        last = None
+        while True:
+            where_clause = Price.stock.in_(list(symbols))
+            if self.from_timestamp:
+                where_clause &= Price.timestamp >= self.from_timestamp
+            if self.to_timestamp:
+                where_clause &= Price.timestamp <= self.to_timestamp
+            if last:
+                where_clause &= Tuple(Price.timestamp, Price.stock) > Tuple(*last)
+            rows = list(
+                Price.select(Price.timestamp, Price.stock, Price.open, Price.high, Price.low, Price.close, Price.adjusted_close, Price.volume)
+                .where(where_clause)
+                .order_by(Price.timestamp, Price.stock)
+                .limit(self.page_size)
+                .tuples()
+            )
+            if not rows:
+                return
+            for timestamp, stock_id, *values in rows:
+                yield Bar(symbols[stock_id], timestamp, *values)
+            last = rows[-1][:2]
+
+    def _dispatch(self, bar):
+        for strategy in self.strategies:
+            on_bar = getattr(strategy, "on_bar", strategy)
+            on_bar(self, bar)
+
+    def _flush(self):
+        rows = self._batch.flush()
+        if rows:
+            self._flushes += 1
+            log.debug("Flushed %s rows at %s.", rows, _LazyTimestamp(self.timestamp))
+        for symbol in self._liquidated:
+            self.portfolio.stop_watching(symbol)
+        self._liquidated.clear()
+
+    def run(self):
+        try:
+            log.info(f"Running {len(self.strategies)} strategies on portfolio {self.portfolio.name}.")
+            start = perf_counter()
+
+            self._stock_ids = {stock.symbol: stock.id for stock in self.portfolio.get_watchlist()}
+            for strategy in self.strategies:
+                if hasattr(strategy, "on_start"):
+                    strategy.on_start(self)
+
+            # A day ends when the trading day of any of the accounts' exchanges does
+            calendars = [get_calendar(exchange) for exchange in sorted({account.exchange for account in self.portfolio.get_accounts()})]
+            calendars = calendars or [get_calendar()]
+            bars = 0
+            day = None
+            for bar in self._stream():
+                if bar.timestamp != self.timestamp:
+                    bar_day = tuple(calendar.get_session_day(bar.timestamp) for calendar in calendars)
+                    if self.timestamp is not None and (self.flush_type == FlushType.BAR or bar_day != day):
+                        self._flush()
+                    self.timestamp = bar.timestamp
+                    day = bar_day
+                self.bars[bar.symbol] = bar
+                self._dispatch(bar)
+                bars += 1
+
+            for strategy in self.strategies:
+                if hasattr(strategy, "on_end"):
+                    strategy.on_end(self)
+            self._flush()
+
+            seconds = perf_counter() - start
+            stats = RunStats(bars, self._orders, self._flushes, seconds, bars / seconds if seconds else 0.0)
+            log.info(f"Processed {stats.bars} bars and {stats.orders} orders in {stats.seconds:.2f}s ({stats.bars_per_second:.0f} bars/s).")
+            return stats
+        except Exception as e:  # pragma: no cover
+            log.error(f"Failed to run strategies on portfolio {self.portfolio.name}: {type(e).__name__} : {e}")
+            raise e
+
+    def _get_state(self, account):
+        if account.id not in self._accounts:
+            self._accounts[account.id] = _AccountState(account)
+        return self._accounts[account.id]
+
+    def _get_stock_id(self, symbol):
+        if symbol not in self._stock_ids:
+            # Trading a symbol outside the streamed watchlist adds it, as Account.buy does
+            self._stock_ids[symbol] = self.portfolio.start_watching(symbol).id
+        return self._stock_ids[symbol]
+
+    def _check_timestamp(self):
+        if self.timestamp is None:
+            raise ValueError("Orders can only be placed once the run has streamed a bar.")
+
+    def _get_order_price(self, symbol, price):
+        if price is not None:
+            return price
+        bar = self.bars.get(symbol)
+        if not bar:
+            raise ValueError(f"No price available for {symbol} at {strtimestamp(self.timestamp)}.")
+        return bar.close
+
+    def get_cash(self, account):
+        return self._get_state(account).cash
+
+    def get_position(self, account, symbol):
+        size, average_price = self._get_state(account).get_position(_as_validated_symbol(symbol))
+        return size, average_price
+
+    def buy(self, account, symbol, quantity, price=None, fees=0.0, external_id=None):
+        self._check_timestamp()
+        symbol = _as_validated_symbol(symbol)
+        if quantity <= 0:
+            raise ValueError(f"Cannot buy {quantity} shares of {symbol}.")
+
+        state = self._get_state(account)
+        price = self._get_order_price(symbol, price)
+        total_cost = quantity * price + fees
+        if state.cash < total_cost:
+            raise ValueError(f"Account {account.name} does not have sufficient cash to buy {quantity} shares of {symbol}.")
+
+        stock_id = self._get_stock_id(symbol)
+        position = state.get_position(symbol)
+        size, average_price = position
+        position[0] = size + quantity
+        position[1] = (average_price * size + price * quantity) / position[0]
+        state.cash -= total_cost
+        self._liquidated.discard(symbol)
+
+        self._orders += 1
+        external_id = external_id or f"{self._run_id}-{self._orders}"
+        self._batch.add_transaction(external_id, account.id, self.timestamp, TransactionType.BUY.value, stock_id, fees, quantity, price)
+        self._batch.set_balance(account.id, self.timestamp, state.cash)
+        self._batch.set_position(account.id, stock_id, self.timestamp, position[0], position[1], price)
+        return external_id
+
+    def sell(self, account, symbol, quantity, price=None, fees=0.0, external_id=None):
+        self._check_timestamp()
+        symbol = _as_validated_symbol(symbol)
+        if quantity <= 0:
+            raise ValueError(f"Cannot sell {quantity} shares of {symbol}.")
+
+        state = self._get_state(account)
+        position = state.get_position(symbol)
+        size, average_price = position
+        if not size:
+            raise ValueError(f"No active position in {symbol} to sell.")
+        if quantity > size:
+            raise ValueError(f"Request to sell {quantity} shares of {symbol} exceeds current position of {size} shares.")
+
+        price = self._get_order_price(symbol, price)
+        stock_id = self._get_stock_id(symbol)
+        position[0] = size - quantity
+        if position[0] == 0:
+            position[1] = 0.0
+            self._liquidated.add(symbol)
+        state.cash += quantity * price - fees
+
+        self._orders += 1
+        external_id = external_id or f"{self._run_id}-{self._orders}"
+        self._batch.add_transaction(external_id, account.id, self.timestamp, TransactionType.SELL.value, stock_id, fees, quantity, price)
+        self._batch.set_balance(account.id, self.timestamp, state.cash)
+        self._batch.set_position(account.id, stock_id, self.timestamp, position[0], position[1], price if position[0] else 0.0)
+        return external_id
@@ -0,0 +1,82 @@
+import glob
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+from peewee import ForeignKeyField, sort_models
+
+from alfa.db import BaseModel, Portfolio, db, get_schema_version
+
+
+log = logging.getLogger("alfa")
+
+
+class ShardRouter:
+    """Routes each portfolio to its own database file in `directory`, with reference data in the opened database.
+
+    Inside `routing(name)` the calling thread's queries run on the portfolio's file, which attaches the opened
+    database as `ref` for stocks and prices. Portfolios in different files write under different SQLite locks, so
+    threads, or processes that open the same reference database, trade them in parallel.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # Files whose per-portfolio tables this router created or found current
+        self._created = set()
+        self._lock = threading.Lock()
+
+    def get_path(self, name):
+        slug = re.sub(r"[^A-Za-z0-9_-]+", "_", name.strip()).strip("_").lower()
+        if not slug:
+            raise ValueError(f"Invalid portfolio name {name!r}.")
+        return os.path.join(self.directory, f"{slug}.db")
+
+    def get_names(self):
+        """Names of the shard files in the directory."""
+        return sorted(os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(glob.escape(self.directory), "*.db")))
+
+    @contextmanager
+    def routing(self, name):
+        path = self.get_path(name)
+        with db.routed(path):
+            self._create_tables(path)
+            yield path
+
+    def init_portfolio(self, name):
+        """Create the portfolio in its shard. Use the returned portfolio inside `routing(name)`."""
+        with self.routing(name):
+            return Portfolio.init(name)
+
+    def close(self):
+        """Close the calling thread's shard connections."""
+        db.close_routes()
+
+    def _create_tables(self, path):
+        with self._lock:
+            if path in self._created:
+                return
+            version = get_schema_version()
+            # Shards created by another process with the current schema need no DDL
+            if db.user_version == version:
+                self._created.add(path)
+                return
+            models = sort_models([model for model in BaseModel.get_models() if not model.reference])
+            # Foreign keys cannot reference tables in another database file, the references to stocks are not enforced
+            foreign_keys = [
+                field for model in models for field in model._meta.sorted_fields if isinstance(field, ForeignKeyField) and field.rel_model.reference
+            ]
+            try:
+                for field in foreign_keys:
+                    field.deferred = True
+                with db.atomic():
+                    for model in models:
+                        model.create_table()
+                    db.user_version = version
+            finally:
+                for field in foreign_keys:
+                    field.deferred = False
+            self._created.add(path)
+            log.debug(f"Created portfolio tables in {path}.")
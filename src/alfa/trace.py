@@ -0,0 +1,53 @@
+import time
+from collections import deque
+
+
+class Tracer:
+    """Ring buffers of the last operations per key, for diagnosing an account after the fact.
+
+    Disabled by default; callers check `enabled` before calling `record`, so tracing costs a single attribute read
+    until it is turned on. Records are kept as raw tuples and only turned into dictionaries by `dump`.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.size = 0
+        self._buffers = {}
+        # Field names of each operation's values
+        self._fields = {}
+
+    def enable(self, size=256):
+        if size <= 0:
+            raise ValueError("Trace size must be positive.")
+        if size != self.size:
+            self._buffers = {key: deque(buffer, maxlen=size) for key, buffer in self._buffers.items()}
+        self.size = size
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self._buffers.clear()
+
+    def register(self, operation, *fields):
+        self._fields[operation] = fields
+
+    def record(self, key, operation, *values):
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = self._buffers[key] = deque(maxlen=self.size)
+        buffer.append((time.time_ns(), operation, values))
+
+    def dump(self, key):
+        """Recorded operations for `key`, oldest first."""
+        records = []
+        for recorded_at, operation, values in self._buffers.get(key, ()):
+            fields = self._fields.get(operation) or [f"value{i}" for i in range(len(values))]
+            record = {"recorded_at": recorded_at, "operation": operation}
+            record.update(zip(fields, values, strict=False))
+            records.append(record)
+        return records
+
+
+tracer = Tracer()
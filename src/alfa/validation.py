@@ -0,0 +1,126 @@
+from collections import namedtuple
+from enum import Enum
+
+import numpy as np
+
+
+class Check(Enum):
+    INVALID_TIMESTAMP = "invalid timestamp"
+    NON_POSITIVE_PRICE = "non-positive price"
+    HIGH_BELOW_LOW = "high below low"
+    OUTSIDE_RANGE = "open or close outside the high-low range"
+    NEGATIVE_VOLUME = "negative volume"
+    DUPLICATE_TIMESTAMP = "duplicate timestamp"
+    OUT_OF_ORDER = "out of order timestamp"
+    PRICE_GAP = "price gap"
+    TIME_GAP = "time gap"
+
+
+class ValidationAction(Enum):
+    WARN = "WARN"  # Load everything loadable and log the violations
+    REJECT = "REJECT"  # Load nothing and raise
+    QUARANTINE = "QUARANTINE"  # Load the valid bars, set the invalid ones aside
+    REPAIR = "REPAIR"  # Fix what can be fixed, set the rest aside
+
+
+# Violations that REPAIR fixes: the high and low are widened to the open and close, duplicates keep the last bar
+# and the bars are sorted
+REPAIRABLE = frozenset((Check.HIGH_BELOW_LOW, Check.OUTSIDE_RANGE, Check.DUPLICATE_TIMESTAMP, Check.OUT_OF_ORDER))
+
+# Maximum relative move of the adjusted close and maximum milliseconds between consecutive bars, None to not check
+Rules = namedtuple("Rules", ["max_move", "max_interval"], defaults=(None, None))
+
+# The rows of each violated check, and whether each row violates any
+ValidationReport = namedtuple("ValidationReport", ["symbol", "count", "violations", "invalid"])
+
+_TIMESTAMP, _OPEN, _HIGH, _LOW, _CLOSE, _ADJUSTED_CLOSE, _VOLUME = range(7)
+
+
+def as_price_array(bars):
+    """Bars given as (timestamp, open, high, low, close, adjusted_close, volume) tuples as an (n, 7) float array."""
+    return np.asarray(bars, dtype=np.float64).reshape(-1, 7)
+
+
+def _duplicates(timestamps):
+    # All but the last bar of each timestamp, as inserting replaces earlier bars with later ones
+    order = np.argsort(timestamps, kind="stable")
+    ordered = timestamps[order]
+    duplicates = np.empty(len(timestamps), dtype=bool)
+    duplicates[order] = np.append(ordered[:-1] == ordered[1:], False)
+    return duplicates
+
+
+def _follows(mask):
+    # Flags the second bar of each flagged consecutive pair
+    return np.concatenate(([False], mask))
+
+
+def validate_prices(symbol, bars, rules=None):
+    """Check a batch of bars with array operations. `bars` is anything `as_price_array` accepts."""
+    rules = rules or Rules()
+    array = as_price_array(bars)
+    timestamps, high, low, volume = array[:, _TIMESTAMP], array[:, _HIGH], array[:, _LOW], array[:, _VOLUME]
+    prices = array[:, _OPEN:_VOLUME]
+    ends = array[:, (_OPEN, _CLOSE)]
+
+    checks = {
+        Check.INVALID_TIMESTAMP: ~(timestamps >= 0),
+        Check.NON_POSITIVE_PRICE: ~((prices > 0) & np.isfinite(prices)).all(axis=1),
+        Check.HIGH_BELOW_LOW: high < low,
+        Check.OUTSIDE_RANGE: ((ends > high[:, None]) | (ends < low[:, None])).any(axis=1),
+        Check.NEGATIVE_VOLUME: ~(volume >= 0),
+        Check.DUPLICATE_TIMESTAMP: _duplicates(timestamps),
+        Check.OUT_OF_ORDER: _follows(timestamps[1:] < timestamps[:-1]),
+    }
+    if rules.max_move is not None:
+        adjusted_close = array[:, _ADJUSTED_CLOSE]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            checks[Check.PRICE_GAP] = _follows(np.abs(adjusted_close[1:] / adjusted_close[:-1] - 1.0) > rules.max_move)
+    if rules.max_interval is not None:
+        checks[Check.TIME_GAP] = _follows(timestamps[1:] - timestamps[:-1] > rules.max_interval)
+
+    violations = {check: np.flatnonzero(mask) for check, mask in checks.items() if mask.any()}
+    invalid = np.zeros(len(array), dtype=bool)
+    for rows in violations.values():
+        invalid[rows] = True
+    return ValidationReport(symbol, len(array), violations, invalid)
+
+
+def describe(report):
+    return ", ".join(f"{len(rows)} {check.value}" for check, rows in report.violations.items())
+
+
+def get_reasons(report):
+    """The checks each bar violates, comma separated, as an object array; empty for valid bars."""
+    reasons = [[] for _ in range(report.count)]
+    for check, rows in report.violations.items():
+        for row in rows.tolist():
+            reasons[row].append(check.value)
+    result = np.empty(report.count, dtype=object)
+    result[:] = [", ".join(row) for row in reasons]
+    return result
+
+
+def repair_prices(bars, report):
+    """Repair the REPAIRABLE violations of `report`.
+
+    Returns the repaired bars sorted by timestamp, a mask of the ones still invalid and their rows in `bars`.
+    """
+    array = as_price_array(bars).copy()
+    unrepaired = np.zeros(len(array), dtype=bool)
+    for check, rows in report.violations.items():
+        if check not in REPAIRABLE:
+            unrepaired[rows] = True
+
+    widen = np.zeros(len(array), dtype=bool)
+    for check in (Check.HIGH_BELOW_LOW, Check.OUTSIDE_RANGE):
+        widen[report.violations.get(check, [])] = True
+    prices = array[widen][:, _OPEN:_ADJUSTED_CLOSE]
+    array[widen, _HIGH] = prices.max(axis=1)
+    array[widen, _LOW] = prices.min(axis=1)
+
+    keep = np.ones(len(array), dtype=bool)
+    keep[report.violations.get(Check.DUPLICATE_TIMESTAMP, [])] = False
+    rows = np.flatnonzero(keep)
+    rows = rows[np.argsort(array[rows, _TIMESTAMP], kind="stable")]
+    return array[rows], unrepaired[rows], rows
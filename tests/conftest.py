@@ -0,0 +1,20 @@
+import os
+
+import pytest
+
+from alfa.db import BaseModel, open_db
+
+
+db_path = "data/test.db"
+
+
+@pytest.fixture(scope="function")
+def test_db():
+    db = open_db(db_path)
+    db.connect()
+    db.create_tables(BaseModel.get_models())
+    yield db  # Provides the initialized database to the test
+    db.drop_tables(BaseModel.get_models())
+    db.close()
+    # Remove test database
+    os.remove(db_path)
@@ -0,0 +1,121 @@
+import os
+import sys
+
+import pytest
+
+from alfa.audit import AuditCheck, AuditMark, Divergence, audit, main
+from alfa.db import Balance, Portfolio, Position, Stock, strtimestamp
+from alfa.partitions import archive, get_partition_path, get_partition_years
+
+
+DAY = 86_400_000
+START = 1_700_000_000_000
+
+
+@pytest.fixture
+def accounts(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    portfolio.start_watching("MSFT")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", START, 1000.0, fees=1.0)
+    account.buy("buy1", START + DAY, "AAPL", 10, 10.0, fees=1.0)
+    account.sell("sell1", START + 2 * DAY, "AAPL", 4, 12.0, fees=1.0)
+    # Two trades at the same timestamp collapse into one balance and one position
+    account.buy("buy2", START + 3 * DAY, "AAPL", 4, 13.0)
+    account.buy("buy3", START + 3 * DAY, "AAPL", 2, 16.0)
+    account.deposit_in_kind("dik1", START + 4 * DAY, "MSFT", 5, 20.0)
+    other = portfolio.add_account("Other")
+    other.deposit("dep2", START, 500.0)
+    other.buy("buy4", START + DAY, "MSFT", 5, 20.0)
+    return account, other
+
+
+def test_clean_accounts_are_marked(accounts):
+    account, other = accounts
+    report = audit()
+    assert (report.accounts, report.incremental, report.divergences) == (2, 0, [])
+    mark = AuditMark.get(AuditMark.account == account)
+    assert mark.timestamp == START + 4 * DAY
+
+    # Later entries are audited from the marks
+    account.sell("sell2", START + 5 * DAY, "AAPL", 12, 15.0)
+    other.withdraw("wd1", START + 5 * DAY, 100.0, fees=1.0)
+    assert audit() == (2, 2, [])
+    assert AuditMark.get(AuditMark.account == account).timestamp == START + 5 * DAY
+
+
+def test_first_divergence_of_each_account(accounts):
+    account, other = accounts
+    Balance.update(cash=0.0).where((Balance.account == account) & (Balance.timestamp == START + 2 * DAY)).execute()
+    Balance.update(cash=1.0).where((Balance.account == account) & (Balance.timestamp == START + 3 * DAY)).execute()
+    msft = Stock.get(Stock.symbol == "MSFT")
+    Position.update(average_price=21.0).where((Position.account == other) & (Position.stock == msft)).execute()
+
+    report = audit()
+    assert report.divergences == [
+        Divergence(account.id, START + 2 * DAY, AuditCheck.CASH, None, pytest.approx(945.0), 0.0),
+        Divergence(other.id, START + DAY, AuditCheck.AVERAGE_PRICE, "MSFT", 20.0, 21.0),
+    ]
+    assert AuditMark.select().count() == 0
+
+
+def test_position_divergences(accounts):
+    account, other = accounts
+    aapl = Stock.get(Stock.symbol == "AAPL")
+    Position.update(size=7).where((Position.account == account) & (Position.stock == aapl) & (Position.timestamp == START + 3 * DAY)).execute()
+    # A position no trade explains
+    Position.create(account=other, stock=aapl, timestamp=START, size=1, average_price=1.0, market_price=1.0)
+
+    divergences = audit().divergences
+    assert divergences == [
+        Divergence(account.id, START + 3 * DAY, AuditCheck.SIZE, "AAPL", 12, 7),
+        Divergence(other.id, START, AuditCheck.SIZE, "AAPL", None, 1),
+    ]
+    assert audit(accounts=[other]).divergences == divergences[1:]
+
+
+def test_marks_skip_verified_history(accounts):
+    account, _ = accounts
+    audit()
+    # Corrupting verified history goes unnoticed until a full audit
+    Balance.update(cash=0.0).where((Balance.account == account) & (Balance.timestamp == START)).execute()
+    assert audit().divergences == []
+    assert audit(full=True).divergences[0].timestamp == START
+
+
+def test_backdated_entry_voids_mark(accounts):
+    account, _ = accounts
+    audit()
+    # Backdated, the deposit's balance is the current cash plus the deposit, not the cash at the time plus the deposit
+    account.deposit("dep3", START + DAY // 2, 100.0)
+    report = audit(accounts=[account])
+    assert (report.accounts, report.incremental) == (1, 0)
+    assert report.divergences == [Divergence(account.id, START + DAY // 2, AuditCheck.CASH, None, pytest.approx(1099.0), pytest.approx(961.0))]
+
+
+def test_archived_history_is_audited(test_db, accounts):
+    account, _ = accounts
+    try:
+        assert archive(2024) > 0
+        assert audit(full=True).divergences == []
+        test_db.execute_sql('UPDATE "p2023"."balance" SET cash = 0.0 WHERE account_id = ? AND timestamp = ?', [account.id, START])
+        assert audit(full=True).divergences == [Divergence(account.id, START, AuditCheck.CASH, None, pytest.approx(999.0), 0.0)]
+    finally:
+        for year in get_partition_years():
+            test_db.detach(f"p{year}")
+            os.remove(get_partition_path(year))
+
+
+def test_main(test_db, accounts, monkeypatch, capsys):
+    account, other = accounts
+    monkeypatch.setattr(sys, "argv", ["alfa.audit", test_db.database, "--account", str(other.id)])
+    assert main() == 0
+    assert capsys.readouterr().out == "Audited 1 accounts, 0 from their mark. 0 diverge.\n"
+
+    Balance.update(cash=0.0).where((Balance.account == account) & (Balance.timestamp == START + 2 * DAY)).execute()
+    monkeypatch.setattr(sys, "argv", ["alfa.audit", test_db.database, "--full"])
+    assert main() == 1
+    assert capsys.readouterr().out.splitlines() == [
+        f"Account {account.id}: cash diverges at {strtimestamp(START + 2 * DAY)}. Expected: 945.0. Actual: 0.0.",
+        "Audited 2 accounts, 0 from their mark. 1 diverge.",
+    ]
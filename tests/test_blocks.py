@@ -0,0 +1,101 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import alfa
+from alfa.blocks import PRICE_DTYPE, Compression, PriceBlock, decode, encode, pack_prices, read_prices, unpack_prices
+from alfa.db import Portfolio, Price, open_db
+
+
+db_path = "data/test.db"
+
+MINUTE = 60_000
+START = 1_704_067_200_000  # 2024-01-01 00:00 UTC
+
+
+def bars(count, start=START, step=MINUTE * 60):
+    return [(start + i * step, 10.0 + i, 11.0 + i, 9.0 + i, 10.5 + i, 10.4 + i, 100 * i) for i in range(count)]
+
+
+@pytest.fixture
+def stock(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    stock = portfolio.start_watching("AAPL")
+    # Hourly bars across January and February
+    stock.add_prices(bars(24 * 45))
+    return stock
+
+
+@pytest.mark.parametrize("compression", list(Compression))
+def test_encode_round_trip(compression):
+    expected = np.array(bars(100, step=MINUTE), dtype=PRICE_DTYPE)
+    data = encode(expected, compression)
+    assert len(data) < expected.nbytes
+    read = decode(data, len(expected), compression)
+    assert (read == expected).all()
+
+
+def test_pack_into_monthly_blocks(stock):
+    assert pack_prices(stock) == 24 * 45
+    assert Price.select().count() == 0
+    assert pack_prices(stock) == 0
+    assert [block.month for block in PriceBlock.select().order_by(PriceBlock.month)] == [202401, 202402]
+    assert sum(block.count for block in PriceBlock.select()) == 24 * 45
+
+    prices = read_prices(stock)
+    assert prices.tolist() == bars(24 * 45)
+    window = read_prices(stock, START + 30 * 24 * MINUTE * 60, START + 32 * 24 * MINUTE * 60)
+    assert window["timestamp"].tolist() == [START + i * MINUTE * 60 for i in range(30 * 24, 32 * 24 + 1)]
+
+
+def test_point_lookups_read_blocks(stock):
+    pack_prices(stock, to_timestamp=START + 40 * 24 * MINUTE * 60)
+    assert Price.select().count() == 24 * 5 - 1
+    # The most recent bar is still in the price table
+    assert stock.get_price().timestamp == START + (24 * 45 - 1) * MINUTE * 60
+    # A bar in a packed block
+    price = stock.get_price(START + 10 * 24 * MINUTE * 60 + 1)
+    assert (price.timestamp, price.close, price.volume) == (START + 10 * 24 * MINUTE * 60, 10.5 + 240, 24_000)
+    assert price.symbol == "AAPL"
+    assert stock.get_price(START - 1) is None
+
+    # The block of the month holds no bar of the day read
+    msft = Portfolio.init("Portfolio").start_watching("MSFT")
+    msft.add_prices(bars(2, step=20 * 24 * MINUTE * 60))
+    pack_prices(msft)
+    assert msft.get_price(START + 10 * 24 * MINUTE * 60) is None
+
+
+def test_repack_merges_new_bars(stock):
+    pack_prices(stock, compression=Compression.LZMA)
+    # A revised bar and a new one in January
+    stock.add_prices([(START, 1.0, 1.0, 1.0, 1.0, 1.0, 1), (START + 30, 2.0, 2.0, 2.0, 2.0, 2.0, 2)])
+    assert read_prices(stock, to_timestamp=START + MINUTE)["close"].tolist() == [1.0, 2.0]
+    pack_prices(stock)
+    january = PriceBlock.get(PriceBlock.month == 202401)
+    assert (january.count, january.compression) == (24 * 31 + 1, Compression.ZLIB.value)
+    assert read_prices(stock, to_timestamp=START + MINUTE)["close"].tolist() == [1.0, 2.0]
+
+
+def test_unpack_restores_rows(stock):
+    pack_prices(stock)
+    assert unpack_prices(stock) == 24 * 45
+    assert PriceBlock.select().count() == 0
+    assert Price.select().count() == 24 * 45
+    assert stock.get_price().volume == 100 * (24 * 45 - 1)
+
+
+def test_packed_prices_read_without_importing_blocks(stock):
+    pack_prices(stock)
+    stock._meta.database.close()
+    code = (
+        f"import sys; from alfa.db import Stock, open_db; open_db({db_path!r}).connect(); "
+        f"print(Stock.get(Stock.symbol == 'AAPL').get_price({START + 30 * 24 * MINUTE * 60}).close, 'alfa.blocks' in sys.modules)"
+    )
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(alfa.__file__)))
+    output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True).stdout.split()
+    assert output == [str(10.5 + 30 * 24), "True"]
+    open_db(db_path).connect()
@@ -0,0 +1,73 @@
+import pytest
+
+from alfa.cache import MISSING, CacheStats, LRUCache, get_cache, get_stats
+from alfa.db import Portfolio, db
+
+
+DAY = 86_400_000
+START = 1_700_000_000_000
+
+
+def test_lru_eviction_and_stats():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", None)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    cache.put("c", 3)  # Evicts "a", the least recently used
+    cache.put("c", 3)
+    assert cache.get("a") is MISSING
+    assert cache.get("a", 0) == 0
+    assert cache.stats == CacheStats(hits=2, misses=2, evictions=1, size=2, maxsize=2)
+    cache.discard_where(lambda key: key == "b")
+    cache.discard("c")
+    assert len(cache) == 0
+    cache.reset_stats()
+    assert cache.stats.hits == 0
+    with pytest.raises(ValueError):
+        LRUCache(0)
+
+
+def test_symbol_cache(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", START, 1000.0)
+    symbols = get_cache("symbol")
+    symbols.reset_stats()
+    account.buy("buy1", START + 1, "AAPL", 1, 10.0)
+    account.buy("buy2", START + 2, "AAPL", 1, 10.0)
+    assert symbols.stats.hits > symbols.stats.misses
+    assert account.get_position("aapl").size == 2
+    assert "symbol" in get_stats()
+
+
+def test_latest_price_cache_and_invalidation(test_db):
+    stock = Portfolio.init("Portfolio").start_watching("AAPL")
+    stock.add_prices([(START + i * DAY, 1.0, 1.0, 1.0, 1.0 + i, 1.0 + i, 10) for i in range(5)])
+    prices = get_cache("price")
+    prices.reset_stats()
+
+    assert stock.get_price().close == 5.0
+    assert stock.get_price().close == 5.0
+    at = START + 2 * DAY + 1
+    assert stock.get_price(at).close == 3.0
+    assert stock.get_price(at + 1).close == 3.0
+    assert prices.stats.hits == 2
+
+    # Earlier in the day than the cached bar, which is the day's only bar
+    assert stock.get_price(START + 2 * DAY - 1) is None
+
+    stock.add_price(START + 5 * DAY, 1.0, 1.0, 1.0, 6.0, 6.0, 10)
+    assert stock.get_price().close == 6.0
+    stock.add_prices([(START + 2 * DAY, 1.0, 1.0, 1.0, 30.0, 30.0, 10)])
+    assert stock.get_price(at).close == 30.0
+
+
+def test_rollback_clears_caches(test_db):
+    stock = Portfolio.init("Portfolio").start_watching("AAPL")
+    with pytest.raises(ZeroDivisionError):
+        with db.atomic():
+            stock.add_price(START, 1.0, 1.0, 1.0, 2.0, 2.0, 10)
+            assert stock.get_price().close == 2.0
+            1 / 0
+    assert stock.get_price() is None
@@ -0,0 +1,98 @@
+from datetime import date, datetime, time
+
+import numpy as np
+import pytest
+
+from alfa.calendar import Exchange, TradingCalendar, get_calendar
+from alfa.db import CurrencyType, Portfolio, get_eod_timestamp
+
+
+def at(calendar, day, hour, minute=0):
+    return int(datetime.combine(day, time(hour, minute), tzinfo=calendar.tz).timestamp() * 1000)
+
+
+def test_nyse_holidays_and_early_closes():
+    nyse = get_calendar(Exchange.NYSE)
+    weekdays = [date.fromordinal(d) for d in range(date(2024, 1, 1).toordinal(), date(2025, 1, 1).toordinal())]
+    holidays = [str(day) for day in weekdays if day.weekday() < 5 and not nyse.is_session(day)]
+    assert holidays == [
+        "2024-01-01",
+        "2024-01-15",
+        "2024-02-19",
+        "2024-03-29",
+        "2024-05-27",
+        "2024-06-19",
+        "2024-07-04",
+        "2024-09-02",
+        "2024-11-28",
+        "2024-12-25",
+    ]
+    assert not nyse.is_session(date(2012, 10, 29))
+    assert nyse.get_eod_timestamp(date(2024, 11, 29)) == at(nyse, date(2024, 11, 29), 13)
+    assert nyse.get_eod_timestamp(date(2024, 11, 27)) == at(nyse, date(2024, 11, 27), 16)
+
+
+def test_tsx_holidays():
+    tsx = get_calendar("TSX")
+    assert not tsx.is_session(date(2024, 5, 20))  # Victoria Day
+    assert not tsx.is_session(date(2024, 12, 26))  # Boxing Day
+    assert tsx.is_session(date(2024, 6, 19))
+    # Christmas on a Sunday closes Monday and Tuesday
+    assert not tsx.is_session(date(2022, 12, 26)) and not tsx.is_session(date(2022, 12, 27))
+
+
+def test_session_lookups():
+    nyse = get_calendar()
+    friday, saturday = date(2024, 3, 8), date(2024, 3, 9)
+    assert nyse.get_session(at(nyse, friday, 9, 29)) is None
+    assert nyse.get_session(at(nyse, friday, 9, 30)) == nyse.get_session(at(nyse, friday, 16))
+    assert nyse.get_session(at(nyse, saturday, 12)) is None
+    # The weekend belongs to Friday's trading day
+    assert nyse.get_day(at(nyse, saturday, 12)) == friday
+    assert nyse.get_day_start(at(nyse, saturday, 12)) == at(nyse, friday, 0)
+    assert nyse.get_eod_timestamp(saturday) == at(nyse, friday, 16)
+    # Sessions after the switch to daylight saving time open at 9:30 local time
+    assert nyse.opens[nyse.get_session(at(nyse, date(2024, 3, 11), 10))] == at(nyse, date(2024, 3, 11), 9, 30)
+    with pytest.raises(ValueError):
+        nyse.get_eod_timestamp(date(2100, 1, 4))
+    with pytest.raises(ValueError):
+        nyse.get_session_day(at(nyse, date(2100, 1, 4), 12))
+    # Without a day, the close of today's trading day
+    assert get_eod_timestamp(None) == nyse.get_eod_timestamp(nyse.today())
+
+
+def test_bulk_lookups():
+    nyse = TradingCalendar(Exchange.NYSE, 2024, 2024)
+    timestamps = [at(nyse, date(2024, 3, 8), 10), at(nyse, date(2024, 3, 9), 10), at(nyse, date(2023, 12, 29), 10)]
+    sessions = nyse.get_sessions(timestamps)
+    assert sessions[0] == nyse.get_session(timestamps[0])
+    assert sessions[1:].tolist() == [-1, -1]
+    days = nyse.get_days(timestamps)
+    assert days[:2].tolist() == [date(2024, 3, 8), date(2024, 3, 8)]
+    assert np.isnat(days[2])
+    assert nyse.get_eod_timestamps(timestamps).tolist() == [at(nyse, date(2024, 3, 8), 16)] * 2 + [-1]
+
+
+def test_eod_reads_use_exchange_calendar(test_db):
+    tsx = get_calendar(Exchange.TSX)
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account", CurrencyType.CAD)
+    assert account.exchange == Exchange.TSX
+    account.deposit("dep1", at(tsx, date(2024, 5, 17), 15), 100.0)
+    account.deposit("dep2", at(tsx, date(2024, 5, 17), 17), 50.0)
+    # Victoria Day's end of day is Friday's close
+    assert get_eod_timestamp(date(2024, 5, 20), Exchange.TSX) == at(tsx, date(2024, 5, 17), 16)
+    assert account.get_eod_balance(date(2024, 5, 20)) == 100.0
+
+    stock = portfolio.start_watching("SHOP")
+    stock.add_price(at(tsx, date(2024, 5, 17), 16), 1.0, 1.0, 1.0, 1.0, 1.0, 100)
+    assert stock.get_eod_price(date(2024, 5, 20), Exchange.TSX).close == 1.0
+    assert stock.get_eod_price(date(2024, 5, 21), Exchange.TSX) is None
+
+    account.buy("buy1", at(tsx, date(2024, 5, 17), 15), "SHOP", 10, 1.0)
+    assert account.get_eod_position("SHOP", date(2024, 5, 20)).size == 10
+    assert account.get_eod_position("SHOP", date(2024, 5, 16)) is None
+    assert account.get_position("NONE") is None
+    # Held stocks stay in the watchlist
+    portfolio.stop_watching("SHOP")
+    assert portfolio.is_watching("SHOP")
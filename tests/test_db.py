@@ -1,11 +1,18 @@
 import os
+import subprocess
+import sys
 
 import pytest
 
+import alfa
 from alfa.db import (
+    SCHEMA_VERSIONS,
+    Balance,
     BaseModel,
     CashLedger,
     CurrencyType,
+    CurrentBalance,
+    CurrentPosition,
     Portfolio,
     Position,
     Price,
@@ -14,24 +21,20 @@ from alfa.db import (
     TransactionLedger,
     TransactionType,
     _as_validated_symbol,
+    add_price_listener,
+    add_transaction_listener,
+    check_current_state,
+    ensure_schema,
+    get_schema_version,
     open_db,
+    rebuild_current_state,
+    remove_price_listener,
+    remove_transaction_listener,
 )
 
 db_path = "data/test.db"
 
 
-@pytest.fixture(scope="function")
-def test_db():
-    db = open_db(db_path)
-    db.connect()
-    db.create_tables(BaseModel.get_models())
-    yield db  # Provides the initialized database to the test
-    db.drop_tables(BaseModel.get_models())
-    db.close()
-    # Remove test database
-    os.remove(db_path)
-
-
 def test_as_validated_symbol_valid():
     symbol = "aapl"
     assert _as_validated_symbol(symbol) == "AAPL"
@@ -466,3 +469,180 @@ def test_transaction_ledgers_unique_external_id(test_db):
             type=TransactionType.SELL.value,
             fees=5.0,
         )
+
+
+def test_sync_watchlist(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    Stock.create(id=1, symbol="AAPL", name="Apple Inc.")
+    portfolio.start_watching("MSFT")
+    portfolio.start_watching("IBM")
+    held = portfolio.start_watching("GOOGL")
+    Position.create(account=account, stock=held, timestamp=1638316800, size=10, average_price=50.0, market_price=50.0)
+    sold = portfolio.start_watching("TSLA")
+    Position.create(account=account, stock=sold, timestamp=1638316800, size=10, average_price=50.0, market_price=50.0)
+    Position.create(account=account, stock=sold, timestamp=1638403200, size=0, average_price=0.0, market_price=0.0)
+
+    added, removed = portfolio.sync_watchlist(["aapl", "msft", "nvda"])
+    assert added == ["AAPL", "NVDA"]
+    assert removed == ["IBM", "TSLA"]
+    assert {stock.symbol for stock in portfolio.get_watchlist()} == {"AAPL", "MSFT", "NVDA", "GOOGL"}
+    assert Stock.get(Stock.symbol == "AAPL").name == "Apple Inc."
+
+    assert portfolio.sync_watchlist(["AAPL", "MSFT", "NVDA"]) == ([], [])
+
+
+def test_current_balance_follows_most_recent_balance(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", 1638403200, 100.0)
+    account.deposit("dep2", 1638489600, 50.0)
+    assert CurrentBalance.get_by_id(account.id).cash == 150.0
+    # An older balance inserted late does not replace the current one
+    Balance.create(account=account, timestamp=1638316800, cash=10.0)
+    assert account.get_cash() == 150.0
+    assert account.get_cash(1638316800) == 10.0
+    assert check_current_state() == []
+
+
+def test_current_position_follows_most_recent_position(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", 1638316800, 2000.0)
+    account.buy("buy1", 1638403200, "AAPL", 10, 50.0)
+    account.buy("buy2", 1638489600, "AAPL", 10, 60.0)
+    current = CurrentPosition.get()
+    assert (current.size, current.average_price) == (20, 55.0)
+    position = account.get_position("AAPL")
+    assert (position.size, position.average_price, position.timestamp) == (20, 55.0, 1638489600)
+    account.sell("sell1", 1638576000, "AAPL", 20, 70.0)
+    assert account.get_position("AAPL") is None
+    assert CurrentPosition.get().size == 0
+    assert check_current_state() == []
+
+
+def test_entries_at_one_timestamp_collapse(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", 1638316800, 2000.0)
+    # Entries sharing a timestamp, e.g. several order fills on one bar, leave one balance and one position with their combined effect
+    account.deposit("dep2", 1638403200, 500.0)
+    account.buy("buy1", 1638403200, "AAPL", 10, 50.0)
+    account.buy("buy2", 1638403200, "AAPL", 10, 60.0)
+    assert [(b.timestamp, b.cash) for b in Balance.select().order_by(Balance.timestamp)] == [(1638316800, 2000.0), (1638403200, 1400.0)]
+    assert [(p.size, p.average_price) for p in Position.select()] == [(20, 55.0)]
+    assert TransactionLedger.select().count() == 2
+    assert account.get_cash(1638403200) == 1400.0
+    assert check_current_state() == []
+
+
+def test_check_and_rebuild_current_state(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", 1638316800, 1000.0)
+    account.buy("buy1", 1638403200, "AAPL", 10, 50.0)
+    CurrentBalance.update(cash=0.0).execute()
+    CurrentPosition.delete().execute()
+    stock = Stock.get(Stock.symbol == "AAPL")
+    assert sorted(check_current_state()) == [("balance", (account.id,)), ("position", (account.id, stock.id))]
+    rebuild_current_state()
+    assert check_current_state() == []
+    assert account.get_cash() == 500.0
+
+
+def test_ensure_schema_skips_current_schema():
+    db = open_db(db_path)
+    db.connect()
+    try:
+        assert db.user_version == 0
+        assert ensure_schema()
+        assert db.user_version == get_schema_version()
+        assert all(model.table_exists() for model in BaseModel.get_models())
+        # Current, no DDL
+        assert not ensure_schema()
+
+        SCHEMA_VERSIONS["alfa.lots"] += 1
+        try:
+            assert db.user_version != get_schema_version()
+            assert ensure_schema()
+            assert not ensure_schema()
+        finally:
+            SCHEMA_VERSIONS["alfa.lots"] -= 1
+    finally:
+        db.drop_tables(BaseModel.get_models())
+        db.close()
+        os.remove(db_path)
+
+
+def test_schema_version_is_independent_of_imports():
+    def ensure(modules):
+        code = f"import {modules}; from alfa.db import ensure_schema, open_db; open_db({db_path!r}).connect(); print(ensure_schema())"
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(alfa.__file__)))
+        return subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True).stdout.strip()
+
+    try:
+        # The first process creates the tables of every module, the others find the schema current whatever they import
+        assert ensure("alfa.db") == "True"
+        assert ensure("alfa.lots, alfa.fx") == "False"
+        assert ensure("alfa.db") == "False"
+        db = open_db(db_path)
+        db.connect()
+        assert db.user_version == get_schema_version()
+        assert all(model.table_exists() for model in BaseModel.get_models())
+        db.close()
+    finally:
+        os.remove(db_path)
+
+
+def test_import_is_lazy():
+    def run(code):
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(alfa.__file__)))
+        return subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True).stdout.strip()
+
+    # Startup imports none of the optional subsystems
+    assert run("import sys, alfa, alfa.db; print(sorted(m for m in ('alfa.validation', 'alfa.risk', 'alfa.rebalance') if m in sys.modules))") == "[]"
+    assert run("import sys, alfa; alfa.risk; print('alfa.risk' in sys.modules)") == "True"
+    assert "risk" in dir(alfa)
+
+
+def test_price_and_transaction_listeners(test_db):
+    events = []
+
+    def on_prices(stock, first_timestamp, last_timestamp):
+        events.append((stock.symbol, first_timestamp, last_timestamp))
+
+    def on_transaction(transaction):
+        events.append(transaction.external_id)
+
+    add_price_listener(on_prices)
+    add_transaction_listener(on_transaction)
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", 1638316800, 1000.0)
+    try:
+        portfolio.start_watching("AAPL").add_prices([(1638316800, 50.0, 50.0, 50.0, 50.0, 50.0, 100)])
+        account.buy("buy1", 1638403200, "AAPL", 10, 50.0)
+    finally:
+        remove_price_listener(on_prices)
+        remove_transaction_listener(on_transaction)
+    account.buy("buy2", 1638489600, "AAPL", 1, 50.0)
+    assert events == [("AAPL", 1638316800, 1638316800), "buy1"]
+
+
+def test_ledger_needs_a_known_stock(test_db):
+    account = Portfolio.init("Portfolio").add_account("Account")
+    with pytest.raises(Stock.DoesNotExist):
+        account.update_transaction_ledger("tx1", 1638316800, TransactionType.BUY.value, "NONE", 0.0, 1, 1.0)
+
+
+def test_current_state_filled_when_created(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", 1638316800, 1000.0)
+    account.buy("buy1", 1638403200, "AAPL", 10, 50.0)
+    # A database from before the current tables
+    test_db.drop_tables([CurrentBalance, CurrentPosition])
+    test_db.create_tables(BaseModel.get_models())
+    assert account.get_cash() == 500.0
+    assert account.get_position("AAPL").size == 10
+    assert check_current_state() == []
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from alfa import fastpath
+from alfa.blocks import pack_prices
+from alfa.db import Portfolio
+from alfa.partitions import archive, get_partition_path
+
+
+DAY = 86_400_000
+START = 1_700_000_000_000
+
+
+@pytest.fixture
+def account(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", START - 1, 10_000.0)
+    stock = portfolio.start_watching("AAPL")
+    stock.add_prices([(START + i * DAY, 10.0, 11.0, 9.0, 10.0 + i, 20.0 + i, 100 + i) for i in range(10)])
+    account.buy("buy1", START + DAY + 1, "AAPL", 10, 10.0)
+    account.buy("buy2", START + 3 * DAY + 1, "AAPL", 10, 12.0)
+    account.sell("sell1", START + 5 * DAY + 1, "AAPL", 20, 15.0)
+    account.buy("buy3", START + 7 * DAY + 1, "AAPL", 5, 17.0)
+    return account
+
+
+def as_bar(price):
+    return price and fastpath.PriceBar(price.timestamp, price.open, price.high, price.low, price.close, price.adjusted_close, price.volume)
+
+
+def as_state(position):
+    return position and fastpath.PositionState(position.timestamp, position.size, position.average_price, position.market_price)
+
+
+TIMESTAMPS = [None, START - 1, START + 2 * DAY + 5, START + 4 * DAY + 5, START + 6 * DAY, START + 9 * DAY + 5, START + 20 * DAY]
+
+
+@pytest.mark.parametrize("to_timestamp", TIMESTAMPS)
+def test_same_results_as_models(account, to_timestamp):
+    stock = account.portfolio.get_watchlist()[0]
+    assert fastpath.get_price(stock, to_timestamp) == as_bar(stock.get_price(to_timestamp))
+    assert fastpath.get_cash(account, to_timestamp) == account.get_cash(to_timestamp)
+    assert fastpath.get_position(account, "aapl", to_timestamp) == as_state(account.get_position("AAPL", to_timestamp))
+    assert fastpath.get_position(account, "MSFT", to_timestamp) is None
+
+
+def test_records(account):
+    stock = account.portfolio.get_watchlist()[0]
+    bar = fastpath.get_price(stock)
+    assert (bar.timestamp, bar.adjusted_close, bar.volume) == (START + 9 * DAY, 29.0, 109)
+    position = fastpath.get_position(account, "AAPL")
+    assert (position.size, position.average_price, position.market_price) == (5, 17.0, 29.0)
+    assert fastpath.get_cash(account) == pytest.approx(10_000.0 - 100.0 - 120.0 + 300.0 - 85.0)
+
+
+def test_reads_history_stores(account):
+    stock = account.portfolio.get_watchlist()[0]
+    pack_prices(stock, START + 5 * DAY)
+    at = START + 4 * DAY + 5
+    assert fastpath.get_price(stock, at) == as_bar(stock.get_price(at))
+    assert fastpath.get_price(stock, at).close == 14.0
+    assert fastpath.get_position(account, "AAPL", at).market_price == 24.0
+
+
+def test_reads_archived_history(test_db, account):
+    archive(2024)
+    try:
+        for at in TIMESTAMPS[1:]:
+            assert fastpath.get_cash(account, at) == account.get_cash(at)
+            assert fastpath.get_position(account, "AAPL", at) == as_state(account.get_position("AAPL", at))
+    finally:
+        test_db.detach("p2023")
+        os.remove(get_partition_path(2023))
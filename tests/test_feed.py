@@ -0,0 +1,117 @@
+import threading
+
+import pytest
+
+from alfa.db import Portfolio
+from alfa.feed import EventType, feed
+from alfa.runner import LedgerBatch
+
+
+DAY = 86_400_000
+START = 1_700_000_000_000
+
+
+@pytest.fixture
+def account(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    portfolio.start_watching("AAPL")
+    portfolio.start_watching("MSFT")
+    return portfolio.add_account("Account")
+
+
+def test_events_published_after_commit(test_db, account):
+    assert not feed.active
+    with feed.subscribe(coalesce=False) as subscription:
+        assert feed.active
+        with test_db.atomic():
+            account.deposit("dep1", START, 1000.0)
+            account.buy("buy1", START + 1, "aapl", 2, 10.0)
+            # Nothing is published before the transaction commits
+            assert len(subscription) == 0
+        events = subscription.drain()
+    assert not feed.active
+    assert [(event.type, event.account, event.symbol) for event in events] == [
+        (EventType.CASH, account.id, None),
+        (EventType.BALANCE, account.id, None),
+        (EventType.TRANSACTION, account.id, "AAPL"),
+        (EventType.BALANCE, account.id, None),
+        (EventType.POSITION, account.id, "AAPL"),
+    ]
+    assert events[0].data == {"external_id": "dep1", "type": "DEPOSIT", "amount": 1000.0, "fees": 0.0}
+    assert events[-1].data == {"size": 2, "average_price": 10.0, "market_price": 10.0}
+    assert events[-1].timestamp == START + 1 and events[-1].route is None
+
+
+def test_rolled_back_writes_not_published(test_db, account):
+    with feed.subscribe(types=[EventType.CASH]) as subscription:
+        with test_db.atomic():
+            account.deposit("dep1", START, 1000.0)
+            with pytest.raises(ValueError):
+                # The failed withdrawal rolls back to its savepoint
+                account.withdraw("wd1", START + 1, 5000.0)
+            with pytest.raises(RuntimeError):
+                with test_db.atomic():
+                    account.deposit("dep2", START + 2, 1.0)
+                    raise RuntimeError
+        with pytest.raises(RuntimeError):
+            with test_db.atomic():
+                account.deposit("dep3", START + 3, 1.0)
+                raise RuntimeError
+        assert [event.data["external_id"] for event in subscription.drain()] == ["dep1"]
+
+
+def test_filters_and_coalescing(test_db, account):
+    other = Portfolio.init("Portfolio").add_account("Other")
+    account.deposit("dep1", START, 1000.0)
+    other.deposit("dep2", START, 1000.0)
+    positions = feed.subscribe(types=["POSITION"], accounts=[account], symbols=["msft"], coalesce=False)
+    prices = feed.subscribe(types=[EventType.PRICE], maxsize=2, coalesce=True)
+    ledger = feed.subscribe(accounts=[other.id], maxsize=2, coalesce=False)
+    try:
+        for i in range(3):
+            account.buy(f"a{i}", START + i + 1, "MSFT", 1, 10.0)
+            account.buy(f"b{i}", START + i + 1, "AAPL", 1, 10.0)
+            other.buy(f"c{i}", START + i + 1, "MSFT", 1, 10.0)
+        stock = Portfolio.init("Portfolio").start_watching("AAPL")
+        for i in range(3):
+            stock.add_prices([(START + i * DAY, 1.0, 1.0, 1.0, 1.0, 1.0, 1)])
+        Portfolio.init("Portfolio").start_watching("MSFT").add_price(START, 1.0, 1.0, 1.0, 1.0, 1.0, 1)
+
+        # Without coalescing every position update is queued
+        assert [event.data["size"] for event in positions.drain()] == [1, 2, 3]
+        # The AAPL price events coalesced into the latest
+        assert [(event.symbol, event.timestamp) for event in prices.drain()] == [("AAPL", START + 2 * DAY), ("MSFT", START)]
+        assert prices.dropped == 0
+        # Only the last two of the other account's events are kept
+        assert [event.type for event in ledger.drain()] == [EventType.BALANCE, EventType.POSITION]
+        assert ledger.dropped == 7
+    finally:
+        for subscription in (positions, prices, ledger):
+            subscription.close()
+    with pytest.raises(ValueError):
+        feed.subscribe(maxsize=0)
+
+
+def test_waiting_consumer(test_db, account):
+    received = []
+    with feed.subscribe(types=[EventType.BALANCE]) as subscription:
+        consumer = threading.Thread(target=lambda: received.append(subscription.get(timeout=5)))
+        consumer.start()
+        account.deposit("dep1", START, 1000.0)
+        consumer.join()
+        assert received[0].data == {"cash": 1000.0}
+        assert subscription.get(timeout=0.01) is None
+
+
+def test_ledger_batch_events(test_db, account):
+    batch = LedgerBatch()
+    batch.add_transaction("t1", account.id, START, "BUY", 1, 0.0, 5, 10.0)
+    batch.set_balance(account.id, START, -50.0)
+    batch.set_position(account.id, 1, START, 5, 10.0, 10.0)
+    with feed.subscribe(accounts=[account]) as subscription:
+        batch.flush()
+        assert [(event.type, event.symbol) for event in subscription.drain()] == [
+            (EventType.TRANSACTION, "AAPL"),
+            (EventType.BALANCE, None),
+            (EventType.POSITION, "AAPL"),
+        ]
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from alfa.db import CurrencyType, Portfolio
+from alfa.fx import _as_of, add_rates, equity_curves, get_rate, get_rates, portfolio_equity
+
+
+DAY = 86_400_000
+START = 1_700_000_000_000
+
+
+USD, CAD = CurrencyType.USD, CurrencyType.CAD
+
+
+def test_get_rate(test_db):
+    add_rates(USD, CAD, [(START, 1.25), (START + DAY, 1.5)])
+    assert get_rate(USD, CAD) == 1.5
+    assert get_rate("USD", "CAD", START + DAY - 1) == 1.25
+    assert get_rate(CAD, USD, START) == pytest.approx(0.8)
+    assert get_rate(CAD, CAD) == 1.0
+    with pytest.raises(ValueError):
+        get_rate(USD, CAD, START - 1)
+
+
+def test_add_rates_rejects_non_positive(test_db):
+    with pytest.raises(ValueError):
+        add_rates(USD, CAD, [(START, 0.0)])
+
+
+def test_get_rates_vectorized(test_db):
+    add_rates(USD, CAD, [(START, 1.25), (START + DAY, 1.5)])
+    rates = get_rates(CAD, USD, [START - 1, START, START + 1, START + 2 * DAY])
+    assert np.isnan(rates[0])
+    assert rates[1:].tolist() == pytest.approx([0.8, 0.8, 1 / 1.5])
+    assert get_rates(USD, USD, [START, START + 1]).tolist() == [1.0, 1.0]
+    assert len(get_rates(USD, CAD, [])) == 0
+    with pytest.raises(ValueError):
+        get_rates(USD, CAD, [START - 1])
+
+
+def test_equity_curves_in_reporting_currency(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    usd = portfolio.add_account("US", USD)
+    cad = portfolio.add_account("CA", CAD)
+    empty = portfolio.add_account("Empty", USD)
+    usd.deposit("d1", START, 1000.0)
+    cad.deposit("d2", START, 2000.0)
+    stock = portfolio.start_watching("AAPL")
+    stock.add_prices([(START + i * DAY, 10.0, 10.0, 10.0, 10.0, 10.0 + i, 100) for i in range(3)])
+    usd.buy("b1", START + DAY, "AAPL", 10, 11.0)
+    add_rates(USD, CAD, [(START, 1.25), (START + 2 * DAY, 2.0)])
+
+    timestamps, equity = equity_curves([usd, cad, empty], USD)
+    assert timestamps.tolist() == [START, START + DAY, START + 2 * DAY]
+    assert equity[0].tolist() == pytest.approx([1000.0, 1000.0, 1010.0])
+    assert equity[1].tolist() == pytest.approx([1600.0, 1600.0, 1000.0])
+    assert equity[2].tolist() == [0.0, 0.0, 0.0]
+
+    _, total = portfolio_equity(portfolio, CAD, [START + 2 * DAY])
+    assert total.tolist() == pytest.approx([1010.0 * 2.0 + 2000.0])
+
+    # Accounts without history
+    timestamps, equity = equity_curves([empty], USD, [START])
+    assert equity.tolist() == [[0.0]]
+    assert np.isnan(_as_of(np.empty(0, dtype=np.int64), np.empty(0), [START])).all()
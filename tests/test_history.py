@@ -0,0 +1,94 @@
+import io
+import tracemalloc
+
+import pytest
+
+from alfa.db import CashLedger, Portfolio, TransactionType
+from alfa.history import (
+    CashEntry,
+    TransactionEntry,
+    get_cash_change,
+    iter_balances,
+    iter_cash,
+    iter_ledger,
+    iter_positions,
+    iter_transactions,
+    render_statement,
+)
+
+
+DAY = 86_400_000
+START = 1_700_000_000_000
+
+
+@pytest.fixture
+def account(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", START, 1000.0, fees=1.0)
+    account.buy("buy1", START + DAY, "AAPL", 5, 10.0, fees=1.0)
+    # Same timestamp as the deposit below
+    account.buy("buy2", START + 2 * DAY, "MSFT", 2, 20.0)
+    account.deposit("dep2", START + 2 * DAY, 100.0)
+    account.sell("sell1", START + 3 * DAY, "AAPL", 5, 12.0, fees=1.0)
+    account.withdraw("wd1", START + 4 * DAY, 50.0, fees=2.0)
+    return account
+
+
+def test_iterators_page_in_order(account):
+    assert [entry.external_id for entry in iter_cash(account, page_size=1)] == ["dep1", "dep2", "wd1"]
+    transactions = list(iter_transactions(account, START + DAY, START + 2 * DAY, page_size=1))
+    assert transactions == [
+        TransactionEntry(transactions[0].id, "buy1", START + DAY, TransactionType.BUY.value, "AAPL", 5, 10.0, 1.0),
+        TransactionEntry(transactions[1].id, "buy2", START + 2 * DAY, TransactionType.BUY.value, "MSFT", 2, 20.0, 0.0),
+    ]
+    assert [entry.cash for entry in iter_balances(account, page_size=2)] == [999.0, 948.0, 1008.0, 1067.0, 1015.0]
+    assert [(entry.symbol, entry.size) for entry in iter_positions(account, page_size=2)] == [("AAPL", 5), ("MSFT", 2), ("AAPL", 0)]
+
+
+def test_ledger_merges_chronologically(account):
+    ledger = list(iter_ledger(account, page_size=2))
+    assert [entry.external_id for entry in ledger] == ["dep1", "buy1", "dep2", "buy2", "sell1", "wd1"]
+    assert isinstance(ledger[0], CashEntry) and isinstance(ledger[1], TransactionEntry)
+    # Shares deposited in kind only cost their fees
+    entry = TransactionEntry(None, "dik1", START, TransactionType.DEPOSIT_IN_KIND.value, "AAPL", 5, 10.0, 2.0)
+    assert get_cash_change(entry) == -2.0
+
+
+def test_statement(account):
+    out = io.StringIO()
+    summary = render_statement(account, out, page_size=2)
+    assert summary.entries == 6
+    assert summary.closing_cash == pytest.approx(account.get_cash())
+    assert (summary.deposits, summary.withdrawals, summary.fees) == (1100.0, 50.0, 5.0)
+    lines = out.getvalue().splitlines()
+    assert lines[0] == "Statement for account Account (USD)"
+    assert lines[6].split()[-2:] == ["-51.00", "948.00"]
+    assert lines[-1].endswith("Closing cash: 1,015.00.")
+
+    summary = render_statement(account, io.StringIO(), from_timestamp=START + 2 * DAY, to_timestamp=START + 3 * DAY)
+    assert (summary.entries, summary.opening_cash, summary.closing_cash) == (3, 948.0, 1067.0)
+
+
+class _Sink:
+    def write(self, text):
+        pass
+
+
+def test_statement_runs_in_constant_memory(account):
+    def peak(entries):
+        rows = [
+            {"external_id": f"bulk-{entries}-{i}", "account": account.id, "timestamp": START + 5 * DAY + i, "amount": 1.0, "type": "DEPOSIT", "fees": 0.0}
+            for i in range(entries)
+        ]
+        CashLedger.insert_many(rows).execute()
+        del rows
+        tracemalloc.start()
+        render_statement(account, _Sink(), page_size=100)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak
+
+    small = peak(1_000)
+    # Ten times the entries, but about the same memory
+    assert peak(10_000) < small * 2
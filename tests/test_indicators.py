@@ -0,0 +1,149 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import alfa
+from alfa.blocks import pack_prices
+from alfa.db import IntervalType, Stock
+from alfa.indicators import ATR, EMA, RSI, SMA, IndicatorSeries, IndicatorValue, _states, get_indicator, track
+
+
+db_path = "data/test.db"
+
+DAY = 86_400_000
+
+
+def _bars(closes, start=0):
+    return [(start + i * DAY, c, c + 1.0, c - 1.0, c, c, 1000) for i, c in enumerate(closes)]
+
+
+CLOSES = [10.0, 11.0, 10.5, 12.0, 11.5, 13.0, 12.5, 12.0, 14.0, 13.5, 15.0, 14.0]
+
+
+def test_indicator_invalid_period():
+    with pytest.raises(ValueError):
+        SMA(0)
+
+
+def test_sma_matches_numpy(test_db):
+    stock = Stock.create(symbol="AAPL")
+    stock.add_prices(_bars(CLOSES))
+    timestamps, values = get_indicator("aapl", SMA(3))
+    assert len(timestamps) == len(CLOSES)
+    assert np.isnan(values[:2]).all()
+    expected = np.convolve(CLOSES, np.ones(3) / 3, mode="valid")
+    assert np.allclose(values[2:], expected)
+
+
+def test_indicator_range(test_db):
+    stock = Stock.create(symbol="AAPL")
+    stock.add_prices(_bars(CLOSES))
+    timestamps, values = get_indicator("AAPL", EMA(3), from_timestamp=2 * DAY, to_timestamp=4 * DAY)
+    assert timestamps.tolist() == [2 * DAY, 3 * DAY, 4 * DAY]
+    assert values[0] == pytest.approx(sum(CLOSES[:3]) / 3)
+
+
+def test_incremental_updates_match_full_recompute(test_db):
+    aapl = Stock.create(symbol="AAPL")
+    msft = Stock.create(symbol="MSFT")
+    indicators = [SMA(4), EMA(4), RSI(4), ATR(4)]
+    aapl.add_prices(_bars(CLOSES[:5]))
+    for indicator in indicators:
+        track("AAPL", indicator)
+    # Append bar by bar, dropping the in-process states half way to exercise restoring them from storage
+    for i, bar in enumerate(_bars(CLOSES)[5:]):
+        if i == 3:
+            _states.clear()
+        aapl.add_price(*bar)
+    msft.add_prices(_bars(CLOSES))
+    for indicator in indicators:
+        _, incremental = get_indicator("AAPL", indicator)
+        _, full = get_indicator("MSFT", indicator)
+        assert np.allclose(incremental, full, equal_nan=True)
+
+
+def test_revision_recomputes_from_first_changed_bar(test_db):
+    aapl = Stock.create(symbol="AAPL")
+    msft = Stock.create(symbol="MSFT")
+    aapl.add_prices(_bars(CLOSES))
+    series = track("AAPL", RSI(3))
+    untouched = IndicatorValue.get((IndicatorValue.series == series) & (IndicatorValue.timestamp == 5 * DAY))
+
+    revised = list(CLOSES)
+    revised[8] = 9.0
+    aapl.add_prices(_bars(revised)[8:])
+    msft.add_prices(_bars(revised))
+
+    assert IndicatorValue.get_by_id(untouched.id).value == untouched.value
+    _, incremental = get_indicator("AAPL", RSI(3))
+    _, full = get_indicator("MSFT", RSI(3))
+    assert np.allclose(incremental, full, equal_nan=True)
+
+
+def test_track_unknown_symbol(test_db):
+    with pytest.raises(ValueError):
+        track("AAPL", SMA(3))
+
+
+def test_only_daily_bars(test_db):
+    stock = Stock.create(symbol="AAPL")
+    stock.add_prices(_bars(CLOSES))
+    # Prices are daily bars, a MINUTE series would be fed the same bars as a DAY one
+    with pytest.raises(ValueError, match="MINUTE"):
+        track("AAPL", SMA(3), IntervalType.MINUTE.value)
+    with pytest.raises(ValueError, match="MINUTE"):
+        get_indicator("AAPL", SMA(3), interval_type=IntervalType.MINUTE)
+    assert IndicatorSeries.select().count() == 0
+
+
+def test_track_is_idempotent(test_db):
+    stock = Stock.create(symbol="AAPL")
+    stock.add_prices(_bars(CLOSES))
+    track("AAPL", SMA(3))
+    track("AAPL", SMA(3))
+    assert IndicatorSeries.select().count() == 1
+    assert IndicatorValue.select().count() == len(CLOSES)
+
+
+def test_rsi_and_atr_values(test_db):
+    stock = Stock.create(symbol="AAPL")
+    stock.add_prices(_bars([10.0, 11.0, 10.0, 12.0]))
+    _, rsi = get_indicator("AAPL", RSI(2))
+    # Gains 1, 0, 2 and losses 0, 1, 0: averages 0.5/0.5 then 1.25/0.25
+    assert rsi[2] == pytest.approx(50.0)
+    assert rsi[3] == pytest.approx(100.0 - 100.0 / (1.0 + 1.25 / 0.25))
+    _, atr = get_indicator("AAPL", ATR(2))
+    # True ranges 2, 2, 2, 3
+    assert np.isnan(atr[0])
+    assert atr.tolist()[1:] == pytest.approx([2.0, 2.0, 2.5])
+
+
+def test_revision_recomputes_without_importing_indicators(test_db):
+    stock = Stock.create(symbol="AAPL")
+    stock.add_prices(_bars(CLOSES[:5]))
+    track("AAPL", SMA(2))
+    code = f"from alfa.db import Stock, open_db; open_db({db_path!r}).connect(); Stock.get(Stock.symbol == 'AAPL').add_prices({_bars([100.0], DAY)!r})"
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(alfa.__file__)))
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)
+    _states.clear()
+    _, values = get_indicator("AAPL", SMA(2))
+    assert values.tolist()[1:] == pytest.approx([55.0, 55.25, 11.25, 11.75])
+
+
+def test_state_restored_from_packed_bars(test_db):
+    aapl = Stock.create(symbol="AAPL")
+    msft = Stock.create(symbol="MSFT")
+    aapl.add_prices(_bars(CLOSES[:8]))
+    for indicator in (SMA(3), RSI(3)):
+        track("AAPL", indicator)
+    pack_prices(aapl)
+    _states.clear()
+    aapl.add_prices(_bars(CLOSES)[8:])
+    msft.add_prices(_bars(CLOSES))
+    for indicator in (SMA(3), RSI(3)):
+        _, incremental = get_indicator("AAPL", indicator)
+        _, full = get_indicator("MSFT", indicator)
+        assert np.allclose(incremental, full, equal_nan=True)
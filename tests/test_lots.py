@@ -0,0 +1,159 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import alfa
+from alfa.db import Account, Portfolio, Position, Stock, open_db
+from alfa.lots import Lot, LotClosure, LotMethod, engine, realized_pnl, unrealized_pnl
+from alfa.runner import LedgerBatch, Runner
+
+
+DAY = 86_400_000
+START = 1_700_000_000_000
+
+
+@pytest.fixture
+def account(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", START - 1, 100_000.0)
+    account.buy("b1", START, "AAPL", 10, 100.0, fees=10.0)
+    account.buy("b2", START + DAY, "AAPL", 10, 120.0)
+    account.deposit_in_kind("d1", START + 2 * DAY, "AAPL", 10, 90.0)
+    return account
+
+
+def test_buys_open_lots(account):
+    lots = engine.get_open_lots(account, "aapl")
+    assert [(lot.external_id, lot.remaining, lot.cost_per_share) for lot in lots] == [("b1", 10, 101.0), ("b2", 10, 120.0), ("d1", 10, 90.0)]
+    assert engine.get_open_lots(account, "MSFT") == []
+
+
+def test_fifo_sell(account):
+    account.sell("s1", START + 3 * DAY, "AAPL", 15, 130.0, fees=15.0)
+    assert [lot.remaining for lot in engine.get_open_lots(account, "AAPL")] == [5, 10]
+    # 10 shares at 101 and 5 at 120, sold at 129 net of fees
+    assert realized_pnl(account) == pytest.approx(10 * 28.0 + 5 * 9.0)
+    assert Lot.get(Lot.external_id == "b1").remaining == 0
+
+
+def test_lifo_sell(account):
+    engine.set_method(account, LotMethod.LIFO)
+    account.sell("s1", START + 3 * DAY, "AAPL", 15, 130.0)
+    assert [lot.remaining for lot in engine.get_open_lots(account, "AAPL")] == [10, 5]
+    assert realized_pnl(account) == pytest.approx(10 * 40.0 + 5 * 10.0)
+
+
+def test_specific_id_sell(account):
+    engine.set_method(account, LotMethod.SPECIFIC_ID)
+    lots = {lot.external_id: lot.id for lot in engine.get_open_lots(account, "AAPL")}
+    with pytest.raises(ValueError):
+        account.sell("s1", START + 3 * DAY, "AAPL", 5, 130.0)
+    # The rejected sale rolled back
+    assert account.get_position("AAPL").size == 30
+
+    with engine.matching([lots["b2"]]):
+        account.sell("s2", START + 3 * DAY, "AAPL", 5, 130.0)
+    assert realized_pnl(account, symbol="AAPL") == pytest.approx(50.0)
+    assert [lot.remaining for lot in engine.get_open_lots(account, "AAPL")] == [10, 5, 10]
+
+
+def test_selection_falls_back_to_method(account):
+    lots = {lot.external_id: lot.id for lot in engine.get_open_lots(account, "AAPL")}
+    with engine.matching([lots["d1"]]):
+        account.sell("s1", START + 3 * DAY, "AAPL", 15, 100.0)
+    assert [lot.external_id for lot in engine.get_open_lots(account, "AAPL")] == ["b1", "b2"]
+    assert engine.get_open_lots(account, "AAPL")[0].remaining == 5
+
+
+def test_realized_pnl_date_range(account):
+    account.sell("s1", START + 3 * DAY, "AAPL", 10, 111.0)
+    account.sell("s2", START + 4 * DAY, "AAPL", 10, 130.0)
+    assert realized_pnl(account, to_timestamp=START + 3 * DAY) == pytest.approx(100.0)
+    assert realized_pnl(account, from_timestamp=START + 4 * DAY) == pytest.approx(100.0)
+    assert LotClosure.select().count() == 2
+
+
+def test_unrealized_pnl(account):
+    stock = Stock.get(Stock.symbol == "AAPL")
+    stock.add_prices([(START + i * DAY, 110.0, 110.0, 110.0, 110.0, 110.0 + i, 1000) for i in range(5)])
+    account.sell("s1", START + 3 * DAY, "AAPL", 10, 110.0)
+
+    # Before the sale all 30 shares are open at 112
+    assert unrealized_pnl(account, to_timestamp=START + 2 * DAY) == pytest.approx(30 * 112.0 - 1010.0 - 1200.0 - 900.0)
+    # Now 20 shares remain at 114
+    assert unrealized_pnl(account) == pytest.approx(20 * 114.0 - 1200.0 - 900.0)
+    assert unrealized_pnl(account, symbol="MSFT") == 0.0
+
+    # Closed lots and lots without a price are left out
+    account.sell("s2", START + 4 * DAY, "AAPL", 20, 110.0)
+    assert unrealized_pnl(account, to_timestamp=START + 4 * DAY) == 0.0
+    account.buy("b3", START + 4 * DAY, "MSFT", 10, 10.0)
+    assert unrealized_pnl(account) == 0.0
+
+
+def test_position_before_tracking_is_seeded(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    stock = portfolio.start_watching("AAPL")
+    Position.create(account=account, stock=stock, timestamp=START, size=10, average_price=50.0, market_price=50.0)
+    account.sell("s1", START + DAY, "AAPL", 4, 60.0)
+    assert realized_pnl(account) == pytest.approx(40.0)
+    [lot] = engine.get_open_lots(account, "AAPL")
+    assert lot.external_id is None
+    assert lot.remaining == 6
+
+
+def test_runner_trades_open_and_close_lots(account):
+    stock = Stock.get(Stock.symbol == "AAPL")
+    stock.add_prices([(START + 5 * DAY, 150.0, 150.0, 150.0, 150.0, 150.0, 1000)])
+
+    def strategy(runner, bar):
+        runner.sell(account, "AAPL", 10, external_id="r1")
+
+    Runner(account.portfolio, [strategy]).run()
+    assert LotClosure.get(LotClosure.external_id == "r1").realized == pytest.approx(490.0)
+
+
+def test_rolled_back_lots_are_dropped(account):
+    with pytest.raises(ValueError, match="positive quantity"):
+        account.buy("b3", START + 3 * DAY, "AAPL", -20, 100.0)
+    assert [lot.external_id for lot in engine.get_open_lots(account, "AAPL")] == ["b1", "b2", "d1"]
+    assert Lot.select().count() == 3
+
+
+def test_sells_beyond_open_lots(account, caplog):
+    stock = Stock.get(Stock.symbol == "AAPL")
+    batch = LedgerBatch()
+    batch.add_transaction("s0", account.id, START + 3 * DAY, "SELL", stock.id, 0.0, 0, 100.0)
+    with pytest.raises(ValueError, match="positive quantity"):
+        batch.flush()
+
+    batch = LedgerBatch()
+    batch.add_transaction("s1", account.id, START + 3 * DAY, "SELL", stock.id, 0.0, 40, 100.0)
+    batch.flush()
+    assert engine.get_open_lots(account, "AAPL") == []
+    assert "sold 10 shares more than its open lots" in caplog.text
+
+
+def test_lots_kept_without_importing_lots(tmp_path):
+    path = str(tmp_path / "lots.db")
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(alfa.__file__)))
+
+    def run(code):
+        setup = f"from alfa.db import Account, BaseModel, Portfolio, open_db\ndb = open_db({path!r})\ndb.connect()\n"
+        subprocess.run([sys.executable, "-c", setup + code], env=env, check=True)
+
+    run("db.create_tables(BaseModel.get_models())\nimport alfa.lots\naccount = Portfolio.init('P').add_account('A')\naccount.deposit('dep', 1, 10_000.0)")
+    run("import alfa.lots\nAccount.get().buy('b1', 2, 'AAPL', 10, 100.0)")
+    # Neither this process nor the next imports alfa.lots
+    run("Account.get().buy('b2', 3, 'AAPL', 10, 200.0)")
+    run("Account.get().sell('s1', 4, 'AAPL', 20, 300.0)")
+
+    db = open_db(path)
+    try:
+        assert realized_pnl(Account.get()) == 3000.0
+    finally:
+        db.close()
@@ -0,0 +1,143 @@
+import pytest
+
+from alfa.db import Portfolio, TransactionLedger, TransactionType
+from alfa.orders import Order, OrderBook, OrderStatus, OrderType
+
+
+START = 1_700_000_000_000
+
+
+@pytest.fixture
+def account(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", START - 1, 100_000.0)
+    return account
+
+
+BUY, SELL = TransactionType.BUY, TransactionType.SELL
+LIMIT, STOP = OrderType.LIMIT, OrderType.STOP
+
+
+def test_place_order_persists(account):
+    book = OrderBook()
+    order = book.place(account, "o1", START, "aapl", BUY, LIMIT, 10, 95.0)
+    assert len(book) == 1
+    stored = Order.get_by_id(order.id)
+    assert stored.status == OrderStatus.OPEN.value
+    assert stored.stock.symbol == "AAPL"
+    assert account.portfolio.is_watching("AAPL")
+
+
+def test_place_invalid_order(account):
+    book = OrderBook()
+    with pytest.raises(ValueError):
+        book.place(account, "o1", START, "AAPL", BUY, LIMIT, 0, 95.0)
+    with pytest.raises(ValueError):
+        book.place(account, "o2", START, "AAPL", TransactionType.DEPOSIT, LIMIT, 1, 95.0)
+    with pytest.raises(ValueError):
+        book.place(account, "o3", START, "AAPL", BUY, "MARKET", 1, 95.0)
+
+
+def test_bar_triggers_only_crossed_orders(account):
+    book = OrderBook()
+    for i in range(50):
+        book.place(account, f"buy{i}", START, "AAPL", BUY, LIMIT, 1, 50.0 + i)
+    filled = book.match("AAPL", START + 1, open=100.0, high=101.0, low=97.5)
+    assert sorted(order.price for order in filled) == [98.0, 99.0]
+    assert all(order.status == OrderStatus.FILLED.value for order in filled)
+    assert len(book) == 48
+    assert TransactionLedger.select().count() == 2
+    assert account.get_position("AAPL").size == 2
+    assert book.match("MSFT", START + 1, open=1.0, high=1.0, low=1.0) == []
+
+
+def test_fill_prices(account):
+    book = OrderBook()
+    book.place(account, "buy_limit", START, "AAPL", BUY, LIMIT, 10, 100.0)
+    book.place(account, "buy_stop", START, "AAPL", BUY, STOP, 10, 105.0)
+    # The bar gaps down through the buy limit, which fills at the open; the buy stop fills at its price
+    filled = {order.external_id: order for order in book.match("AAPL", START + 1, open=95.0, high=106.0, low=94.0)}
+    assert filled["buy_limit"].fill_price == 95.0
+    assert filled["buy_stop"].fill_price == 105.0
+
+    book.place(account, "sell_limit", START + 1, "AAPL", SELL, LIMIT, 5, 110.0)
+    book.place(account, "sell_stop", START + 1, "AAPL", SELL, STOP, 5, 90.0)
+    filled = {order.external_id: order for order in book.match("AAPL", START + 2, open=112.0, high=113.0, low=111.0)}
+    assert filled["sell_limit"].fill_price == 112.0
+    filled = {order.external_id: order for order in book.match("AAPL", START + 3, open=85.0, high=86.0, low=84.0)}
+    assert filled["sell_stop"].fill_price == 85.0
+
+    transaction = TransactionLedger.get(TransactionLedger.external_id == "sell_stop")
+    assert transaction.type == TransactionType.SELL.value
+    assert transaction.price == 85.0
+    assert account.get_position("AAPL").size == 10
+
+
+def test_cancel_order(account):
+    book = OrderBook()
+    order = book.place(account, "o1", START, "AAPL", BUY, LIMIT, 10, 100.0)
+    assert book.cancel(order)
+    assert not book.cancel(order)
+    assert book.match("AAPL", START + 1, open=90.0, high=91.0, low=89.0) == []
+    assert Order.get_by_id(order.id).status == OrderStatus.CANCELLED.value
+
+
+def test_rejected_order(account):
+    book = OrderBook()
+    order = book.place(account, "o1", START, "AAPL", SELL, LIMIT, 10, 100.0)
+    [executed] = book.match("AAPL", START + 1, open=101.0, high=101.0, low=99.0)
+    assert executed.id == order.id
+    assert Order.get_by_id(order.id).status == OrderStatus.REJECTED.value
+
+
+def test_load_open_orders(account):
+    book = OrderBook()
+    book.place(account, "o1", START, "AAPL", BUY, LIMIT, 10, 100.0)
+    cancelled = book.place(account, "o2", START, "AAPL", BUY, LIMIT, 10, 99.0)
+    book.cancel(cancelled)
+
+    fills = []
+    reloaded = OrderBook(executor=lambda order, timestamp, price: fills.append((order.external_id, timestamp, price))).load()
+    assert len(reloaded) == 1
+    reloaded.match("AAPL", START + 1, open=98.0, high=98.0, low=97.0)
+    assert fills == [("o1", START + 1, 98.0)]
+
+
+def test_fill_and_status_commit_together(account):
+    def executor(order, timestamp, price):
+        account.buy(order.external_id, timestamp, order.stock.symbol, order.quantity, price)
+        raise RuntimeError("Crashed after posting the fill")
+
+    book = OrderBook(executor=executor)
+    order = book.place(account, "o1", START, "AAPL", BUY, LIMIT, 10, 100.0)
+    with pytest.raises(RuntimeError):
+        book.match("AAPL", START + 1, open=99.0, high=99.0, low=98.0)
+    # Neither the fill nor the status were written, and the order rests in the book
+    assert TransactionLedger.select().count() == 0
+    assert Order.get_by_id(order.id).status == OrderStatus.OPEN.value
+    assert len(book) == 1
+
+
+def test_failed_execution_requeues_remaining_orders(account):
+    def executor(order, timestamp, price):
+        if order.external_id == "o2":
+            raise RuntimeError("Executor failed")
+
+    book = OrderBook(executor=executor)
+    for i in range(1, 4):
+        book.place(account, f"o{i}", START, "AAPL", BUY, LIMIT, 10, 100.0)
+    with pytest.raises(RuntimeError):
+        book.match("AAPL", START + 1, open=99.0, high=99.0, low=98.0)
+    assert len(book) == 2
+    book.executor = lambda order, timestamp, price: None
+    assert [order.external_id for order in book.match("AAPL", START + 2, open=99.0, high=99.0, low=98.0)] == ["o2", "o3"]
+
+
+def test_earlier_bar_does_not_fill(account):
+    book = OrderBook()
+    book.place(account, "o1", START, "AAPL", BUY, LIMIT, 10, 100.0)
+    assert book.match("AAPL", START - 1, open=99.0, high=99.0, low=98.0) == []
+    assert len(book) == 1
+    [filled] = book.match("AAPL", START, open=99.0, high=99.0, low=98.0)
+    assert filled.status == OrderStatus.FILLED.value
@@ -0,0 +1,116 @@
+import os
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+import alfa
+from alfa.db import Balance, Portfolio, Price, check_current_state, open_db
+from alfa.fx import equity_curves
+from alfa.history import iter_balances, iter_positions
+from alfa.partitions import archive, get_partition_path, get_partition_years, main
+from alfa.risk import get_holdings
+
+
+db_path = "data/test.db"
+
+
+def ts(year, month=6, day=1):
+    return int(datetime(year, month, day, 16, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+@pytest.fixture
+def account(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    stock = portfolio.start_watching("AAPL")
+    for year in (2019, 2020, 2021):
+        account.deposit(f"dep{year}", ts(year), 1000.0)
+        account.buy(f"buy{year}", ts(year, 7), "AAPL", 10, 10.0 * (year - 2018))
+        stock.add_prices([(ts(year, month), 1.0, 1.0, 1.0, year - 2000.0, year - 2000.0, 100) for month in range(1, 13)])
+    yield account
+    for year in get_partition_years():
+        test_db.detach(f"p{year}")
+        os.remove(get_partition_path(year))
+
+
+def test_archive_moves_old_history(account):
+    assert archive(2021) == 2 * 12 + 2 * 2 + 2
+    assert get_partition_years() == [2019, 2020]
+    assert os.path.exists("data/test_2019.db") and os.path.exists("data/test_2020.db")
+    assert Price.select().count() == 12
+    assert Balance.select().count() == 6 - 4
+    assert check_current_state() == []
+    assert archive(2021) == 0
+    # No partition holds history before the first archived year
+    assert account.get_cash(ts(2018)) == 0.0
+
+
+def test_reads_fall_back_to_partitions(account):
+    archive(2022)
+    stock = Price.select().first().stock
+    assert stock.get_price(ts(2019, 3)).close == 19.0
+    assert stock.get_price(ts(2020, 12)).close == 20.0
+    assert stock.get_price().close == 21.0
+    assert account.get_cash(ts(2019, 6, 2)) == 1000.0
+    assert account.get_cash(ts(2020, 8)) == 1000.0 - 100.0 + 1000.0 - 200.0
+    assert account.get_cash() == 3000.0 - 600.0
+    assert account.get_position("AAPL", ts(2020, 8)).size == 20
+    assert account.get_position("AAPL", ts(2019, 1)) is None
+
+
+def test_partitions_attach_on_open(account):
+    archive(2020)
+    account._meta.database.close()
+    db = open_db(db_path)
+    db.connect()
+    assert get_partition_years() == [2019]
+    assert account.get_cash(ts(2019, 6, 2)) == 1000.0
+
+
+def test_history_reads_include_partitions(account):
+    def read():
+        return (
+            list(iter_balances(account, page_size=2)),
+            list(iter_positions(account, page_size=2)),
+            list(iter_balances(account, ts(2020), ts(2020, 12))),
+            equity_curves([account], account.currency),
+            get_holdings(account, ts(2019, 8)),
+        )
+
+    balances, positions, balances_2020, (timestamps, equity), holdings = read()
+    archive(2021)
+    assert read()[:3] == (balances, positions, balances_2020)
+    np.testing.assert_array_equal(read()[3][0], timestamps)
+    np.testing.assert_array_equal(read()[3][1], equity)
+    assert read()[4][0] == holdings[0] == ["AAPL"]
+    np.testing.assert_array_equal(read()[4][1], holdings[1])
+
+
+def test_partitions_attach_without_importing_partitions(account):
+    archive(2021)
+    account._meta.database.close()
+    code = (
+        f"from alfa.db import Account, open_db; open_db({db_path!r}).connect(); account = Account.get_by_id({account.id}); "
+        f"print(account.get_cash({ts(2019, 8)}), account.get_cash({ts(2020, 8)}))"
+    )
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(alfa.__file__)))
+    output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True).stdout.split()
+    assert output == ["900.0", "1700.0"]
+    open_db(db_path).connect()
+
+
+def test_main(account, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["alfa.partitions", db_path, "2021", "--vacuum"])
+    main()
+    assert capsys.readouterr().out == "Archived 30 rows.\n"
+    open_db(db_path).connect()
+    assert get_partition_years() == [2019, 2020]
+
+
+def test_in_memory_database_has_no_partitions(test_db):
+    open_db(":memory:")
+    assert get_partition_years() == []
+    open_db(db_path)
@@ -0,0 +1,132 @@
+import pytest
+
+from alfa.blocks import pack_prices
+from alfa.cache import clear_caches
+from alfa.db import Portfolio, Stock, TransactionLedger, TransactionType
+from alfa.rebalance import Constraints, Trade, execute_plan, plan_rebalance
+
+
+DAY = 86_400_000
+START = 1_700_000_000_000
+
+
+@pytest.fixture
+def portfolio(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    for symbol, price in (("AAPL", 100.0), ("MSFT", 50.0), ("IBM", 20.0)):
+        stock = portfolio.start_watching(symbol)
+        stock.add_prices([(START, price, price, price, price, price, 1000), (START + DAY, price * 2, price * 2, price * 2, price * 2, price * 2, 1000)])
+    first = portfolio.add_account("First")
+    first.deposit("dep1", START, 10_000.0)
+    first.buy("buy1", START, "IBM", 100, 20.0)
+    second = portfolio.add_account("Second")
+    second.deposit("dep2", START, 5_000.0)
+    return portfolio
+
+
+def test_dry_run_returns_plan(portfolio):
+    plan = portfolio.rebalance({"aapl": 0.5, "MSFT": 0.25}, START, dry_run=True)
+    assert [(trade.account.name, trade.symbol, trade.type, trade.quantity) for trade in plan] == [
+        ("First", "IBM", TransactionType.SELL.value, 100),
+        ("First", "AAPL", TransactionType.BUY.value, 50),
+        ("First", "MSFT", TransactionType.BUY.value, 50),
+        ("Second", "AAPL", TransactionType.BUY.value, 25),
+        ("Second", "MSFT", TransactionType.BUY.value, 25),
+    ]
+    assert all(trade.external_id is None for trade in plan)
+    assert TransactionLedger.select().count() == 1
+
+
+def test_constraints(portfolio):
+    accounts = portfolio.get_accounts()
+    # Lots of 10 shares and 10% of each account kept in cash
+    plan = plan_rebalance(accounts, {"AAPL": 0.5, "MSFT": 0.5}, START, Constraints(lot_size=10, cash_buffer=0.1))
+    assert {(trade.account.name, trade.symbol): trade.quantity for trade in plan if trade.type == TransactionType.BUY.value} == {
+        ("First", "AAPL"): 40,
+        ("First", "MSFT"): 90,
+        ("Second", "AAPL"): 20,
+        ("Second", "MSFT"): 40,
+    }
+    # Trades worth less than $1500 are skipped, the IBM position is still closed
+    plan = plan_rebalance(accounts, {"AAPL": 0.9, "MSFT": 0.1}, START, Constraints(min_trade_value=1500.0))
+    assert [(trade.account.name, trade.symbol, trade.quantity) for trade in plan] == [("First", "IBM", 100), ("First", "AAPL", 90), ("Second", "AAPL", 45)]
+    # Buys are scaled down to leave cash for the fees
+    plan = plan_rebalance(accounts, {"AAPL": 1.0}, START, Constraints(fees=10.0))
+    assert [trade.quantity for trade in plan if trade.account.name == "Second"] == [49]
+
+    with pytest.raises(ValueError):
+        plan_rebalance(accounts, {"AAPL": 0.8, "MSFT": 0.8}, START)
+    with pytest.raises(ValueError):
+        plan_rebalance(accounts, {"AAPL": 1.0}, START - 1)
+    with pytest.raises(ValueError):
+        plan_rebalance(accounts, {"NONE": 1.0}, START)
+    with pytest.raises(ValueError):
+        plan_rebalance(accounts, {"AAPL": 1.0}, START, Constraints(lot_size=0))
+    portfolio.start_watching("TSLA")
+    with pytest.raises(ValueError, match="No price for TSLA"):
+        plan_rebalance(accounts, {"TSLA": 1.0}, START)
+    assert plan_rebalance([], {"AAPL": 1.0}, START) == []
+
+
+def test_rebalance_executes_plan(portfolio):
+    executed = portfolio.rebalance({"AAPL": 0.5, "MSFT": 0.25}, START + DAY, Constraints(fees=1.0))
+    assert len(executed) == 5 and all(trade.external_id for trade in executed)
+    first, second = portfolio.get_accounts()
+    # IBM sold at the second day's close
+    assert first.get_position("IBM") is None
+    assert first.get_position("AAPL").size == 30
+    assert first.get_position("MSFT").size == 30
+    assert first.get_cash() == pytest.approx(8_000.0 + 100 * 40.0 - 30 * 200.0 - 30 * 100.0 - 3.0)
+    assert second.get_position("AAPL").size == 12
+    assert second.get_cash() == pytest.approx(5_000.0 - 12 * 200.0 - 12 * 100.0 - 2.0)
+    assert TransactionLedger.select().where(TransactionLedger.fees == 1.0).count() == 5
+    # The fees paid leave a one share drift, below the minimum trade
+    assert portfolio.rebalance({"AAPL": 0.5, "MSFT": 0.25}, START + DAY, Constraints(fees=1.0, min_trade_value=500.0)) == []
+
+
+def test_rebalance_updates_watchlist(portfolio):
+    other = Portfolio.init("Other")
+    account = other.add_account("Account")
+    account.deposit("dep3", START, 1_000.0)
+    account.buy("buy3", START, "AAPL", 5, 100.0)
+    assert [stock.symbol for stock in other.get_watchlist()] == ["AAPL"]
+    other.rebalance({"MSFT": 0.5}, START)
+    assert [stock.symbol for stock in other.get_watchlist()] == ["MSFT"]
+
+
+def test_plan_reads_packed_prices(portfolio):
+    expected = portfolio.rebalance({"AAPL": 0.5, "MSFT": 0.25}, START + DAY, dry_run=True)
+    for stock in Stock.select():
+        pack_prices(stock)
+    clear_caches()
+    assert portfolio.rebalance({"AAPL": 0.5, "MSFT": 0.25}, START + DAY, dry_run=True) == expected
+
+
+def test_past_as_of_rejected(portfolio):
+    portfolio.get_accounts()[0].deposit("dep3", START + DAY, 1_000.0)
+    with pytest.raises(ValueError):
+        portfolio.rebalance({"AAPL": 0.5}, START, dry_run=True)
+    with pytest.raises(ValueError):
+        portfolio.rebalance({"AAPL": 0.5}, START)
+    assert TransactionLedger.select().count() == 1
+
+
+def test_watchlist_updated_with_the_trades(portfolio, monkeypatch):
+    def fail(self, symbol):
+        raise RuntimeError("Watchlist unavailable")
+
+    monkeypatch.setattr(Portfolio, "start_watching", fail)
+    with pytest.raises(RuntimeError):
+        portfolio.rebalance({"AAPL": 0.5}, START + DAY)
+    # The trades written before the watchlist update are rolled back with it
+    assert TransactionLedger.select().count() == 1
+
+
+def test_execute_plan_checks_holdings(portfolio):
+    first, second = portfolio.get_accounts()
+    assert execute_plan([], START) == []
+    with pytest.raises(ValueError, match="only 0 available"):
+        execute_plan([Trade(second, "IBM", TransactionType.SELL.value, 1, 20.0, 0.0, None)], START)
+    with pytest.raises(ValueError, match="sufficient cash"):
+        execute_plan([Trade(second, "AAPL", TransactionType.BUY.value, 100, 100.0, 0.0, None)], START)
+    assert TransactionLedger.select().count() == 1
@@ -0,0 +1,122 @@
+import os
+from datetime import date
+
+import numpy as np
+import pytest
+
+from alfa.blocks import pack_prices
+from alfa.cache import clear_caches
+from alfa.calendar import get_calendar
+from alfa.db import Portfolio, Stock
+from alfa.partitions import archive, get_partition_path
+from alfa.risk import TRADING_DAYS, get_holdings, get_returns, get_risk
+
+
+# Closes of the NYSE sessions from January 2nd 2024
+SESSIONS = get_calendar().closes[get_calendar().days.index(date(2024, 1, 2).toordinal()) :][:40]
+
+
+def bars(closes, sessions=SESSIONS):
+    return [(timestamp, close, close, close, close, close, 100) for timestamp, close in zip(sessions, closes, strict=False)]
+
+
+@pytest.fixture
+def portfolio(test_db):
+    portfolio = Portfolio.init("Portfolio")
+    rng = np.random.default_rng(7)
+    for symbol in ("AAPL", "MSFT", "SPY"):
+        stock = portfolio.start_watching(symbol)
+        stock.add_prices(bars(100.0 * np.cumprod(1.0 + rng.normal(0.0, 0.01, len(SESSIONS)))))
+    return portfolio
+
+
+def test_returns_over_common_sessions(portfolio):
+    stock = portfolio.start_watching("IBM")
+    # IBM misses the third session, and has an intraday bar before the close of the second
+    stock.add_prices(bars([10.0, 11.0, 12.0, 13.0], [SESSIONS[0], SESSIONS[1], SESSIONS[3], SESSIONS[4]]))
+    stock.add_prices([(SESSIONS[1] - 3_600_000, 1.0, 1.0, 1.0, 1.0, 10.5, 1)])
+
+    returns = get_returns(["AAPL", "ibm"])
+    assert returns.symbols == ["AAPL", "IBM"]
+    assert returns.timestamps.tolist() == [SESSIONS[1], SESSIONS[3], SESSIONS[4]]
+    assert returns.returns[:, 1] == pytest.approx([0.1, 12.0 / 11.0 - 1.0, 13.0 / 12.0 - 1.0])
+
+    assert get_returns(["AAPL", "IBM"], to_timestamp=SESSIONS[3]).timestamps.tolist() == [SESSIONS[1], SESSIONS[3]]
+    with pytest.raises(ValueError):
+        get_returns(["NONE"])
+
+
+def test_returns_updated_as_bars_arrive(portfolio):
+    first = get_returns(["AAPL", "MSFT"])
+    assert len(first.timestamps) == len(SESSIONS) - 1
+    assert get_returns(["AAPL", "MSFT"]).returns is first.returns
+
+    # A new session for both is appended
+    next_session = get_calendar().closes[get_calendar().closes.index(SESSIONS[-1]) + 1]
+    for symbol in ("AAPL", "MSFT"):
+        portfolio.start_watching(symbol).add_prices(bars([200.0], [next_session]))
+    appended = get_returns(["AAPL", "MSFT"])
+    assert appended.timestamps[-1] == next_session
+    assert (appended.returns[:-1] == first.returns).all()
+
+    # A revised bar replaces the series
+    portfolio.start_watching("AAPL").add_prices(bars([50.0], [SESSIONS[0]]))
+    revised = get_returns(["AAPL", "MSFT"])
+    assert revised.returns[0, 0] != first.returns[0, 0]
+    assert (revised.returns[1:, 1] == appended.returns[1:, 1]).all()
+
+
+def test_returns_read_packed_and_archived_bars(test_db, portfolio):
+    expected = get_returns(["AAPL", "MSFT"])
+
+    pack_prices(Stock.get(Stock.symbol == "AAPL"), SESSIONS[20])
+    archive(2025)
+    clear_caches()
+    try:
+        returns = get_returns(["AAPL", "MSFT"])
+        assert returns.timestamps.tolist() == expected.timestamps.tolist()
+        assert (returns.returns == expected.returns).all()
+    finally:
+        test_db.detach("p2024")
+        os.remove(get_partition_path(2024))
+
+
+def test_portfolio_risk(portfolio):
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", SESSIONS[0], 10_000.0)
+    account.buy("buy1", SESSIONS[-1], "AAPL", 10, 100.0)
+    account.buy("buy2", SESSIONS[-1], "MSFT", 30, 100.0)
+    symbols, values = get_holdings(account)
+    assert symbols == ["AAPL", "MSFT"]
+
+    risk = get_risk(account, window=20, benchmark="SPY")
+    weights = values / values.sum()
+    assert risk.weights == pytest.approx(weights)
+    assert len(risk.timestamps) == len(SESSIONS) - 20
+    assert risk.timestamps[-1] == SESSIONS[-1]
+
+    returns = get_returns(["AAPL", "MSFT", "SPY"]).returns
+    portfolio_returns = returns[:, :2] @ weights
+    last = portfolio_returns[-20:]
+    assert risk.volatility[-1] == pytest.approx(last.std(ddof=1) * np.sqrt(TRADING_DAYS))
+    assert risk.value_at_risk[-1] == pytest.approx(-np.quantile(last, 0.05))
+    assert risk.beta[-1] == pytest.approx(np.cov(last, returns[-20:, 2])[0, 1] / np.var(returns[-20:, 2], ddof=1))
+    wealth = np.cumprod(np.concatenate(([1.0], 1.0 + last)))
+    assert risk.max_drawdown[-1] == pytest.approx((wealth / np.maximum.accumulate(wealth) - 1.0).min())
+    assert risk.correlation.shape == (2, 2)
+    assert risk.correlation[0, 1] == pytest.approx(np.corrcoef(returns[-20:, 0], returns[-20:, 1])[0, 1])
+
+    assert np.isnan(get_risk(account, window=20).beta).all()
+    with pytest.raises(ValueError):
+        get_risk(account, window=len(SESSIONS))
+
+
+def test_no_holdings(portfolio):
+    account = portfolio.add_account("Account")
+    risk = get_risk(account)
+    assert risk.symbols == [] and len(risk.volatility) == 0
+    with pytest.raises(ValueError):
+        get_risk(account, window=1)
+    # A stock without bars has no returns
+    portfolio.start_watching("IBM")
+    assert len(get_returns(["AAPL", "IBM"]).timestamps) == 0
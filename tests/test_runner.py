@@ -0,0 +1,169 @@
+import pytest
+
+from alfa.db import Balance, Portfolio, Position, Stock, StockToWatch, TransactionLedger, TransactionType
+from alfa.runner import FlushType, Runner
+
+
+DAY = 86_400_000
+START = 1_700_000_000_000
+
+
+def _setup(days=5):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", START - DAY, 10_000.0)
+    for symbol, base in (("AAPL", 100.0), ("MSFT", 200.0)):
+        stock = portfolio.start_watching(symbol)
+        stock.add_prices([(START + i * DAY, base + i, base + i + 1, base + i - 1, base + i, base + i, 1000) for i in range(days)])
+    return portfolio, account
+
+
+def test_run_streams_bars_in_timestamp_order(test_db):
+    portfolio, _ = _setup()
+    seen = []
+    stats = Runner(portfolio, [lambda runner, bar: seen.append((bar.timestamp, bar.symbol))]).run()
+    assert seen == sorted(seen)
+    assert len(seen) == 10
+    assert stats.bars == 10
+    assert stats.bars_per_second > 0
+
+
+def test_run_respects_time_range(test_db):
+    portfolio, _ = _setup()
+    seen = []
+    Runner(portfolio, [lambda runner, bar: seen.append(bar.timestamp)], from_timestamp=START + DAY, to_timestamp=START + 2 * DAY, page_size=1).run()
+    assert seen == [START + DAY, START + DAY, START + 2 * DAY, START + 2 * DAY]
+
+
+class BuyThenSell:
+    def __init__(self, account):
+        self.account = account
+        self.ended = False
+
+    def on_bar(self, runner, bar):
+        if bar.symbol != "AAPL":
+            return
+        if bar.timestamp == START:
+            runner.buy(self.account, "AAPL", 10, fees=1.0)
+            runner.buy(self.account, "AAPL", 10, price=102.0)
+        elif bar.timestamp == START + 2 * DAY:
+            runner.sell(self.account, "aapl", 5, fees=1.0)
+            assert runner.get_position(self.account, "AAPL") == (15, 101.0)
+
+    def on_end(self, runner):
+        self.ended = True
+
+
+def test_run_executes_orders_and_flushes_ledger(test_db):
+    portfolio, account = _setup()
+    strategy = BuyThenSell(account)
+    stats = Runner(portfolio, [strategy]).run()
+    assert strategy.ended
+    assert stats.orders == 3
+    assert stats.flushes == 2
+
+    transactions = list(TransactionLedger.select().order_by(TransactionLedger.id))
+    assert [t.type for t in transactions] == [TransactionType.BUY.value, TransactionType.BUY.value, TransactionType.SELL.value]
+    assert account.get_cash() == 10_000.0 - 1001.0 - 1020.0 + 5 * 102.0 - 1.0
+    # Both buys share a timestamp and collapse into one balance and one position row
+    assert Balance.select().where(Balance.timestamp == START).count() == 1
+    position = account.get_position("AAPL")
+    assert position.size == 15
+    assert position.average_price == 101.0
+
+
+def test_flush_per_bar(test_db):
+    portfolio, account = _setup()
+
+    def strategy(runner, bar):
+        if bar.symbol == "MSFT":
+            runner.buy(account, "MSFT", 1)
+
+    stats = Runner(portfolio, [strategy], flush_type=FlushType.BAR).run()
+    assert stats.flushes == 5
+    assert Position.select().count() == 5
+
+
+def test_sell_entire_position_stops_watching(test_db):
+    portfolio, account = _setup()
+
+    def strategy(runner, bar):
+        if bar.symbol == "AAPL" and bar.timestamp == START:
+            runner.buy(account, "AAPL", 1)
+        elif bar.symbol == "AAPL" and bar.timestamp == START + DAY:
+            runner.sell(account, "AAPL", 1)
+
+    Runner(portfolio, [strategy]).run()
+    assert account.get_position("AAPL") is None
+    assert not portfolio.is_watching("AAPL")
+    assert StockToWatch.select().count() == 1
+
+
+def test_buy_new_symbol_starts_watching(test_db):
+    portfolio, account = _setup()
+
+    def strategy(runner, bar):
+        if bar.timestamp == START and bar.symbol == "AAPL":
+            runner.buy(account, "IBM", 1, price=10.0)
+
+    Runner(portfolio, [strategy]).run()
+    assert portfolio.is_watching("IBM")
+    assert Stock.get(Stock.symbol == "IBM").id
+
+
+def test_invalid_orders(test_db):
+    portfolio, account = _setup()
+    errors = []
+
+    def strategy(runner, bar):
+        if bar.timestamp != START or bar.symbol != "AAPL":
+            return
+        for order in (
+            lambda: runner.buy(account, "AAPL", 1000),
+            lambda: runner.buy(account, "AAPL", 0),
+            lambda: runner.buy(account, "GOOG", 1),
+            lambda: runner.sell(account, "AAPL", 1),
+            lambda: runner.sell(account, "AAPL", -1),
+        ):
+            with pytest.raises(ValueError) as e:
+                order()
+            errors.append(e)
+        runner.buy(account, "AAPL", 1)
+        assert runner.get_cash(account) == 10_000.0 - 100.0
+        with pytest.raises(ValueError):
+            runner.sell(account, "AAPL", 2)
+
+    stats = Runner(portfolio, [strategy]).run()
+    assert len(errors) == 5
+    assert stats.orders == 1
+    assert account.get_cash() == 10_000.0 - 100.0
+
+
+def test_flush_per_trading_day(test_db):
+    portfolio, account = _setup()
+
+    def strategy(runner, bar):
+        # Friday's and Saturday's bars fall in Friday's NYSE session
+        if bar.symbol == "MSFT" and bar.timestamp >= START + 3 * DAY:
+            runner.buy(account, "MSFT", 1)
+
+    stats = Runner(portfolio, [strategy]).run()
+    assert stats.flushes == 1
+    assert Position.select().count() == 2
+
+
+def test_orders_need_a_bar(test_db):
+    portfolio, account = _setup()
+
+    class BuyOnStart:
+        def on_start(self, runner):
+            with pytest.raises(ValueError, match="streamed a bar"):
+                runner.buy(account, "AAPL", 1, price=100.0)
+            with pytest.raises(ValueError, match="streamed a bar"):
+                runner.sell(account, "AAPL", 1, price=100.0)
+
+        def on_bar(self, runner, bar):
+            pass
+
+    assert Runner(portfolio, [BuyOnStart()]).run().orders == 0
+    assert TransactionLedger.select().count() == 0
@@ -0,0 +1,129 @@
+import os
+import shutil
+import threading
+from datetime import datetime, timezone
+
+import pytest
+
+from alfa.db import Portfolio, Stock, TransactionLedger, db
+from alfa.history import iter_balances
+from alfa.lots import engine, realized_pnl
+from alfa.partitions import archive, get_partition_path, get_partition_years
+from alfa.shards import ShardRouter
+
+
+shards_path = "data/shards"
+
+START = 1_700_000_000_000
+
+
+@pytest.fixture
+def router(test_db):
+    router = ShardRouter(shards_path)
+    yield router
+    router.close()
+    shutil.rmtree(shards_path)
+
+
+def trade(router, name, amount):
+    with router.routing(name):
+        portfolio = Portfolio.init(name)
+        account = portfolio.add_account("Account")
+        account.deposit("dep1", START, amount)
+        account.buy("buy1", START + 1, "AAPL", 10, amount / 100)
+        return account
+
+
+def test_portfolios_live_in_their_own_files(router):
+    first = trade(router, "First", 1000.0)
+    second = trade(router, "Second One", 2000.0)
+    assert router.get_names() == ["first", "second_one"]
+    # Both files number their rows from 1
+    assert first.id == second.id == 1
+
+    with router.routing("First"):
+        assert [p.name for p in Portfolio.get_portfolios()] == ["First"]
+        assert first.get_cash() == 900.0
+    with router.routing("Second One"):
+        assert second.get_cash() == 1800.0
+        assert TransactionLedger.select().count() == 1
+
+    # Stocks are shared reference data in the opened database
+    assert Stock.select().count() == 1
+    assert Portfolio.select().count() == 0
+
+    # Shards already holding the current schema are used as they are
+    other = ShardRouter(shards_path)
+    with other.routing("First"):
+        assert first.get_cash() == 900.0
+    other.close()
+    with pytest.raises(ValueError):
+        router.get_path(" ! ")
+
+
+def test_lots_are_kept_per_shard(router):
+    first = trade(router, "First", 1000.0)
+    second = trade(router, "Second", 2000.0)
+    with router.routing("First"):
+        first.sell("sell1", START + 2, "AAPL", 10, 20.0)
+        assert realized_pnl(first) == pytest.approx(100.0)
+    with router.routing("Second"):
+        assert [lot.remaining for lot in engine.get_open_lots(second, "AAPL")] == [10]
+        assert realized_pnl(second) == 0.0
+
+
+def test_threads_write_to_their_shards(router):
+    names = [f"portfolio{i}" for i in range(4)]
+    for name in names:
+        router.init_portfolio(name)
+    errors = []
+
+    def run(name):
+        try:
+            with router.routing(name):
+                account = Portfolio.get(Portfolio.name == name).add_account("Account")
+                for i in range(50):
+                    account.deposit(f"dep{i}", START + i, 10.0)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            router.close()
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    for name in names:
+        with router.routing(name):
+            assert Portfolio.get(Portfolio.name == name).accounts[0].get_cash() == 500.0
+
+
+def test_shards_read_archived_reference_history(router):
+    def ts(year):
+        return int(datetime(year, 6, 1, 16, tzinfo=timezone.utc).timestamp() * 1000)
+
+    # The opened database has partitions, with history of its own accounts
+    reference = Portfolio.init("Reference").add_account("Account")
+    for year in (2019, 2020, 2021):
+        reference.deposit(f"dep{year}", ts(year), 1000.0)
+    stock = Portfolio.init("Reference").start_watching("AAPL")
+    stock.add_prices([(ts(year), 1.0, 1.0, 1.0, year - 2000.0, year - 2000.0, 100) for year in (2019, 2020, 2021)])
+    try:
+        assert archive(2021) == 4
+
+        with router.routing("First"):
+            account = Portfolio.init("First").add_account("Account")
+            account.deposit("dep1", ts(2021), 500.0)
+            # The partitions' balances belong to the reference account with the same id
+            assert account.get_cash(ts(2019)) == 0.0
+            assert account.get_cash() == 500.0
+            assert [balance.cash for balance in iter_balances(account)] == [500.0]
+            assert Stock.get(Stock.symbol == "AAPL").get_price(ts(2019)).close == 19.0
+        assert reference.get_cash(ts(2019)) == 1000.0
+    finally:
+        router.close()
+        for year in get_partition_years():
+            db.detach(f"p{year}")
+            os.remove(get_partition_path(year))
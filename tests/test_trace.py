@@ -0,0 +1,81 @@
+import logging
+
+import pytest
+
+import alfa.db
+from alfa.db import Portfolio, _LazyTimestamp
+from alfa.trace import Tracer, tracer
+
+
+START = 1_700_000_000_000
+
+
+@pytest.fixture
+def tracing():
+    tracer.enable(size=4)
+    yield tracer
+    tracer.disable()
+    tracer.clear()
+
+
+def test_ring_buffer_keeps_last_records():
+    trace = Tracer()
+    trace.register("op", "a", "b")
+    trace.enable(size=2)
+    for i in range(3):
+        trace.record("key", "op", i, i * 2)
+    assert [(record["operation"], record["a"], record["b"]) for record in trace.dump("key")] == [("op", 1, 2), ("op", 2, 4)]
+    trace.record("key", "unregistered", 5)
+    assert trace.dump("key")[-1]["value0"] == 5
+    assert trace.dump("other") == []
+    with pytest.raises(ValueError):
+        trace.enable(size=0)
+
+
+def test_disabled_by_default(test_db):
+    assert not tracer.enabled
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", START, 1000.0)
+    assert account.get_trace() == []
+
+
+def test_account_operations_traced(test_db, tracing):
+    portfolio = Portfolio.init("Portfolio")
+    account = portfolio.add_account("Account")
+    account.deposit("dep1", START, 1000.0)
+    account.buy("buy1", START + 1, "AAPL", 2, 10.0)
+    trace = account.get_trace()
+    # The deposit's cash ledger entry fell out of the buffer
+    assert [record["operation"] for record in trace] == ["balance", "transaction", "balance", "position"]
+    assert (trace[1]["external_id"], trace[1]["symbol"], trace[1]["quantity"]) == ("buy1", "AAPL", 2)
+    assert trace[2]["cash"] == 980.0
+    assert (trace[3]["size"], trace[3]["average_price"]) == (2, 10.0)
+    assert portfolio.add_account("Other").get_trace() == []
+
+
+def test_lazy_log_arguments(test_db, caplog):
+    class Timestamp(_LazyTimestamp):
+        formatted = 0
+
+        def __str__(self):
+            Timestamp.formatted += 1
+            return super().__str__()
+
+    log = logging.getLogger("alfa")
+    with caplog.at_level(logging.INFO, logger="alfa"):
+        log.debug("Timestamp %s.", Timestamp(START))
+    assert Timestamp.formatted == 0
+    with caplog.at_level(logging.DEBUG, logger="alfa"):
+        log.debug("Timestamp %s.", Timestamp(START))
+    assert Timestamp.formatted > 0
+
+
+def test_dated_price_reads_format_nothing(test_db, caplog, monkeypatch):
+    stock = Portfolio.init("Portfolio").start_watching("AAPL")
+    stock.add_price(START, 1.0, 1.0, 1.0, 1.0, 1.0, 100)
+    formatted = []
+    monkeypatch.setattr(alfa.db, "strtimestamp", lambda timestamp: formatted.append(timestamp))
+    with caplog.at_level(logging.INFO, logger="alfa"):
+        assert stock.get_price(START + 1).close == 1.0
+    assert formatted == []
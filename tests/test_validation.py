@@ -0,0 +1,92 @@
+import math
+
+import numpy as np
+import pytest
+
+from alfa.db import Portfolio, Price, PriceQuarantine
+from alfa.validation import Check, Rules, ValidationAction, get_reasons, repair_prices, validate_prices
+
+
+DAY = 86_400_000
+START = 1_700_000_000_000
+
+
+def bar(day, close=100.0, high=None, low=None, volume=1000):
+    return (START + day * DAY, close, close + 1.0 if high is None else high, close - 1.0 if low is None else low, close, close, volume)
+
+
+BARS = [
+    bar(0),
+    bar(1, high=98.0),  # High below low and the close above it
+    bar(2, close=0.0),
+    bar(3, volume=-1),
+    bar(3, close=101.0),  # Replaces the previous bar
+    bar(5),
+    bar(4, close=math.nan),
+    bar(20, close=300.0),
+]
+
+
+def test_checks():
+    report = validate_prices("AAPL", BARS)
+    assert report.count == len(BARS)
+    assert {check: rows.tolist() for check, rows in report.violations.items()} == {
+        Check.HIGH_BELOW_LOW: [1],
+        Check.OUTSIDE_RANGE: [1],
+        Check.NON_POSITIVE_PRICE: [2, 6],
+        Check.NEGATIVE_VOLUME: [3],
+        Check.DUPLICATE_TIMESTAMP: [3],
+        Check.OUT_OF_ORDER: [6],
+    }
+    assert report.invalid.tolist() == [False, True, True, True, False, False, True, False]
+    assert get_reasons(report)[1] == "high below low, open or close outside the high-low range"
+
+    report = validate_prices("AAPL", BARS, Rules(max_move=0.5, max_interval=10 * DAY))
+    assert report.violations[Check.PRICE_GAP].tolist() == [2, 3]
+    assert report.violations[Check.TIME_GAP].tolist() == [7]
+    assert validate_prices("AAPL", []).violations == {}
+
+
+def test_repair():
+    report = validate_prices("AAPL", BARS)
+    bars, unrepaired, rows = repair_prices(BARS, report)
+    assert rows.tolist() == [0, 1, 2, 4, 6, 5, 7]
+    assert bars[1, 2:4].tolist() == [100.0, 98.0]
+    assert unrepaired.tolist() == [False, False, True, False, True, False, False]
+    assert not validate_prices("AAPL", bars[~unrepaired]).violations
+
+
+def test_add_prices_actions(test_db):
+    stock = Portfolio.init("Portfolio").start_watching("AAPL")
+    with pytest.raises(ValueError, match="Volume cannot be negative."):
+        stock.add_prices(BARS)
+    with pytest.raises(ValueError, match="2 non-positive price"):
+        stock.add_prices(BARS, action=ValidationAction.REJECT)
+    assert Price.select().count() == 0
+
+    # Valid bars are loaded, invalid ones set aside with their reasons
+    assert stock.add_prices(BARS, action=ValidationAction.QUARANTINE) == 4
+    assert PriceQuarantine.select().count() == 4
+    nan_bar = PriceQuarantine.get(PriceQuarantine.reasons.contains("non-positive") & PriceQuarantine.close.is_null())
+    assert nan_bar.reasons == "non-positive price, out of order timestamp"
+
+    # Repaired bars are loaded too
+    PriceQuarantine.delete().execute()
+    assert stock.add_prices(BARS, action=ValidationAction.REPAIR) == 5
+    assert (stock.get_price(START + DAY).high, stock.get_price(START + DAY).low) == (100.0, 98.0)
+    assert stock.get_price(START + 3 * DAY).close == 101.0
+    assert sorted(row.timestamp for row in PriceQuarantine.select()) == [START + 2 * DAY, START + 4 * DAY]
+
+    # Batches with nothing to load
+    assert stock.add_prices([]) == 0
+    assert stock.add_prices([bar(6, close=0.0)], action=ValidationAction.QUARANTINE) == 0
+    with pytest.raises(ValueError, match="Timestamp must be a non-negative number."):
+        stock.add_prices([(-1, 1.0, 1.0, 1.0, 1.0, 1.0, 1)])
+
+
+def test_add_prices_from_array(test_db):
+    stock = Portfolio.init("Portfolio").start_watching("AAPL")
+    bars = np.array([bar(day) for day in range(10)])
+    assert stock.add_prices(bars, rules=Rules(max_move=0.1)) == 10
+    assert stock.get_price().timestamp == START + 9 * DAY
+    assert isinstance(stock.get_price().volume, int)